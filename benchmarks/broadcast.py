@@ -0,0 +1,93 @@
+"""Load test for the WebSocket fan-out with simulated consumers.
+
+Usage::
+
+    python -m benchmarks.broadcast --clients 500 --slow 25 --messages 2000
+
+Fast clients take ``--send-delay`` seconds per send, slow ones ``--slow-delay``.
+Reports how long ``broadcast`` blocks the event pipeline and how far clients lag.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from ws.encoding import Payload
+from ws.models import SlowClientPolicy
+from ws.websocket_manager import WebsocketManager
+
+
+class SimulatedConsumer:
+    def __init__(self, index: int, delay: float):
+        self.scope = {"client": ("127.0.0.1", 10000 + index)}
+        self.delay = delay
+        self.received = 0
+        self.closed = False
+
+    async def send(self, text_data=None, bytes_data=None) -> None:
+        await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code=None) -> None:
+        self.closed = True
+
+
+async def run(args: argparse.Namespace) -> dict:
+    manager = WebsocketManager("Benchmark", max_pending=args.queue_size)
+    consumers = [
+        SimulatedConsumer(i, args.slow_delay if i < args.slow else args.send_delay)
+        for i in range(args.clients)
+    ]
+    for consumer in consumers:
+        manager.subscribe(consumer, policy=SlowClientPolicy(args.policy))
+
+    message = json.dumps({"type": "task-succeeded", "data": {"id": "x" * 36}})
+    broadcast_times = []
+    started = time.perf_counter()
+    for i in range(args.messages):
+        before = time.perf_counter()
+        await manager.broadcast(Payload.from_text(message), key=i % args.keys)
+        broadcast_times.append(time.perf_counter() - before)
+        await asyncio.sleep(args.interval)
+    pipeline_elapsed = time.perf_counter() - started
+
+    max_lag = manager.max_lag()
+    await asyncio.sleep(args.drain)
+    stats = [sender.stats() for sender in manager.active_connections.values()]
+    fast = consumers[args.slow:]
+    broadcast_times.sort()
+    return {
+        "clients": args.clients,
+        "slow_clients": args.slow,
+        "messages": args.messages,
+        "policy": args.policy,
+        "pipeline_seconds": round(pipeline_elapsed, 4),
+        "broadcast_p50_ms": round(statistics.median(broadcast_times) * 1000, 4),
+        "broadcast_p99_ms": round(broadcast_times[int(len(broadcast_times) * 0.99)] * 1000, 4),
+        "fast_client_min_received": min((c.received for c in fast), default=0),
+        "max_lag_seconds": round(max_lag, 4),
+        "dropped": sum(s.dropped for s in stats),
+        "coalesced": sum(s.coalesced for s in stats),
+        "disconnected": sum(c.closed for c in consumers),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--slow", type=int, default=25)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--keys", type=int, default=200, help="Distinct entities the messages are about")
+    parser.add_argument("--interval", type=float, default=0.0, help="Seconds between broadcasts")
+    parser.add_argument("--send-delay", type=float, default=0.0)
+    parser.add_argument("--slow-delay", type=float, default=0.05)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--policy", choices=[policy.value for policy in SlowClientPolicy], default="coalesce")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to let writers drain before reporting")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Events/sec through the ingestion and parsing stages, without a broker.
+
+Usage::
+
+    python -m benchmarks.ingestion --workflows 2000
+
+``--double-apply`` reproduces the old pipeline, where the broadcaster applied
+every event to the state a second time before parsing it.
+"""
+import argparse
+import json
+import time
+
+from events.broadcaster import parse_event
+from events.factories import SyntheticCluster
+from events.clusters import clusters
+from events.receiver import apply_event, state
+
+
+def run(events: list[dict], double_apply: bool) -> dict:
+    state.clear(ready=False)
+    clusters.default.index.clear()
+
+    started = time.perf_counter()
+    for event in events:
+        applied = apply_event(dict(event))
+        if double_apply:
+            state.event(applied.event)
+        parse_event(applied)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "mode": "double-apply" if double_apply else "single-apply",
+        "events": len(events),
+        "seconds": round(elapsed, 4),
+        "events_per_sec": round(len(events) / elapsed),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workflows", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--double-apply", action="store_true", help="Only run the old double-apply pipeline")
+    args = parser.parse_args()
+
+    events = list(SyntheticCluster(workers=args.workers, seed=args.seed).events(args.workflows))
+    modes = [True] if args.double_apply else [True, False]
+    print(json.dumps([run(events, double_apply) for double_apply in modes], indent=4))
+
+
+if __name__ == "__main__":
+    main()
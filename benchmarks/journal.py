@@ -0,0 +1,74 @@
+"""Event journal ingest throughput and cold-start rebuild time.
+
+Usage::
+
+    python -m benchmarks.journal --events 1000000
+
+Appends synthetic events to a journal in a temporary directory (applying them to a state
+and snapshotting as the receiver does), then restores a fresh state from it.
+"""
+import argparse
+import itertools
+import json
+import tempfile
+import time
+
+from celery.events.state import State
+
+from events.changelog import ChangeLog
+from events.factories import SyntheticCluster
+from events.journal import EventJournal
+from events.snapshot import SnapshotManager
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--max-tasks", type=int, default=10000)
+    parser.add_argument("--snapshot-interval", type=int, default=100_000)
+    parser.add_argument("--segment-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Workflows have 6 tasks of 4 events each, plus heartbeats
+    cluster = SyntheticCluster(seed=args.seed)
+    events = list(itertools.islice(cluster.events(args.events // 24 + 1), args.events))
+
+    with tempfile.TemporaryDirectory() as path:
+        journal = EventJournal(path, segment_size=args.segment_size, snapshot_interval=args.snapshot_interval)
+        journal.start()
+        state = State(max_tasks_in_memory=args.max_tasks)
+        snapshots = SnapshotManager(state, ChangeLog(args.max_tasks))
+
+        started = time.perf_counter()
+        for event in events:
+            journal.append(event)
+            snapshots.apply(event)
+            journal.maybe_snapshot(snapshots)
+        journal.close()
+        ingest_seconds = time.perf_counter() - started
+
+        segments = journal.segments()
+        journal_bytes = sum(segment.stat().st_size for segment in segments)
+
+        restored = State(max_tasks_in_memory=args.max_tasks)
+        started = time.perf_counter()
+        replayed = EventJournal(path).restore(restored)
+        restore_seconds = time.perf_counter() - started
+
+    print(json.dumps({
+        "events": len(events),
+        "ingest_seconds": round(ingest_seconds, 3),
+        "ingest_events_per_sec": round(len(events) / ingest_seconds),
+        "segments": len(segments),
+        "journal_bytes": journal_bytes,
+        "bytes_per_event": round(journal_bytes / len(events), 1),
+        "restore_seconds": round(restore_seconds, 3),
+        "replayed_events": replayed,
+        "restored_tasks": len(restored.tasks),
+        "state_tasks": len(state.tasks),
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Bytes per task held by the state, with celery's task records and with the compact store.
+
+Usage::
+
+    python -m benchmarks.memory --tasks 100000 1000000
+
+Each task goes through sent/received/started/succeeded events, as in a real cluster. Memory is
+measured with tracemalloc, so the run takes a while and reports allocations made by Python only.
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+import uuid
+
+from celery.events.state import State
+
+from events.store import CompactState
+
+TASK_NAMES = [f"project.tasks.task_{i}" for i in range(50)]
+WORKERS = [f"celery@worker-{i}" for i in range(20)]
+QUEUES = ["default", "priority", "reports"]
+
+
+def task_events(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    clock = 0
+    now = time.time()
+    for i in range(count):
+        task_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        name = rng.choice(TASK_NAMES)
+        worker = rng.choice(WORKERS)
+        common = {"uuid": task_id, "pid": 1234, "utcoffset": 0}
+        timestamp = now + i * 0.001
+        for subject, fields in (
+                ("sent", {
+                    "hostname": "client@web-1", "name": name, "args": f"({i}, 'order-{i}')", "kwargs": "{}",
+                    "routing_key": rng.choice(QUEUES), "exchange": "", "retries": 0, "root_id": task_id,
+                    "parent_id": None, "eta": None, "expires": None,
+                }),
+                ("received", {"hostname": worker, "name": name, "args": f"({i}, 'order-{i}')", "kwargs": "{}"}),
+                ("started", {"hostname": worker}),
+                ("succeeded", {"hostname": worker, "result": "'ok'", "runtime": rng.random()}),
+        ):
+            clock += 1
+            yield {
+                "type": f"task-{subject}", "timestamp": timestamp, "local_received": timestamp, "clock": clock,
+                **common, **fields,
+            }
+
+
+def measure(state_cls: type[State], tasks: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    state = state_cls(max_tasks_in_memory=tasks)
+    started = time.perf_counter()
+    for event in task_events(tasks):
+        state.event(event)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {
+        "store": state_cls.__name__,
+        "tasks": len(state.tasks),
+        "bytes_per_task": round((current - baseline) / len(state.tasks)),
+        "total_mb": round((current - baseline) / 1024 / 1024, 1),
+        "events_per_second": round(tasks * 4 / elapsed),
+    }
+    del state
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--store", choices=["celery", "compact", "both"], default="both")
+    args = parser.parse_args()
+
+    stores = {"celery": [State], "compact": [CompactState], "both": [State, CompactState]}[args.store]
+    print(json.dumps([measure(store, tasks) for tasks in args.tasks for store in stores], indent=4))
+
+
+if __name__ == "__main__":
+    main()
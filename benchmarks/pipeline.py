@@ -0,0 +1,178 @@
+"""End-to-end benchmark of the event pipeline, from the broker callback to the WebSocket clients and HTTP API.
+
+Usage::
+
+    python -m benchmarks.pipeline --workflows 2000 --clients 100 --output pipeline.json
+
+Synthetic events (see ``events.factories.SyntheticCluster``) go through ``CeleryEventReceiver.on_event``,
+the event channel, ``parse_event`` and ``WebsocketManager.broadcast`` to simulated clients, at ``--rate``
+events/sec (as fast as possible by default), while the task and worker list views are requested every
+``--http-every`` events. Reports events/sec, p50/p99 latency per stage, allocations and peak RSS as JSON,
+tagged with the current commit so runs can be compared across commits.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import subprocess
+import time
+import tracemalloc
+from collections import defaultdict
+
+STAGES = ("receive", "queue", "parse", "broadcast", "end_to_end", "http_tasks", "http_tasks_delta", "http_workers")
+
+
+class SimulatedConsumer:
+    def __init__(self, index: int):
+        self.scope = {"client": ("127.0.0.1", 10000 + index)}
+        self.received = 0
+
+    async def send(self, text_data=None, bytes_data=None) -> None:
+        self.received += 1
+
+    async def close(self, code=None) -> None:
+        pass
+
+
+def summarize(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 2),
+        "p50_us": round(samples[len(samples) // 2] * 1e6, 2),
+        "p99_us": round(samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1e6, 2),
+        "max_us": round(samples[-1] * 1e6, 2),
+    }
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(events: list[dict], args: argparse.Namespace) -> dict:
+    from django.test import RequestFactory
+
+    from events.broadcaster import event_attributes, parse_event
+    from events.channel import EventChannel
+    from events.receiver import CeleryEventReceiver, applied_event_key
+    from tasks.views import get_tasks
+    from workers.views import get_workers
+    from ws.encoding import Payload
+    from ws.websocket_manager import WebsocketManager
+
+    timings: dict[str, list[float]] = defaultdict(list)
+    channel = EventChannel(max_size=len(events) + 1, batch_size=args.batch_size, batch_window=0)
+    receiver = CeleryEventReceiver(app=None, queue=channel, journal=None)
+    manager = WebsocketManager("Benchmark", max_pending=1_000_000)
+    consumers = [SimulatedConsumer(i) for i in range(args.clients)]
+    for consumer in consumers:
+        manager.subscribe(consumer)
+    requests = RequestFactory()
+    received_at: dict[int, float] = {}
+    version = None
+
+    async def drain() -> None:
+        for applied in await channel.get_batch():
+            dequeued = time.perf_counter()
+            timings["queue"].append(dequeued - received_at[id(applied.event)])
+            message = parse_event(applied)
+            parsed = time.perf_counter()
+            timings["parse"].append(parsed - dequeued)
+            if message is not None:
+                await manager.broadcast(Payload(message), key=applied_event_key(applied),
+                                        attributes=event_attributes(applied))
+            done = time.perf_counter()
+            timings["broadcast"].append(done - parsed)
+            timings["end_to_end"].append(done - received_at.pop(id(applied.event)))
+        # Let the client writers run
+        await asyncio.sleep(0)
+
+    def request(stage: str, view, path: str):
+        before = time.perf_counter()
+        response = view(requests.get(path))
+        timings[stage].append(time.perf_counter() - before)
+        return response
+
+    if args.trace_allocations:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for i, event in enumerate(events):
+        if args.rate:
+            ahead = started + i / args.rate - time.perf_counter()
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+        before = time.perf_counter()
+        received_at[id(event)] = before
+        receiver.on_event(event)
+        timings["receive"].append(time.perf_counter() - before)
+
+        if len(channel) >= args.batch_size:
+            await drain()
+        if args.http_every and i % args.http_every == args.http_every - 1:
+            page = json.loads(request("http_tasks", get_tasks, f"/api/tasks?limit={args.page_size}").content)
+            if version is not None:
+                request("http_tasks_delta", get_tasks, f"/api/tasks?limit={args.page_size}&since={version}")
+            version = page["version"]
+            before = time.perf_counter()
+            await get_workers(requests.get("/api/workers"))
+            timings["http_workers"].append(time.perf_counter() - before)
+    while len(channel):
+        await drain()
+    elapsed = time.perf_counter() - started
+    while any(sender.stats().pending for sender in manager.active_connections.values()):
+        await asyncio.sleep(0.01)
+
+    allocations = None
+    if args.trace_allocations:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocations = {"current_mb": round(current / 1024 / 1024, 2), "peak_mb": round(peak / 1024 / 1024, 2)}
+
+    return {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "events": len(events),
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(len(events) / elapsed),
+        "delivered": sum(consumer.received for consumer in consumers),
+        "stages": {stage: summarize(timings[stage]) for stage in STAGES},
+        "allocations": allocations,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main() -> None:
+    from events.factories import SyntheticCluster
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workflows", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=0, help="Events/sec to feed, 0 for as fast as possible")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--http-every", type=int, default=1000, help="Events between API requests, 0 for none")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--trace-allocations", action="store_true", help="Trace allocations (slows the run down)")
+    parser.add_argument("--output", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    events = list(SyntheticCluster(workers=args.workers, seed=args.seed).events(args.workflows))
+    report = json.dumps(asyncio.run(run(events, args)), indent=4)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Client fan-out and API throughput of replica processes fed from one event stream.
+
+Usage::
+
+    python -m benchmarks.scaleout --processes 1 2 4 --clients 400 --requests 4000
+
+Every replica receives every event (as batches over a multiprocessing queue, standing in for the
+channel layer) and applies it to its own state, while the simulated WebSocket clients and API
+requests are split evenly between the replicas. Reports delivered messages/sec and requests/sec
+for each process count.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+BATCH_SIZE = 500
+
+
+class SimulatedConsumer:
+    def __init__(self, index: int):
+        self.scope = {"client": ("127.0.0.1", 10000 + index)}
+        self.received = 0
+
+    async def send(self, text_data=None, bytes_data=None) -> None:
+        self.received += 1
+
+    async def close(self, code=None) -> None:
+        pass
+
+
+def replica(bus: multiprocessing.Queue, clients: int, requests: int, results: multiprocessing.Queue) -> None:
+    from events.broadcaster import parse_event
+    from events.receiver import apply_event, state
+    from events.clusters import clusters
+    from ws.encoding import Payload
+    from ws.websocket_manager import WebsocketManager
+
+    batches_expected = bus.get()
+
+    async def run() -> dict:
+        manager = WebsocketManager("Benchmark", max_pending=1_000_000)
+        consumers = [SimulatedConsumer(i) for i in range(clients)]
+        for consumer in consumers:
+            manager.subscribe(consumer)
+
+        started = time.perf_counter()
+        batches = 0
+        while (batch := bus.get()) is not None:
+            for event in batch:
+                applied = apply_event(event)
+                message = parse_event(applied)
+                if message is not None:
+                    manager.send(manager.route(), Payload(message))
+            batches += 1
+            # Serve this replica's share of API requests while events keep flowing
+            for _ in range(requests // batches_expected):
+                clusters.default.index.query(state.tasks.data.get, limit=100)
+            await asyncio.sleep(0)
+        while any(sender.stats().pending for sender in manager.active_connections.values()):
+            await asyncio.sleep(0.01)
+        return {"elapsed": time.perf_counter() - started, "delivered": sum(c.received for c in consumers)}
+
+    results.put(asyncio.run(run()))
+
+
+def measure(events: list[dict], processes: int, clients: int, requests: int) -> dict:
+    batches = [events[i:i + BATCH_SIZE] for i in range(0, len(events), BATCH_SIZE)]
+    buses = [multiprocessing.Queue() for _ in range(processes)]
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=replica, args=(bus, clients // processes, requests // processes, results))
+        for bus in buses
+    ]
+    for worker in workers:
+        worker.start()
+
+    started = time.perf_counter()
+    for bus in buses:
+        bus.put(len(batches))
+    for batch in batches:
+        for bus in buses:
+            bus.put(batch)
+    for bus in buses:
+        bus.put(None)
+    reports = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+
+    return {
+        "processes": processes,
+        "clients": clients,
+        "events": len(events),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(sum(report["delivered"] for report in reports) / elapsed),
+        "requests_per_second": round(requests // processes * processes / elapsed),
+    }
+
+
+def main() -> None:
+    from events.factories import SyntheticCluster
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workflows", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=400)
+    parser.add_argument("--requests", type=int, default=4000)
+    args = parser.parse_args()
+
+    events = list(SyntheticCluster(seed=0).events(args.workflows))
+    print(json.dumps([
+        measure(events, processes, args.clients, args.requests) for processes in args.processes
+    ], indent=4))
+
+
+if __name__ == "__main__":
+    main()
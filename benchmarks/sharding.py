@@ -0,0 +1,92 @@
+"""Ingestion throughput of the state sharded across processes, against applying events in the server process.
+
+Usage::
+
+    python -m benchmarks.sharding --shards 1 2 4 8 --workflows 5000
+
+Synthetic events (see ``events.factories.SyntheticCluster``) are applied, parsed and encoded either inline,
+as ``CeleryEventReceiver`` and ``EventBroadcaster`` do by default, or by a ``ShardPool`` of each size (the
+number of cores by default) whose results are merged back by the benchmark process. Reports events/sec
+for each, from the first event sent until the last one is merged. Sharding only pays off with free cores:
+expect events/sec to grow with the shard count up to the number of cores, and to fall beyond it.
+
+``server_cpu_seconds`` is the CPU time the benchmark process spent routing events and merging results. It bounds
+the sharded throughput whatever the number of cores, at ``events / server_cpu_seconds`` events/sec, so it can be
+checked on a single core too.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+
+def measure_inline(events: list[dict]) -> dict:
+    from events.broadcaster import parse_event
+    from events.receiver import apply_event
+
+    started = time.perf_counter()
+    for event in events:
+        parse_event(apply_event(dict(event))).model_dump_json()
+    elapsed = time.perf_counter() - started
+    return {"shards": 0, "events": len(events), "seconds": round(elapsed, 3),
+            "events_per_second": round(len(events) / elapsed)}
+
+
+def measure(events: list[dict], shards: int, batch_size: int, timeout: float) -> dict:
+    from events.sharding import ShardPool
+
+    merged = 0
+    done = threading.Event()
+
+    def on_applied(batch) -> None:
+        nonlocal merged
+        merged += len(batch)
+        if merged == len(events):
+            done.set()
+
+    pool = ShardPool(shards, batch_size=batch_size, on_applied=on_applied)
+    pool.start()
+    # Wait for every shard process to be up, so its start up is not measured
+    pool.gather("workers")
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    for event in events:
+        pool.put(event)
+    pool.flush()
+    completed = done.wait(timeout)
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    pool.stop()
+
+    return {
+        "shards": shards,
+        "events": len(events),
+        "merged": merged,
+        "completed": completed,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(merged / elapsed),
+        "server_cpu_seconds": round(cpu, 3),
+    }
+
+
+def main() -> None:
+    from events.factories import SyntheticCluster
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=list(range(1, (os.cpu_count() or 1) + 1)))
+    parser.add_argument("--workflows", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the shards to catch up")
+    args = parser.parse_args()
+
+    events = list(SyntheticCluster(workers=args.workers, seed=0).events(args.workflows))
+    print(json.dumps({
+        "cpu_count": os.cpu_count(),
+        "inline": measure_inline(events),
+        "sharded": [measure(events, shards, args.batch_size, args.timeout) for shards in args.shards],
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,21 @@ import logging
 
 from celery import Celery
 
+from celery_detect.settings import CELERY_CLUSTERS, CELERY_DEFAULT_CLUSTER
+
 logger = logging.getLogger(__name__)
-_celery_app_cache: Celery | None = None
+_celery_app_cache: dict[str, Celery] = {}
 
 
-def get_celery_app():
-    global _celery_app_cache
-    if _celery_app_cache is not None:
-        return _celery_app_cache
+def get_celery_app(cluster: str = CELERY_DEFAULT_CLUSTER):
+    """The Celery app of a cluster, configured from the CELERY_ settings and the cluster's CELERY_CLUSTERS entry."""
+    if cluster in _celery_app_cache:
+        return _celery_app_cache[cluster]
     app = Celery(
         'celery_detect'
     )
     app.config_from_object('django.conf:settings', namespace='CELERY')
-    _celery_app_cache = app
+    if cluster != CELERY_DEFAULT_CLUSTER:
+        app.conf.update(CELERY_CLUSTERS[cluster])
+    _celery_app_cache[cluster] = app
     return app
@@ -31,11 +31,19 @@ ALLOWED_HOSTS = ['*']
 
 INSTALLED_APPS = [
     'daphne',
-    'django_celery_results'
+    # Needed by the admin site and the authentication middleware
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django_celery_results',
     'ws',
     'events',
     'server_info',
     'tasks',
+    'history',
+    'metrics',
     'workers',
     'chat'
 ]
@@ -48,9 +56,34 @@ CELERY_TASK_TRACK_STARTED = True
 CELERY_WORKER_SEND_TASK_EVENTS = True  # Enables task events
 CELERY_SEND_TASK_SENT_EVENT = True
 CELERY_ENABLE_UTC = True
+# More Celery clusters monitored by this instance, by cluster id, each with its own event consumer and state. Values
+# override the CELERY_ settings above, e.g, {'payments': {'CELERY_BROKER_URL': 'amqp://...'}}. The broker above is
+# the CELERY_DEFAULT_CLUSTER cluster. The event journal covers the default cluster only.
+CELERY_CLUSTERS = {}
+CELERY_DEFAULT_CLUSTER = "default"
 # Celery-Detect Config
 CELERY_MAX_TASKS = 10000
 CELERY_MAX_WORKERS = 5000
+# Tasks and workers remembered as changed for ?since= delta requests, older versions get a full response.
+CELERY_CHANGE_LOG_SIZE = 100000
+# Hand-off from the event receiver thread to the asyncio loop.
+# Overflow policy is one of "drop-oldest", "coalesce" (keep the latest event per task/worker) or "block".
+CELERY_EVENT_QUEUE_SIZE = 100000
+CELERY_EVENT_QUEUE_OVERFLOW = "drop-oldest"
+CELERY_EVENT_BATCH_SIZE = 500
+CELERY_EVENT_BATCH_WINDOW = 0.005  # seconds
+# WebSocket fan-out: pending messages per client, and what to do with clients that fall behind
+# ("drop" the oldest messages, "coalesce" to the latest state per task/worker, or "disconnect").
+CELERY_WS_CLIENT_QUEUE_SIZE = 1000
+CELERY_WS_SLOW_CLIENT_POLICY = "coalesce"
+# Scale-out: a "standalone" process consumes events from the broker and serves every client. An "ingest" process
+# does the same and also publishes the events on the channel layer, for any number of "replica" processes that
+# serve clients from their own copy of the state without connecting to the broker. Replicas need a channel layer
+# shared between processes (e.g, channels_redis) instead of the InMemoryChannelLayer.
+CELERY_DETECT_ROLE = os.environ.get("CELERY_DETECT_ROLE", "standalone")
+# Worker heartbeats are merged per worker and broadcast as one "workers-changed" message per window.
+# Set to 0 to broadcast every heartbeat as it arrives.
+CELERY_HEARTBEAT_COALESCE_WINDOW = 2.0  # seconds
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -143,7 +176,120 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 DebugBundleSettings = {
-    'LOG_FILE_PATH': "./logs"
+    'LOG_FILE_PATH': "./logs",
+    'PROFILE_SECONDS': 5,  # seconds the server is profiled for bundles downloaded by admins, 0 to never profile
+    'PROFILE_ALLOCATIONS': 20,  # largest allocation sites traced during the profile, 0 to skip tracemalloc
+}
+
+# Memory-compact task records, for keeping 1M+ tasks in memory. Long text fields are truncated to the given lengths.
+TaskStoreSettings = {
+    'COMPACT': False,
+    'MAX_ARGS_LENGTH': 1024,  # args and kwargs
+    'MAX_RESULT_LENGTH': 1024,  # result and exception
+    'MAX_TRACEBACK_LENGTH': 16 * 1024,
+}
+
+# Tasks evicted before CELERY_MAX_TASKS is reached, e.g, to keep failures longer than successes or to stop one
+# noisy task type from pushing out the others. Can be replaced at runtime through /api/settings/retention/.
+RetentionSettings = {
+    'TTL': {},  # seconds to keep tasks per state after their last event, e.g, {'SUCCESS': 3600, 'FAILURE': 86400}
+    'DEFAULT_TTL': None,  # seconds to keep tasks in other states, None to keep them until evicted by count
+    'STATE_QUOTAS': {},  # maximum number of tasks kept per state, e.g, {'SUCCESS': 50000}
+    'TYPE_QUOTAS': {},  # maximum number of tasks kept per task type
+    'DEFAULT_TYPE_QUOTA': None,  # maximum number of tasks kept for other task types
+    'SWEEP_INTERVAL': 60.0,  # seconds between evictions of the tasks whose TTL ran out without events, None to pause
+}
+
+# Optional on-disk journal of received events, replayed into the state on startup.
+EventJournalSettings = {
+    'PATH': None,  # Directory for journal segments and state snapshots, None disables the journal
+    'SEGMENT_SIZE': 64 * 1024 * 1024,  # bytes per segment file
+    'FSYNC_INTERVAL': 1.0,  # seconds between batched fsyncs
+    'SNAPSHOT_INTERVAL': 100000,  # events between state snapshots, bounds replay time
+    'MAX_AGE': 7 * 24 * 3600,  # seconds to keep segments, None to keep forever
+    'MAX_SIZE': 1024 * 1024 * 1024,  # total bytes of segments to keep, None for no limit
+}
+
+# Optional archive of task snapshots in the database, searchable after eviction from memory.
+TaskArchiveSettings = {
+    'ENABLED': False,
+    'BATCH_SIZE': 1000,  # rows per bulk upsert
+    'FLUSH_INTERVAL': 1.0,  # seconds between writes
+    'MAX_PENDING': 100000,  # tasks waiting to be written before new updates are dropped
+}
+
+# Inspect broadcasts behind /api/workers: seconds to wait for replies, and seconds each worker's reply is reused.
+InspectSettings = {
+    'TIMEOUT': 10.0,
+    'TTL': {
+        'stats': 5.0,
+        'registered': 5.0,
+        'revoked': 5.0,
+        'active_queues': 5.0,
+        'scheduled': 1.0,
+        'reserved': 1.0,
+        'active': 1.0,
+    },
+}
+
+# Event bus between the ingest process and the replicas, see CELERY_DETECT_ROLE.
+EventBusSettings = {
+    'GROUP': 'celery_detect.events',  # channel layer group the events are published to
+}
+
+# Optional background polling of worker details, pushed to ws/workers as they change. While clients are
+# connected each command runs every INTERVALS seconds, backing off up to MAX_BACKOFF times while nothing changes.
+WorkerPollerSettings = {
+    'ENABLED': False,
+    'INTERVALS': {
+        'active': 2.0,
+        'reserved': 2.0,
+        'scheduled': 10.0,
+        'stats': 10.0,
+        'active_queues': 30.0,
+    },
+    'MAX_BACKOFF': 4.0,
+    'IDLE_INTERVAL': 60.0,  # seconds between polls without connected clients, None to pause
+}
+
+# Rolling task metrics served by /api/metrics: BUCKETS buckets of BUCKET_SECONDS each are kept per series.
+MetricsSettings = {
+    'BUCKET_SECONDS': 10.0,
+    'BUCKETS': 60,  # i.e, the last 10 minutes
+    'MAX_SERIES': 500,  # task types, workers and routing keys tracked, least recently updated are dropped
+}
+
+# Sampled timing of events through each stage from the broker to the WebSocket clients, reported by
+# /api/settings/info and the debug bundle. A SAMPLE_RATE of 0 disables tracing.
+LatencyTracingSettings = {
+    'SAMPLE_RATE': 0.01,
+}
+
+# Sampling profiler behind /api/settings/profile, restricted to admins sending "Authorization: Bearer <TOKEN>".
+# The endpoint is disabled while no TOKEN is set.
+ProfilerSettings = {
+    'TOKEN': os.environ.get("CELERY_DETECT_ADMIN_TOKEN"),
+    'INTERVAL': 0.005,  # seconds between samples of the threads' stacks
+    'MAX_SECONDS': 60,
+}
+
+# API models of tasks and workers are cached per cluster, and only converted again once an event changes them.
+# The MAX_ENTRIES least recently read models are kept, along with their JSON encoding once it is needed.
+ConversionCacheSettings = {
+    'MAX_ENTRIES': 10000,
+}
+
+# Optional sharding of the state across processes, each applying the events of the tasks (by workflow) and workers
+# hashed to it, so ingestion scales with cores. SHARDS below 2 applies events in the server process. Sharded mode
+# only monitors the default cluster and does not support the event journal, deltas or raw events.
+ShardingSettings = {
+    'SHARDS': int(os.environ.get("CELERY_DETECT_SHARDS", 0)),
+    'BATCH_SIZE': 500,  # events sent to a shard at once
+    'BATCH_WINDOW': 0.005,  # seconds events wait for a batch to fill up
+    'QUERY_TIMEOUT': 10.0,  # seconds to wait for the shards to answer a query, before responding with a 503
+    'INBOX_SIZE': 64,  # batches waiting for a shard, before events wait in the server process
+    'MAX_PENDING': CELERY_EVENT_QUEUE_SIZE,  # events waiting in the server process per shard, beyond INBOX_SIZE
+    'OVERFLOW': CELERY_EVENT_QUEUE_OVERFLOW,  # what happens beyond MAX_PENDING, drop-oldest (or coalesce) or block
 }
 
 LOG_DIR = os.path.join(BASE_DIR, 'log')
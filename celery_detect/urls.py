@@ -17,10 +17,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from metrics.views import export_prometheus_metrics
+
 urlpatterns = [
     path("chat", include("chat.urls")),
     path("api/workers", include("workers.urls")),
+    path("api/tasks/history", include("history.urls")),
     path("api/tasks",  include("tasks.urls")),
-    path("api/settings", include("server_info.urls")),
+    path("api/metrics", include("metrics.urls")),
+    path("api/settings/", include("server_info.urls")),
+    path("metrics", export_prometheus_metrics, name="export_prometheus_metrics"),
     path("admin", admin.site.urls),
 ]
\ No newline at end of file
@@ -0,0 +1,19 @@
+import json
+from collections.abc import Iterable
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+
+def json_list_response(items: Iterable[bytes]) -> HttpResponse:
+    """JSON array of already encoded items."""
+    return HttpResponse(b"[" + b",".join(items) + b"]", content_type="application/json")
+
+
+def json_items_response(items: Iterable[bytes], **fields) -> HttpResponse:
+    """JSON object of already encoded ``items`` followed by ``fields``, encoded as by ``JsonResponse``."""
+    body = [b'{"items":[', b",".join(items), b"]"]
+    for name, value in fields.items():
+        body.append(f",{json.dumps(name)}:{json.dumps(value, cls=DjangoJSONEncoder)}".encode())
+    body.append(b"}")
+    return HttpResponse(b"".join(body), content_type="application/json")
@@ -1,14 +1,19 @@
 import logging
 from django.apps import AppConfig
 import threading
-from events.handler import startup_handler
+from events.handler import check_role, startup_handler
 
 logger = logging.getLogger(__name__)
 
 
 class EventsConfig(AppConfig):
     name = 'events'
+    # Unset by the state shard processes, which only set Django up to archive their tasks
+    start_event_system = True
 
     def ready(self):
+        check_role()
+        if not self.start_event_system:
+            return
         # We will call startup_handler in a new thread after Django starts.
-        threading.Thread(target=startup_handler, daemon=True).start()
\ No newline at end of file
+        threading.Thread(target=startup_handler, name="event-system", daemon=True).start()
\ No newline at end of file
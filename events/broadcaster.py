@@ -1,37 +1,91 @@
 import asyncio
-import json
 import logging
 
 from twisted.python.log import logerr
 
+from celery_detect.settings import CELERY_HEARTBEAT_COALESCE_WINDOW
+from events.clusters import clusters
+from events.coalescer import HeartbeatCoalescer
+from events.conversion import ConversionCache
 from events.exceptions import InconsistentStateStoreError, InvalidEventError
-from events.models import EventCategory, EventMessage, EventType
-from events.receiver import state
+from events.models import AppliedEvent, EventCategory, EventMessage, EventType
+from events.receiver import applied_event_key
+from events.sharding import ShardedEvent
 from events.subscriber import QueueSubscriber
-from tasks.models import Task
-from workers.models import Worker
+from ws.encoding import Payload
 from ws.managers import events_manager, raw_events_manager
+from ws.subscriptions import EventAttributes
 
 logger = logging.getLogger(__name__)
 
 
-class EventBroadcaster(QueueSubscriber[dict]):
-    async def handle_event(self, event: dict) -> None:
+class EventBroadcaster(QueueSubscriber[AppliedEvent]):
+    def __init__(self, *args, heartbeat_window: float = CELERY_HEARTBEAT_COALESCE_WINDOW, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.heartbeats = HeartbeatCoalescer(heartbeat_window) if heartbeat_window > 0 else None
+
+    def start(self):
+        super().start()
+        if self.heartbeats is not None:
+            self.heartbeats.start()
+
+    def stop(self):
+        super().stop()
+        if self.heartbeats is not None:
+            self.heartbeats.stop()
+
+    async def handle_event(self, event: AppliedEvent) -> None:
+        if event.trace is not None:
+            event.trace.mark("queue")
+        if self.heartbeats is not None and event.category == "worker":
+            if event.subject == "heartbeat":
+                self.heartbeats.add(event)
+                await broadcast_raw_event(event)
+                return
+            # Online/offline transitions are sent right away and supersede any pending heartbeat
+            self.heartbeats.discard(event.event.get("hostname"), event.event.get("cluster"))
+
         await asyncio.gather(
             broadcast_raw_event(event),
             broadcast_parsed_event(event),
         )
 
 
-async def broadcast_raw_event(event: dict) -> None:
-    logger.debug(f"Broadcasting raw event of type {event.get('type', 'UNKNOWN')!r}")
+class ShardedEventBroadcaster(QueueSubscriber[ShardedEvent]):
+    """Broadcasts the events applied by the state shards, whose messages were built and encoded there."""
+
+    async def handle_event(self, event: ShardedEvent) -> None:
+        if event.message is None or not events_manager.has_subscribers:
+            return
+
+        recipients = events_manager.route(EventAttributes(**event.attributes))
+        if recipients:
+            events_manager.send(recipients, Payload.from_text(event.message), key=event.key)
+
+
+async def broadcast_raw_event(event: AppliedEvent) -> None:
+    if not raw_events_manager.has_subscribers:
+        return
+
+    recipients = raw_events_manager.route(event_attributes(event))
+    if not recipients:
+        return
+
+    logger.debug(f"Broadcasting raw event of type {event.event.get('type', 'UNKNOWN')!r}")
     try:
-        await raw_events_manager.broadcast(json.dumps(event))
+        raw_events_manager.send(recipients, Payload(event.event))
     except Exception as e:
         logger.exception(f"Failed to broadcast raw event: {e}")
 
 
-async def broadcast_parsed_event(event: dict) -> None:
+async def broadcast_parsed_event(event: AppliedEvent) -> None:
+    if not events_manager.has_subscribers:
+        return
+
+    recipients = events_manager.route(event_attributes(event))
+    if not recipients:
+        return
+
     try:
         message = parse_event(event)
     except InvalidEventError as e:
@@ -42,37 +96,69 @@ async def broadcast_parsed_event(event: dict) -> None:
         logger.exception(f"Failed to parse event message: {e}")
     else:
         logger.debug(f"Broadcasting event {message.type.value!r}")
+        trace = event.trace
+        if trace is not None:
+            trace.mark("parse")
+            handed_off = trace.last
         try:
-            await events_manager.broadcast(message.model_dump_json())
+            events_manager.send(recipients, Payload(message, trace=trace), key=applied_event_key(event))
         except Exception as e:
             logger.exception(f"Failed to broadcast event: {e}")
+        else:
+            if trace is not None:
+                # The first client's writer may be marking its stages on the server loop already
+                trace.measure("dispatch", handed_off)
+
+
+def event_attributes(applied: AppliedEvent) -> EventAttributes:
+    """Attributes clients can filter on, taken from the state entity so they are known for every event type."""
+    event_type = applied.event.get("type", "")
+    cluster = applied.event.get("cluster")
+    entity = applied.entity
+    if applied.category == "task" and entity is not None:
+        return EventAttributes(
+            category=applied.category,
+            type=event_type,
+            task_name=entity.name,
+            worker=entity.worker.hostname if entity.worker is not None else None,
+            routing_key=entity.routing_key,
+            root_id=entity.root_id,
+            cluster=cluster,
+        )
+    elif applied.category == "worker":
+        return EventAttributes(
+            category=applied.category, type=event_type, worker=applied.event.get("hostname"), cluster=cluster,
+        )
+    return EventAttributes(category=applied.category, type=event_type, cluster=cluster)
+
 
+def parse_event(applied: AppliedEvent, models: ConversionCache | None = None) -> EventMessage:
+    """Build the event message from an event the receiver has already applied to the state.
 
-def parse_event(event: dict) -> EventMessage:
-    event_type = event.get("type")
+    The entity is converted through ``models``, by default the conversion cache of the event's cluster.
+    """
+    event_type = applied.event.get("type")
     if event_type is None:
-        raise InvalidEventError(f"Received event without type: {event}")
-
-    event_category, _ = event_type.split("-", 1)
-    state.event(event)
-    if event_category == "task":
-        return parse_task_event(event, event_type)
-    elif event_category == "worker":
-        return parse_worker_event(event, event_type)
+        raise InvalidEventError(f"Received event without type: {applied.event}")
+
+    if models is None:
+        models = clusters.get(applied.event.get("cluster")).snapshots.models
+    if applied.category == "task":
+        return parse_task_event(applied, event_type, models)
+    elif applied.category == "worker":
+        return parse_worker_event(applied, event_type, models)
     else:
-        raise InvalidEventError(f"Unknown event category {event_category!r}")
+        raise InvalidEventError(f"Unknown event category {applied.category!r}")
 
 
-def parse_worker_event(event: dict, event_type: str) -> EventMessage | None:
-    worker_hostname = event.get("hostname")
-    if worker_hostname is None:
-        raise InvalidEventError(f"Worker event {event_type!r} is missing hostname: {event}")
+def parse_worker_event(applied: AppliedEvent, event_type: str, models: ConversionCache) -> EventMessage | None:
+    if applied.event.get("hostname") is None:
+        raise InvalidEventError(f"Worker event {event_type!r} is missing hostname: {applied.event}")
 
-    state_worker = state.workers.get(worker_hostname)
-    if state_worker is None:
-        raise InconsistentStateStoreError(f"Could not find worker {worker_hostname!r} in state")
+    if applied.entity is None:
+        raise InconsistentStateStoreError(f"Worker event {event_type!r} was not applied to state")
 
-    worker = Worker.from_celery_worker(state_worker)
+    worker = models.worker(applied.entity, applied.version).model
     return EventMessage(
         type=EventType(event_type),
         category=EventCategory.WORKER,
@@ -80,16 +166,14 @@ def parse_worker_event(event: dict, event_type: str) -> EventMessage | None:
     )
 
 
-def parse_task_event(event: dict, event_type: str) -> EventMessage | None:
-    task_id = event.get("uuid")
-    if task_id is None:
-        raise InvalidEventError(f"Task event {event_type!r} is missing uuid: {event}")
+def parse_task_event(applied: AppliedEvent, event_type: str, models: ConversionCache) -> EventMessage | None:
+    if applied.event.get("uuid") is None:
+        raise InvalidEventError(f"Task event {event_type!r} is missing uuid: {applied.event}")
 
-    state_task = state.tasks.get(task_id)
-    if state_task is None:
-        raise InconsistentStateStoreError(f"Could not find task {task_id!r} in state")
+    if applied.entity is None:
+        raise InconsistentStateStoreError(f"Task event {event_type!r} was not applied to state")
 
-    task = Task.from_celery_task(state_task)
+    task = models.task(applied.entity, applied.version).model
     return EventMessage(
         type=EventType(event_type),
         category=EventCategory.TASK,
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from asyncio import CancelledError, Task as AioTask, create_task
+from itertools import repeat
+from typing import Self
+
+from channels.layers import BaseChannelLayer, get_channel_layer
+
+from celery_detect.settings import EventBusSettings
+from events.channel import EventChannel
+from events.models import AppliedEvent
+from events.receiver import apply_event
+from events.subscriber import QueueSubscriber
+from metrics.tracing import latency_tracer
+
+logger = logging.getLogger(__name__)
+
+#: Channel layer message type of a batch of raw events.
+EVENTS_MESSAGE_TYPE = "celery_detect.events"
+#: Seconds between renewals of the replica's group membership, which channel layers expire.
+GROUP_RENEWAL_INTERVAL = 3600
+
+
+class EventBusPublisher(QueueSubscriber[tuple[int | None, dict]]):
+    """Publishes the raw events received from the broker to every replica, in numbered batches.
+
+    Replicas apply the same events to their own state, so the ingestion process is the only one
+    connected to the broker, and the work of serving clients is spread across processes. The queue
+    holds the events with their sequence number in the event journal, None for events not journaled,
+    which are published along so replicas can skip the events they restored from the journal.
+    """
+
+    def __init__(
+            self,
+            queue: EventChannel[tuple[int | None, dict]],
+            group: str,
+            layer: BaseChannelLayer | None = None,
+            **kwargs,
+    ):
+        super().__init__(queue, **kwargs)
+        self.group = group
+        self.layer = layer or get_channel_layer()
+        self.seq = 0
+
+    @classmethod
+    def from_settings(cls, queue: EventChannel[tuple[int | None, dict]], settings: dict = EventBusSettings) -> Self:
+        return cls(queue, group=settings.get("GROUP", "celery_detect.events"))
+
+    async def handle_batch(self, events: list[tuple[int | None, dict]]) -> None:
+        self.seq += 1
+        message = {
+            "type": EVENTS_MESSAGE_TYPE,
+            "seq": self.seq,
+            "events": [event for _, event in events],
+            "journal_seqs": [journal_seq for journal_seq, _ in events],
+        }
+        try:
+            await self.layer.group_send(self.group, message)
+        except Exception as e:
+            logger.exception(f"Failed to publish {len(events)} events to the event bus: {e}")
+
+    async def handle_event(self, event: tuple[int | None, dict]) -> None:
+        await self.handle_batch([event])
+
+
+class EventBusReceiver:
+    """Applies the events published by the ingestion process to this replica's state.
+
+    Applied events are handed to ``queue``, just as the broker receiver does in a standalone
+    process, so the broadcaster and every index work the same on replicas. Batches lost by the
+    channel layer (e.g, when a replica falls behind its capacity) are detected from their
+    sequence numbers and counted as ``gaps``. Events journaled up to ``journal_seq``, which the
+    replica restored its state from, were already applied and are skipped.
+    """
+
+    def __init__(self, queue: EventChannel[AppliedEvent], group: str, layer: BaseChannelLayer | None = None):
+        self.queue = queue
+        self.group = group
+        self.layer = layer or get_channel_layer()
+        self.channel: str | None = None
+        self.last_seq: int | None = None
+        self.journal_seq = 0
+        self.received = 0
+        self.skipped = 0
+        self.gaps = 0
+        self._task: AioTask | None = None
+        self._renewal: AioTask | None = None
+
+    @classmethod
+    def from_settings(cls, queue: EventChannel[AppliedEvent], settings: dict = EventBusSettings) -> Self:
+        return cls(queue, group=settings.get("GROUP", "celery_detect.events"))
+
+    async def subscribe(self) -> None:
+        """Join the group. Batches published from now on are buffered by the layer until :meth:`start`."""
+        self.channel = await self.layer.new_channel()
+        await self.layer.group_add(self.group, self.channel)
+        logger.info(f"Subscribed to event bus group {self.group!r} as {self.channel!r}")
+
+    def start(self) -> None:
+        self._task = create_task(self._listen())
+        self._renewal = create_task(self._renew_membership())
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                message = await self.layer.receive(self.channel)
+            except CancelledError:
+                break
+            except Exception as e:
+                logger.exception(f"Failed to receive from the event bus: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message.get("type") != EVENTS_MESSAGE_TYPE:
+                continue
+            self.handle_message(message)
+
+    def handle_message(self, message: dict) -> None:
+        seq = message.get("seq")
+        if self.last_seq is not None and seq is not None and seq > self.last_seq + 1:
+            self.gaps += seq - self.last_seq - 1
+            logger.warning(f"Missed {seq - self.last_seq - 1} event batches from the event bus")
+        self.last_seq = seq
+
+        for event, journal_seq in zip(message["events"], message.get("journal_seqs") or repeat(None)):
+            self.received += 1
+            if journal_seq is not None and journal_seq <= self.journal_seq:
+                self.skipped += 1
+                continue
+            try:
+                trace = latency_tracer.start(event)
+                applied = apply_event(event, trace)
+                if trace is not None:
+                    trace.mark("ingest")
+                self.queue.put(applied)
+            except Exception as e:
+                logger.exception(f"Failed to apply event from the event bus: {e}")
+
+    async def _renew_membership(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(GROUP_RENEWAL_INTERVAL)
+                await self.layer.group_add(self.group, self.channel)
+            except CancelledError:
+                break
+            except Exception as e:
+                logger.exception(f"Failed to renew event bus group membership: {e}")
+
+    async def stop(self) -> None:
+        for task in (self._task, self._renewal):
+            if task is not None and not task.done():
+                task.cancel()
+        if self.channel is not None:
+            await self.layer.group_discard(self.group, self.channel)
@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
+from typing import NamedTuple
+
+
+class Changes(NamedTuple):
+    tasks: list[str]
+    workers: list[str]
+
+
+class ChangeLog:
+    """Latest state version each task and worker was changed, added or evicted at.
+
+    Entries are kept in version order, so the changes since a version are found by walking back
+    from the newest entry, in time proportional to their number. At most ``max_size`` entries are
+    kept; changes made before ``oldest`` may have been forgotten.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.oldest = 0
+        self._lock = threading.Lock()
+        self._changes: OrderedDict[tuple[str, str], int] = OrderedDict()
+
+    def record(self, version: int, uuids: Iterable[str | None] = (), hostnames: Iterable[str | None] = ()) -> None:
+        with self._lock:
+            changes = self._changes
+            for kind, keys in (("task", uuids), ("worker", hostnames)):
+                for key in keys:
+                    if key is None:
+                        continue
+                    changes[kind, key] = version
+                    changes.move_to_end((kind, key))
+            while len(changes) > self.max_size:
+                _, self.oldest = changes.popitem(last=False)
+
+    def since(self, version: int) -> Changes | None:
+        """Tasks and workers changed after ``version``, newest first, or None if they are not all known."""
+        changes = Changes(tasks=[], workers=[])
+        with self._lock:
+            if version < self.oldest:
+                return None
+            for (kind, key), changed in reversed(self._changes.items()):
+                if changed <= version:
+                    break
+                (changes.tasks if kind == "task" else changes.workers).append(key)
+        return changes
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Callable, Hashable, Iterable
+from enum import Enum
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop-oldest"
+    COALESCE = "coalesce"
+    BLOCK = "block"
+
+
+class ChannelStats(BaseModel):
+    depth: int = Field(description="Number of events waiting to be consumed")
+    max_size: int = Field(description="Maximum number of events buffered")
+    overflow: OverflowPolicy = Field(description="What happens when the buffer is full")
+    received: int = Field(description="Events put into the channel")
+    dropped: int = Field(description="Events dropped because the buffer was full")
+    coalesced: int = Field(description="Pending events replaced by a newer event for the same entity")
+    blocked: int = Field(description="Times the producer waited for free space")
+    wakeups: int = Field(description="Times the event loop was woken up by the producer")
+    batches: int = Field(description="Batches handed to the consumer")
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class EventChannel(Generic[T]):
+    """Bounded channel moving items from producer threads to an asyncio consumer in batches.
+
+    The producer never touches the event loop directly, except to schedule a single wakeup
+    through ``call_soon_threadsafe`` when the consumer is idle. After waking up, the consumer
+    lingers for ``batch_window`` seconds (or until ``batch_size`` items are pending) so that a
+    burst of events costs one loop wakeup instead of one per event.
+
+    Once ``max_size`` items are pending, ``overflow`` decides what happens to a new one: drop the
+    oldest pending item, wait for the consumer, or coalesce, i.e, replace the pending item with the
+    same ``key`` (dropping the oldest one if there is none). Below ``max_size`` every item is kept.
+    """
+
+    def __init__(
+            self,
+            max_size: int = 100_000,
+            overflow: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+            batch_size: int = 500,
+            batch_window: float = 0.005,
+            key: Callable[[T], Hashable | None] | None = None,
+    ):
+        if overflow == OverflowPolicy.COALESCE and key is None:
+            raise ValueError("Coalescing channel requires a key function")
+        self.max_size = max_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.key = key
+        self._items: deque[T] | OrderedDict[int, T] = (
+            OrderedDict() if overflow == OverflowPolicy.COALESCE else deque()
+        )
+        # When coalescing, the position of the latest pending item of each key
+        self._latest: dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._waiter: asyncio.Future | None = None
+        self._wake_threshold = 1
+        self._closed = False
+        self._positions = 0
+        self._received = self._dropped = self._coalesced = self._blocked = self._wakeups = self._batches = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, item: T) -> None:
+        """Add an item. Safe to call from any thread."""
+        with self._lock:
+            self._put(item)
+
+    def put_many(self, items: Iterable[T]) -> None:
+        """Add several items at once, e.g, a batch applied elsewhere. Safe to call from any thread."""
+        with self._lock:
+            for item in items:
+                if not self._put(item):
+                    break
+
+    def _put(self, item: T) -> bool:
+        """Add an item while holding the lock. Returns False once the channel is closed."""
+        if self._closed:
+            return False
+        self._received += 1
+        if self.overflow == OverflowPolicy.COALESCE:
+            self._put_coalesce(item)
+        else:
+            if len(self._items) >= self.max_size:
+                if self.overflow == OverflowPolicy.BLOCK:
+                    self._blocked += 1
+                    while len(self._items) >= self.max_size and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+                else:
+                    self._items.popleft()
+                    self._dropped += 1
+            self._items.append(item)
+
+        waiter = self._waiter
+        if waiter is not None and len(self._items) >= self._wake_threshold:
+            self._waiter = None
+            self._wakeups += 1
+            self._loop.call_soon_threadsafe(_wake, waiter)
+        return True
+
+    def _put_coalesce(self, item: T) -> None:
+        key = self.key(item)
+        if len(self._items) >= self.max_size:
+            position = self._latest.get(key) if key is not None else None
+            if position is not None and position in self._items:
+                self._coalesced += 1
+                del self._items[position]
+            else:
+                _, dropped = self._items.popitem(last=False)
+                self._dropped += 1
+                dropped_key = self.key(dropped)
+                if dropped_key is not None and self._latest.get(dropped_key) not in self._items:
+                    self._latest.pop(dropped_key, None)
+        self._positions += 1
+        self._items[self._positions] = item
+        if key is not None:
+            self._latest[key] = self._positions
+
+    async def get_batch(self) -> list[T]:
+        """Wait for pending items and return all of them, oldest first."""
+        await self._wait_for(1, timeout=None)
+        if self.batch_window > 0:
+            await self._wait_for(self.batch_size, timeout=self.batch_window)
+
+        with self._lock:
+            self._waiter = None
+            if self.overflow == OverflowPolicy.COALESCE:
+                batch = list(self._items.values())
+            else:
+                batch = list(self._items)
+            self._items.clear()
+            self._latest.clear()
+            self._not_full.notify_all()
+            if batch:
+                self._batches += 1
+            return batch
+
+    async def _wait_for(self, threshold: int, timeout: float | None) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if len(self._items) >= threshold or self._closed:
+                return
+            self._loop = loop
+            self._wake_threshold = threshold
+            waiter = self._waiter = loop.create_future()
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            with self._lock:
+                if self._waiter is waiter:
+                    self._waiter = None
+            waiter.cancel()
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            waiter, self._waiter = self._waiter, None
+            if waiter is not None:
+                self._loop.call_soon_threadsafe(_wake, waiter)
+
+    def stats(self) -> ChannelStats:
+        with self._lock:
+            return ChannelStats(
+                depth=len(self._items),
+                max_size=self.max_size,
+                overflow=self.overflow,
+                received=self._received,
+                dropped=self._dropped,
+                coalesced=self._coalesced,
+                blocked=self._blocked,
+                wakeups=self._wakeups,
+                batches=self._batches,
+            )
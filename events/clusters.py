@@ -0,0 +1,152 @@
+from collections.abc import Iterable, Iterator
+from typing import Self
+
+from celery.events.state import State, Task as CeleryTask, Worker as CeleryWorker
+
+from celery_detect.settings import (
+    CELERY_CHANGE_LOG_SIZE,
+    CELERY_CLUSTERS,
+    CELERY_DEFAULT_CLUSTER,
+    CELERY_MAX_TASKS,
+    CELERY_MAX_WORKERS,
+)
+from events.changelog import ChangeLog
+from events.conversion import ConvertedModel
+from events.journal import EventJournal
+from events.retention import RetentionEngine
+from events.snapshot import SnapshotManager, StateSnapshot, format_etag
+from events.store import create_state, stored_tasks
+from tasks.index import TaskIndex
+
+
+class UnknownClusterError(KeyError):
+    """Raised when a cluster id that is not configured is requested."""
+
+
+class Cluster:
+    """A monitored Celery cluster, with a state, versions, task index and retention of its own.
+
+    Clusters share nothing that is locked for the duration of an event, so the consumers of
+    several clusters apply their events side by side.
+    """
+
+    def __init__(self, id: str, max_tasks: int = CELERY_MAX_TASKS, max_workers: int = CELERY_MAX_WORKERS):
+        self.id = id
+        self.state: State = create_state(max_tasks_in_memory=max_tasks, max_workers_in_memory=max_workers)
+        # Tasks reach their cluster through the state they belong to (task.cluster_state.cluster)
+        self.state.cluster = id
+        self.snapshots = SnapshotManager(self.state, changes=ChangeLog(CELERY_CHANGE_LOG_SIZE))
+        self.index = TaskIndex(max_tasks=max_tasks)
+        self.retention = RetentionEngine.from_settings(
+            contains=lambda uuid: uuid in self.state.tasks.data,
+            size=lambda: len(self.state.tasks.data),
+        )
+
+    def clear(self, ready: bool = True, journal: EventJournal | None = None) -> None:
+        """Forget the cluster's workers and tasks, only the finished ones if ``ready``, and re-track the rest.
+
+        The clear is recorded in ``journal`` if the cluster's events are journaled, under the snapshot lock
+        its events are appended and applied with, so replaying the journal clears the state at the same point.
+        """
+        with self.snapshots.changing(list(self.state.tasks.data), list(self.state.workers.data)):
+            if journal is not None:
+                journal.record_clear(ready)
+            self.state.clear(ready=ready)
+            tasks = stored_tasks(self.state)
+            self.retention.rebuild(tasks)
+            # Replaced by a new index rather than rebuilt in place, so the queries running meanwhile are
+            # answered from the old one
+            self.index = TaskIndex.from_tasks(tasks, max_tasks=self.index.max_tasks)
+
+    def __repr__(self) -> str:
+        return f"Cluster({self.id!r})"
+
+
+def task_cluster(task: CeleryTask) -> str | None:
+    return getattr(task.cluster_state, "cluster", None)
+
+
+class MergedSnapshot:
+    """Snapshots of several clusters, read as one.
+
+    Versions are per cluster, so there is no version to compute changes from: ``version`` is
+    None and the ETag combines the versions of every cluster.
+    """
+
+    version = None
+
+    def __init__(self, snapshots: dict[str, StateSnapshot]):
+        self.snapshots = snapshots
+        self.etag = format_etag("-".join(str(snapshot.version) for snapshot in snapshots.values()))
+
+    def get_task(self, uuid: str) -> CeleryTask | None:
+        return self.get_tasks((uuid,))[0]
+
+    def get_tasks(self, uuids: Iterable[str]) -> list[CeleryTask | None]:
+        tasks: list[CeleryTask | None] = [None] * len(uuids := list(uuids))
+        for snapshot in self.snapshots.values():
+            missing = [position for position, task in enumerate(tasks) if task is None]
+            if not missing:
+                break
+            for position, task in zip(missing, snapshot.get_tasks([uuids[position] for position in missing])):
+                tasks[position] = task
+        return tasks
+
+    def iter_tasks(self, chunk_size: int = 1000) -> Iterator[list[CeleryTask]]:
+        for snapshot in self.snapshots.values():
+            yield from snapshot.iter_tasks(chunk_size)
+
+    def cluster_workers(self) -> Iterator[tuple[str, CeleryWorker]]:
+        for cluster, snapshot in self.snapshots.items():
+            for worker in snapshot.workers():
+                yield cluster, worker
+
+    def convert_task(self, task: CeleryTask) -> ConvertedModel:
+        return self.snapshots[task_cluster(task)].convert_task(task)
+
+    def convert_worker(self, worker: CeleryWorker, cluster: str | None = None) -> ConvertedModel:
+        return self.snapshots[cluster].convert_worker(worker)
+
+
+class ClusterRegistry:
+    """The clusters monitored by this instance, by id."""
+
+    def __init__(self, ids: Iterable[str], default: str):
+        self.clusters = {id: Cluster(id) for id in dict.fromkeys([default, *ids])}
+        self.default = self.clusters[default]
+
+    @classmethod
+    def from_settings(cls, clusters: dict = CELERY_CLUSTERS, default: str = CELERY_DEFAULT_CLUSTER) -> Self:
+        return cls(clusters, default)
+
+    def __iter__(self) -> Iterator[Cluster]:
+        return iter(self.clusters.values())
+
+    def __len__(self) -> int:
+        return len(self.clusters)
+
+    def get(self, id: str | None) -> Cluster:
+        """The cluster an event was tagged with, the default one for untagged events."""
+        if id is None:
+            return self.default
+        try:
+            return self.clusters[id]
+        except KeyError:
+            raise UnknownClusterError(f"Unknown cluster {id!r}") from None
+
+    def select(self, id: str | None = None) -> list[Cluster]:
+        """The requested cluster, or every cluster."""
+        return [self.get(id)] if id else list(self)
+
+    def snapshot(self, id: str | None = None) -> StateSnapshot | MergedSnapshot:
+        """Snapshot of the requested cluster, or a merged one of every cluster."""
+        selected = self.select(id)
+        if len(selected) == 1:
+            return selected[0].snapshots.snapshot()
+        return MergedSnapshot({cluster.id: cluster.snapshots.snapshot() for cluster in selected})
+
+    def etag(self, id: str | None = None) -> str:
+        return format_etag("-".join(str(cluster.snapshots.version) for cluster in self.select(id)))
+
+
+clusters = ClusterRegistry.from_settings()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from asyncio import CancelledError, Task as AioTask, create_task
+from collections import defaultdict
+
+from celery.events.state import Worker as CeleryWorker
+
+from events.clusters import clusters
+from events.models import AppliedEvent, EventType, WorkersChangedMessage
+from ws.encoding import Payload
+from ws.managers import events_manager
+from ws.subscriptions import EventAttributes
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatCoalescer:
+    """Merges worker heartbeats within a time window into one ``workers-changed`` message per tick.
+
+    Only the latest state of each worker is kept, and workers are converted and encoded once per
+    tick no matter how many heartbeats they sent in the meantime.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        # (cluster, hostname) -> latest worker state, with the version of the cluster's state it is a copy of
+        self._pending: dict[tuple[str | None, str], tuple[CeleryWorker, int | None]] = {}
+        self._task: AioTask | None = None
+
+    def add(self, event: AppliedEvent) -> None:
+        if not events_manager.has_subscribers or event.entity is None:
+            return
+        self._pending[event.event.get("cluster"), event.entity.hostname] = event.entity, event.version
+
+    def discard(self, hostname: str, cluster: str | None = None) -> None:
+        """Forget a pending heartbeat, e.g, because a newer online/offline event was sent right away."""
+        self._pending.pop((cluster, hostname), None)
+
+    def start(self) -> None:
+        self._task = create_task(self._tick())
+
+    async def _tick(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(self.window)
+            except CancelledError:
+                break
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to broadcast coalesced heartbeats: {e}")
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        if not events_manager.has_subscribers:
+            return
+
+        if events_manager.subscriptions.unconstrained:
+            message = WorkersChangedMessage(data=[
+                clusters.get(cluster).snapshots.models.worker(*pending[cluster, hostname]).model
+                for cluster, hostname in pending
+            ])
+            logger.debug(f"Broadcasting {len(message.data)} coalesced worker heartbeats")
+            events_manager.send(events_manager.route(), Payload(message))
+            return
+
+        # Some clients filter by worker or event type: send each one only the workers it subscribed to,
+        # sharing one message between clients that match the same set of workers.
+        keys_by_sender = defaultdict(list)
+        for key in pending:
+            cluster, hostname = key
+            attributes = EventAttributes(
+                category="worker", type=EventType.WORKER_HEARTBEAT.value, worker=hostname, cluster=cluster,
+            )
+            for sender in events_manager.route(attributes):
+                keys_by_sender[sender].append(key)
+
+        senders_by_keys = defaultdict(list)
+        for sender, keys in keys_by_sender.items():
+            senders_by_keys[tuple(keys)].append(sender)
+
+        workers = {}
+        for keys, senders in senders_by_keys.items():
+            for key in keys:
+                if key not in workers:
+                    workers[key] = clusters.get(key[0]).snapshots.models.worker(*pending[key]).model
+            message = WorkersChangedMessage(data=[workers[key] for key in keys])
+            events_manager.send(senders, Payload(message))
+
+    def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
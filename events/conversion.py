@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from typing import Self
+
+from celery.events.state import State, Task as CeleryTask, Worker as CeleryWorker
+from pydantic import BaseModel
+from pydantic_core import to_json
+
+from celery_detect.settings import ConversionCacheSettings
+from tasks.models import Task
+from workers.models import Worker
+
+
+class ConvertedModel:
+    """API model of a task or worker as of ``version``, with its JSON encoding made on first use."""
+
+    __slots__ = ("model", "version", "_json")
+
+    def __init__(self, model: BaseModel, version: int):
+        self.model = model
+        self.version = version
+        self._json: bytes | None = None
+
+    @property
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = to_json(self.model)
+        return self._json
+
+
+class ConversionCache:
+    """API models of a state's tasks and workers, converted once per version of each of them.
+
+    The snapshot manager calls :meth:`invalidate` with the tasks and workers every change touches,
+    recording the version they last changed at, so entries are dropped as soon as new events arrive
+    or their task or worker is evicted. Records read from a snapshot older than their last change are
+    converted without caching, and the ``max_entries`` least recently read models are kept.
+    """
+
+    def __init__(self, state: State, max_entries: int):
+        self.state = state
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, str], ConvertedModel] = OrderedDict()
+        # Version each task and worker last changed at, those unchanged since the start have none
+        self._versions: dict[tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, state: State, settings: dict = ConversionCacheSettings) -> Self:
+        return cls(state, max_entries=settings.get("MAX_ENTRIES", 10000))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def task(self, task: CeleryTask, version: int | None = None) -> ConvertedModel:
+        """Model of a task as of ``version`` (read from a snapshot or copied), or of the live task if None."""
+        return self._get(("task", task.uuid), task, version, self.state.tasks.data, Task.from_celery_task)
+
+    def worker(self, worker: CeleryWorker, version: int | None = None) -> ConvertedModel:
+        return self._get(
+            ("worker", worker.hostname), worker, version, self.state.workers.data,
+            lambda record: Worker.from_celery_worker(record, cluster=getattr(self.state, "cluster", None)),
+        )
+
+    def _get(self, key: tuple[str, str], record, version: int | None, live: dict, convert: Callable) -> ConvertedModel:
+        with self._lock:
+            changed = self._versions.get(key, 0 if key[1] in live else None)
+            # Evicted records, and records read from a snapshot taken before their last change, are not cached
+            cacheable = self.max_entries > 0 and changed is not None and (version is None or changed <= version)
+            if cacheable:
+                entry = self._entries.get(key)
+                if entry is not None and entry.version == changed:
+                    self._entries.move_to_end(key)
+                    return entry
+
+        converted = ConvertedModel(convert(record), changed or 0)
+        if cacheable:
+            with self._lock:
+                # Unless the record changed meanwhile, when the entry would never be read
+                if self._versions.get(key, 0) == changed and key[1] in live:
+                    self._entries[key] = converted
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        return converted
+
+    def invalidate(self, version: int, uuids: Iterable[str | None], hostnames: Iterable[str | None]) -> None:
+        """Drop the models of tasks and workers changed at ``version``, after the change was applied."""
+        with self._lock:
+            for category, ids, live in (
+                    ("task", uuids, self.state.tasks.data),
+                    ("worker", hostnames, self.state.workers.data),
+            ):
+                for id in ids:
+                    if id is None:
+                        continue
+                    key = (category, id)
+                    self._entries.pop(key, None)
+                    if id in live:
+                        self._versions[key] = version
+                    else:
+                        self._versions.pop(key, None)
@@ -4,3 +4,7 @@ class InvalidEventError(ValueError):
 
 class InconsistentStateStoreError(KeyError):
     pass
+
+
+class ShardUnavailableError(TimeoutError):
+    pass
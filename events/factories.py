@@ -1,3 +1,8 @@
+import random
+import time
+from collections.abc import Iterator
+from uuid import UUID
+
 from polyfactory.factories.pydantic_factory import ModelFactory
 
 from events.models import EventMessage
@@ -7,3 +12,109 @@ from tasks.factories import TaskFactory
 class EventMessageFactory(ModelFactory[EventMessage]):
     __model__ = EventMessage
     data = TaskFactory
+
+
+#: Task graph mirroring the workflow in ``test_project/app.py``.
+WORKFLOW = {
+    "test_project.app.order_workflow": ("test_project.app.update_inventory", "test_project.app.create_invoice"),
+    "test_project.app.update_inventory": ("test_project.app.create_shipment",),
+    "test_project.app.create_shipment": (
+        "test_project.app.generate_sales_report",
+        "test_project.app.notify_user",
+    ),
+}
+WORKFLOW_ROOT = "test_project.app.order_workflow"
+
+
+class SyntheticCluster:
+    """Generates realistic Celery event sequences without a broker.
+
+    Every workflow publishes the task tree of ``test_project/app.py``; each task goes through
+    sent -> received -> started -> succeeded/failed on a random worker, and workers heartbeat
+    as the clock advances.
+    """
+
+    def __init__(
+            self,
+            workers: int = 8,
+            failure_rate: float = 0.05,
+            heartbeat_interval: float = 2.0,
+            seed: int | None = None,
+            start: float | None = None,
+    ):
+        self.random = random.Random(seed)
+        self.workers = [f"celery@worker-{i}" for i in range(workers)]
+        self.failure_rate = failure_rate
+        self.heartbeat_interval = heartbeat_interval
+        self.now = start or time.time()
+        self.clock = 0
+        self._processed = dict.fromkeys(self.workers, 0)
+        self._next_heartbeat = self.now
+
+    def events(self, workflows: int) -> Iterator[dict]:
+        yield from self._online()
+        for _ in range(workflows):
+            yield from self._workflow()
+
+    def _event(self, type_: str, **fields) -> dict:
+        self.clock += 1
+        self.now += self.random.uniform(0.0001, 0.002)
+        return dict(fields, type=type_, timestamp=self.now, local_received=self.now, clock=self.clock)
+
+    def _uuid(self) -> str:
+        return str(UUID(int=self.random.getrandbits(128), version=4))
+
+    def _worker_fields(self, hostname: str) -> dict:
+        return dict(
+            hostname=hostname,
+            pid=1000 + self.workers.index(hostname),
+            freq=self.heartbeat_interval,
+            sw_ident="py-celery",
+            sw_ver="5.4.0",
+            sw_sys="Linux",
+            active=self.random.randint(0, 4),
+            processed=self._processed[hostname],
+            loadavg=[round(self.random.uniform(0, 4), 2) for _ in range(3)],
+        )
+
+    def _online(self) -> Iterator[dict]:
+        for hostname in self.workers:
+            yield self._event("worker-online", **self._worker_fields(hostname))
+
+    def _heartbeats(self) -> Iterator[dict]:
+        if self.now < self._next_heartbeat:
+            return
+        self._next_heartbeat = self.now + self.heartbeat_interval
+        for hostname in self.workers:
+            yield self._event("worker-heartbeat", **self._worker_fields(hostname))
+
+    def _workflow(self) -> Iterator[dict]:
+        root_id = self._uuid()
+        pending = [(WORKFLOW_ROOT, root_id, None)]
+        while pending:
+            name, task_id, parent_id = pending.pop(0)
+            yield from self._task(name, task_id, root_id, parent_id)
+            pending.extend((child, self._uuid(), task_id) for child in WORKFLOW.get(name, ()))
+            yield from self._heartbeats()
+
+    def _task(self, name: str, task_id: str, root_id: str, parent_id: str | None) -> Iterator[dict]:
+        hostname = self.random.choice(self.workers)
+        common = dict(uuid=task_id, root_id=root_id, parent_id=parent_id)
+        yield self._event(
+            "task-sent", **common, hostname="client@web-1", name=name, args="()", kwargs="{}",
+            retries=0, eta=None, expires=None, queue="celery", exchange="", routing_key="celery",
+        )
+        yield self._event(
+            "task-received", **common, hostname=hostname, name=name, args="()", kwargs="{}",
+            retries=0, eta=None, expires=None,
+        )
+        yield self._event("task-started", **common, hostname=hostname, pid=1000)
+        runtime = self.random.uniform(0.001, 0.5)
+        self._processed[hostname] += 1
+        if self.random.random() < self.failure_rate:
+            yield self._event(
+                "task-failed", **common, hostname=hostname, exception="ValueError('synthetic failure')",
+                traceback='Traceback (most recent call last):\n  File "app.py", line 1\nValueError',
+            )
+        else:
+            yield self._event("task-succeeded", **common, hostname=hostname, result="None", runtime=runtime)
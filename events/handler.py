@@ -3,13 +3,36 @@ import os
 import time
 from asyncio import CancelledError
 from django.conf import settings
-from events.receiver import CeleryEventReceiver
-from events.broadcaster import EventBroadcaster
+from django.core.exceptions import ImproperlyConfigured
+from celery_detect.settings import (
+    CELERY_DETECT_ROLE,
+    CELERY_EVENT_BATCH_SIZE,
+    CELERY_EVENT_BATCH_WINDOW,
+    CELERY_EVENT_QUEUE_SIZE,
+)
+from events.bus import EventBusPublisher, EventBusReceiver
+from events.channel import EventChannel
+from events.clusters import clusters
+from events.journal import event_journal
+from events.receiver import CeleryEventReceiver, RetentionSweeper, event_queue, event_queues, restore_state
+from events.broadcaster import EventBroadcaster, ShardedEventBroadcaster
+from events.sharding import shard_pool, sharded_event_queue
+from events.poller import worker_poller
+from history.archive import task_archive
 from celery_detect.celery_app import get_celery_app
 import logging
 
 logger = logging.getLogger(__name__)
 
+#: Values of CELERY_DETECT_ROLE.
+ROLES = ("standalone", "ingest", "replica")
+
+
+def check_role(role: str = CELERY_DETECT_ROLE) -> None:
+    if role not in ROLES:
+        raise ImproperlyConfigured(f"CELERY_DETECT_ROLE must be one of {', '.join(ROLES)}, not {role!r}")
+
+
 def startup_handler():
     logger.info("Welcome to Celery Insights!")
     # Update timezone
@@ -18,22 +41,156 @@ def startup_handler():
     asyncio.run(start_event_system())
 
 async def start_event_system():
-    # Start consuming events
-    celery_app = get_celery_app()
-    event_consumer = CeleryEventReceiver(celery_app)
+    if CELERY_DETECT_ROLE == "replica":
+        await run_replica()
+    else:
+        await run_ingest(publish=CELERY_DETECT_ROLE == "ingest")
+
+
+async def run_ingest(publish: bool):
+    if shard_pool is not None:
+        await run_sharded_ingest()
+        return
+
+    # Rebuild state from the event journal, if enabled
+    if event_journal is not None:
+        await asyncio.to_thread(restore_state, event_journal)
+        event_journal.start()
+
+    # Start archiving task snapshots to the database, if enabled
+    if task_archive is not None:
+        task_archive.start()
+
+    # Publish received events to the replicas
+    publisher = None
+    if publish:
+        publisher = EventBusPublisher.from_settings(EventChannel(
+            max_size=CELERY_EVENT_QUEUE_SIZE,
+            batch_size=CELERY_EVENT_BATCH_SIZE,
+            batch_window=CELERY_EVENT_BATCH_WINDOW,
+        ))
+        publisher.start()
+
+    # Start consuming events, with one consumer and hand-off queue per cluster. Only the default cluster is journaled.
+    event_consumers = [
+        CeleryEventReceiver(
+            get_celery_app(cluster.id),
+            queue=event_queues[cluster.id],
+            journal=event_journal if cluster is clusters.default else None,
+            bus=publisher.queue if publisher is not None else None,
+            cluster=cluster.id,
+        )
+        for cluster in clusters
+    ]
+    for event_consumer in event_consumers:
+        event_consumer.start()
+
+    # Evict the tasks whose TTL ran out while no events arrived, if enabled
+    sweeper = RetentionSweeper.from_settings()
+    if sweeper is not None:
+        sweeper.start()
+
+    # Start broadcasting events, from the queue of every cluster
+    listeners = [
+        EventBroadcaster(queue, name=f"{EventBroadcaster.__name__}[{cluster}]")
+        for cluster, queue in event_queues.items()
+    ]
+    for listener in listeners:
+        listener.start()
+
+    # Start polling worker details for ws/workers, if enabled
+    if worker_poller is not None:
+        worker_poller.start()
+
+    try:
+        await run_forever()
+    finally:
+        for event_consumer in event_consumers:
+            event_consumer.stop()
+        if sweeper is not None:
+            sweeper.stop()
+        if publisher is not None:
+            publisher.stop()
+        for listener in listeners:
+            listener.stop()
+        if worker_poller is not None:
+            worker_poller.stop()
+        if event_journal is not None:
+            event_journal.close()
+        if task_archive is not None:
+            task_archive.stop()
+        logger.info("Goodbye! See you soon.")
+
+
+async def run_sharded_ingest():
+    """Consume the default cluster's events into the state shards, broadcasting what they apply."""
+    shard_pool.start()
+    event_consumer = CeleryEventReceiver(get_celery_app(), journal=None, shards=shard_pool)
     event_consumer.start()
 
-    # Start broadcasting events
-    listener = EventBroadcaster(event_consumer.queue)
+    sweeper = RetentionSweeper.from_settings(journal=None, shards=shard_pool)
+    if sweeper is not None:
+        sweeper.start()
+
+    listener = ShardedEventBroadcaster(sharded_event_queue)
     listener.start()
 
+    if worker_poller is not None:
+        worker_poller.start()
+
     try:
-        # Let the system run indefinitely until stopped
-        while True:
-            await asyncio.sleep(0.1)  # Sleep for 1 hour (or adjust as needed)
-    except (KeyboardInterrupt, SystemExit, CancelledError):
-        logger.info("Stopping server...")
+        await run_forever()
     finally:
         event_consumer.stop()
+        if sweeper is not None:
+            sweeper.stop()
+        shard_pool.stop()
+        sharded_event_queue.close()
+        listener.stop()
+        if worker_poller is not None:
+            worker_poller.stop()
+        logger.info("Goodbye! See you soon.")
+
+
+async def run_replica():
+    # Join the event bus first, so that nothing published while the state is restored is lost
+    bus_receiver = EventBusReceiver.from_settings(event_queue)
+    await bus_receiver.subscribe()
+
+    # Start from the ingest process' journal if it is shared with this replica. Replicas only read it.
+    if event_journal is not None:
+        await asyncio.to_thread(restore_state, event_journal)
+        bus_receiver.journal_seq = event_journal.seq
+    bus_receiver.start()
+
+    # Replicas only read the journal
+    sweeper = RetentionSweeper.from_settings(journal=None)
+    if sweeper is not None:
+        sweeper.start()
+
+    listener = EventBroadcaster(event_queue)
+    listener.start()
+
+    if worker_poller is not None:
+        worker_poller.start()
+
+    try:
+        await run_forever()
+    finally:
+        await bus_receiver.stop()
+        if sweeper is not None:
+            sweeper.stop()
+        event_queue.close()
         listener.stop()
+        if worker_poller is not None:
+            worker_poller.stop()
         logger.info("Goodbye! See you soon.")
+
+
+async def run_forever():
+    try:
+        # Let the system run indefinitely until stopped
+        while True:
+            await asyncio.sleep(0.1)
+    except (KeyboardInterrupt, SystemExit, CancelledError):
+        logger.info("Stopping server...")
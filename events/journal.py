@@ -0,0 +1,325 @@
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Self
+
+from celery.events.state import State
+
+from celery_detect.settings import EventJournalSettings
+from events.snapshot import SnapshotManager, StateSnapshot
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+SNAPSHOT_PREFIX = "snapshot-"
+SNAPSHOT_SUFFIX = ".pickle"
+SNAPSHOTS_KEPT = 2
+#: Journal record marking that the state was cleared, so replay clears it at the same point.
+CLEAR_EVENT_TYPE = "celery_detect-clear"
+#: Journal record of the tasks evicted by the retention policy, which replaying the events alone would bring back.
+EVICT_EVENT_TYPE = "celery_detect-evict"
+
+
+def _seq_from_name(path: Path, prefix: str, suffix: str) -> int:
+    return int(path.name[len(prefix):-len(suffix)])
+
+
+def replace_state(target: State, source: State) -> None:
+    """Swap the contents of an unpickled ``source`` into ``target``, which other modules hold a reference to."""
+    with target._mutex:
+        mutex = target._mutex
+        target.__dict__.update(source.__dict__)
+        target._mutex = mutex
+        # The cached event dispatcher closes over the previous task and worker containers
+        target.__dict__.pop("_event", None)
+
+        # Pickled tasks lose their links to the state, their children and the shared worker objects
+        tasks, workers = target.tasks.data, target.workers.data
+        for task in tasks.values():
+            task.cluster_state = target
+            if task.worker is not None:
+                task.worker = workers.get(task.worker.hostname, task.worker)
+        for task in tasks.values():
+            parent = tasks.get(task.parent_id) if task.parent_id else None
+            if parent is not None:
+                parent.children.add(task)
+
+
+def freeze(view: StateSnapshot, like: State) -> State:
+    """New state holding copies of the records of a snapshot view, with the limits of the ``like`` state."""
+    frozen = type(like)(max_tasks_in_memory=like.max_tasks_in_memory, max_workers_in_memory=like.max_workers_in_memory)
+    for worker in view.workers():
+        frozen.workers[worker.hostname] = worker
+    workers = frozen.workers.data
+    for tasks in view.iter_tasks():
+        for task in tasks:
+            # Copied tasks still refer to the live workers
+            if task.worker is not None:
+                task.worker = workers.get(task.worker.hostname, task.worker)
+            frozen.tasks[task.uuid] = task
+    return frozen
+
+
+class EventJournal:
+    """Segmented, append-only log of the raw events applied to the state.
+
+    Events are written as compact JSON lines to segment files named after the sequence number
+    of their first event, and fsync'ed in batches by a background thread. Every
+    ``snapshot_interval`` events the whole state is pickled by another background thread, from a
+    :class:`StateSnapshot` view so ingestion carries on meanwhile, and a cold start only has to replay
+    the events recorded after the latest snapshot. Old segments and snapshots are removed by age and
+    by total size, except for the segments recorded after the latest snapshot: when those exceed the
+    limits, a snapshot is taken early instead.
+    """
+
+    def __init__(
+            self,
+            path: str | Path,
+            segment_size: int = 64 * 1024 * 1024,
+            fsync_interval: float = 1.0,
+            snapshot_interval: int = 100_000,
+            max_age: float | None = 7 * 24 * 3600,
+            max_size: int | None = 1024 * 1024 * 1024,
+    ):
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.max_age = max_age
+        self.max_size = max_size
+        self.seq = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment_bytes = 0
+        self._dirty = False
+        self._last_snapshot_seq = 0
+        self._snapshot_due = False
+        self._snapshotter: threading.Thread | None = None
+        self._stop_signal = threading.Event()
+        self._flusher: threading.Thread | None = None
+        self._encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+
+    @classmethod
+    def from_settings(cls, settings: dict = EventJournalSettings) -> Self | None:
+        if not settings.get("PATH"):
+            return None
+        return cls(
+            path=settings["PATH"],
+            segment_size=settings.get("SEGMENT_SIZE", 64 * 1024 * 1024),
+            fsync_interval=settings.get("FSYNC_INTERVAL", 1.0),
+            snapshot_interval=settings.get("SNAPSHOT_INTERVAL", 100_000),
+            max_age=settings.get("MAX_AGE"),
+            max_size=settings.get("MAX_SIZE"),
+        )
+
+    def segments(self) -> list[Path]:
+        return sorted(
+            self.path.glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"),
+            key=lambda path: _seq_from_name(path, SEGMENT_PREFIX, SEGMENT_SUFFIX),
+        )
+
+    def snapshots(self) -> list[Path]:
+        return sorted(
+            self.path.glob(f"{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}"),
+            key=lambda path: _seq_from_name(path, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX),
+        )
+
+    def restore(self, state: State) -> int:
+        """Rebuild ``state`` from the latest snapshot and the events recorded after it.
+
+        Returns the number of events replayed.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        started = time.monotonic()
+        start_seq = 0
+        for snapshot in reversed(self.snapshots()):
+            try:
+                with snapshot.open("rb") as f:
+                    restored = pickle.load(f)
+            except Exception as e:
+                logger.exception(f"Failed to load state snapshot {snapshot}: {e}")
+                continue
+            replace_state(state, restored)
+            start_seq = _seq_from_name(snapshot, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+            logger.info(f"Loaded state snapshot {snapshot.name} with {len(state.tasks)} tasks")
+            break
+
+        replayed = 0
+        seq = start_seq
+        for seq, event in self._read(start_seq):
+            if event.get("type") == CLEAR_EVENT_TYPE:
+                state.clear(ready=event.get("ready", True))
+            elif event.get("type") == EVICT_EVENT_TYPE:
+                for uuid in event.get("uuids", ()):
+                    state.tasks.pop(uuid, None)
+            else:
+                state.event(event)
+            replayed += 1
+
+        self.seq = max(seq, start_seq)
+        self._last_snapshot_seq = start_seq
+        logger.info(f"Replayed {replayed} journal events in {time.monotonic() - started:.2f}s")
+        return replayed
+
+    def _read(self, start_seq: int) -> Iterator[tuple[int, dict]]:
+        """Yield ``(seq, event)`` for every recorded event with seq > ``start_seq``."""
+        segments = self.segments()
+        for i, segment in enumerate(segments):
+            next_first = (
+                _seq_from_name(segments[i + 1], SEGMENT_PREFIX, SEGMENT_SUFFIX) if i + 1 < len(segments) else None
+            )
+            if next_first is not None and next_first <= start_seq + 1:
+                continue
+            seq = _seq_from_name(segment, SEGMENT_PREFIX, SEGMENT_SUFFIX) - 1
+            with segment.open("rb") as f:
+                for line in f:
+                    seq += 1
+                    if seq <= start_seq:
+                        continue
+                    try:
+                        yield seq, json.loads(line)
+                    except ValueError:
+                        # Torn write at the tail of the last segment
+                        logger.warning(f"Skipping corrupt journal record {seq} in {segment.name}")
+
+    def start(self) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._flusher = threading.Thread(target=self._flush_periodically, name="EventJournalFlusher", daemon=True)
+        self._flusher.start()
+
+    def append(self, event: dict) -> int:
+        """Record an event, returning its sequence number."""
+        record = self._encode(event).encode("utf-8") + b"\n"
+        with self._lock:
+            self.seq += 1
+            if self._file is None or self._segment_bytes >= self.segment_size:
+                self._rotate()
+            self._file.write(record)
+            self._segment_bytes += len(record)
+            self._dirty = True
+            return self.seq
+
+    def record_clear(self, ready: bool) -> None:
+        self.append({"type": CLEAR_EVENT_TYPE, "ready": ready})
+
+    def record_evictions(self, uuids: list[str]) -> None:
+        self.append({"type": EVICT_EVENT_TYPE, "uuids": uuids})
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+        segment = self.path / f"{SEGMENT_PREFIX}{self.seq:020d}{SEGMENT_SUFFIX}"
+        self._file = segment.open("ab", buffering=1024 * 1024)
+        self._segment_bytes = 0
+        self._enforce_retention()
+
+    def _sync(self) -> None:
+        if self._file is not None and self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def flush(self) -> None:
+        with self._lock:
+            self._sync()
+
+    def _flush_periodically(self) -> None:
+        while not self._stop_signal.wait(self.fsync_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to flush event journal: {e}")
+
+    def maybe_snapshot(self, snapshots: SnapshotManager) -> None:
+        """Snapshot the state in the background if enough events were recorded since the last snapshot,
+        or if the segments recorded since then exceed the retention limits.
+
+        Must be called from the ingestion thread, after the last appended event was applied.
+        """
+        if self.seq - self._last_snapshot_seq < self.snapshot_interval and not self._snapshot_due:
+            return
+        if self._snapshotter is not None and self._snapshotter.is_alive():
+            return
+        self._snapshot_due = False
+        # A clear may be recorded by another thread in the meantime: reading the seq first replays it again
+        # over the view in that case, which clears nothing more
+        seq = self.seq
+        # Taking the view is O(1), the records are copied and pickled on the snapshotter thread
+        self._snapshotter = threading.Thread(
+            target=self._snapshot_view, args=(snapshots.snapshot(), snapshots.state, seq),
+            name="EventJournalSnapshotter", daemon=True,
+        )
+        self._snapshotter.start()
+
+    def _snapshot_view(self, view: StateSnapshot, like: State, seq: int) -> None:
+        try:
+            self.snapshot(freeze(view, like), seq)
+        except Exception as e:
+            logger.exception(f"Failed to save state snapshot: {e}")
+
+    def snapshot(self, state: State, seq: int | None = None) -> Path:
+        """Pickle ``state`` as of the event ``seq``, the last one appended by default."""
+        seq = self.seq if seq is None else seq
+        self.flush()
+        started = time.monotonic()
+        data = state.freeze_while(pickle.dumps, state, protocol=pickle.HIGHEST_PROTOCOL)
+        path = self.path / f"{SNAPSHOT_PREFIX}{seq:020d}{SNAPSHOT_SUFFIX}"
+        temporary = path.with_suffix(".tmp")
+        with temporary.open("wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        temporary.replace(path)
+        self._last_snapshot_seq = seq
+        logger.info(f"Saved state snapshot {path.name} ({len(data)} bytes) in {time.monotonic() - started:.2f}s")
+
+        for old in self.snapshots()[:-SNAPSHOTS_KEPT]:
+            old.unlink(missing_ok=True)
+        with self._lock:
+            self._enforce_retention()
+        return path
+
+    def _enforce_retention(self) -> None:
+        """Delete the oldest closed segments exceeding the age or size limits.
+
+        Segments holding events recorded after the latest snapshot are needed to restore the state, so
+        they are kept, and a snapshot is requested instead.
+        """
+        all_segments = self.segments()
+        segments = all_segments[:-1]  # never the one being written
+        if not segments:
+            return
+        now = time.time()
+        total = sum(segment.stat().st_size for segment in all_segments)
+        for segment, following in zip(segments, all_segments[1:]):
+            stat = segment.stat()
+            too_old = self.max_age is not None and now - stat.st_mtime > self.max_age
+            too_big = self.max_size is not None and total > self.max_size
+            if not (too_old or too_big):
+                break
+            if _seq_from_name(following, SEGMENT_PREFIX, SEGMENT_SUFFIX) - 1 > self._last_snapshot_seq:
+                self._snapshot_due = True
+                break
+            logger.info(f"Removing journal segment {segment.name}")
+            segment.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def close(self) -> None:
+        self._stop_signal.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+event_journal = EventJournal.from_settings()
@@ -2,11 +2,14 @@ from django.db import models
 
 # Create your models here.
 from enum import Enum
+from typing import NamedTuple
 
+from celery.events.state import Task as CeleryTask, Worker as CeleryWorker
 from pydantic import BaseModel
 
+from metrics.tracing import EventTrace
 from tasks.models import Task
-from workers.models import Worker
+from workers.models import QueueInfo, ScheduledTask, Stats, TaskRequest, Worker
 
 
 class EventType(str, Enum):
@@ -21,6 +24,7 @@ class EventType(str, Enum):
     WORKER_ONLINE = "worker-online"
     WORKER_HEARTBEAT = "worker-heartbeat"
     WORKER_OFFLINE = "worker-offline"
+    WORKERS_CHANGED = "workers-changed"
 
 
 class EventCategory(str, Enum):
@@ -32,3 +36,44 @@ class EventMessage(BaseModel):
     type: EventType
     category: EventCategory
     data: Task | Worker
+
+
+class WorkersChangedMessage(BaseModel):
+    """Latest state of the workers that sent heartbeats during the last coalescing window."""
+    type: EventType = EventType.WORKERS_CHANGED
+    category: EventCategory = EventCategory.WORKER
+    data: list[Worker]
+
+
+class WorkerDetailsType(str, Enum):
+    STATS = "worker-stats"
+    ACTIVE = "worker-active"
+    RESERVED = "worker-reserved"
+    SCHEDULED = "worker-scheduled"
+    QUEUES = "worker-queues"
+
+
+class WorkerDetailsMessage(BaseModel):
+    """Inspect reply of a worker that changed since the previous poll. ``data`` is None once the worker stops replying."""
+    type: WorkerDetailsType
+    category: EventCategory = EventCategory.WORKER
+    hostname: str
+    cluster: str | None = None
+    data: Stats | list[TaskRequest] | list[ScheduledTask] | list[QueueInfo] | None
+
+
+class AppliedEvent(NamedTuple):
+    """A raw Celery event together with the state entity it was applied to, and its trace if it is sampled.
+
+    ``entity`` is a copy of the entity as of ``version``, the version of its cluster's state right after the
+    event was applied, so it is unaffected by the events applied while this one waits to be broadcast. ``seq``
+    is the sequence number of the event in the journal, if it was journaled.
+    """
+    event: dict
+    category: str
+    subject: str
+    entity: CeleryTask | CeleryWorker | None
+    created: bool
+    trace: EventTrace | None = None
+    version: int | None = None
+    seq: int | None = None
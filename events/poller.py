@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from asyncio import CancelledError, Task as AioTask, create_task
+from typing import Any, Self
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+from pydantic import TypeAdapter, ValidationError
+
+from celery_detect.settings import WorkerPollerSettings
+from events.clusters import ClusterRegistry, clusters
+from events.models import WorkerDetailsMessage, WorkerDetailsType
+from workers.gateway import InspectGateway, inspect_gateway
+from workers.models import QueueInfo, ScheduledTask, Stats, TaskRequest
+from ws.encoding import Payload
+from ws.managers import workers_manager
+from ws.subscriptions import EventAttributes
+from ws.websocket_manager import WebsocketManager
+
+logger = logging.getLogger(__name__)
+
+#: How often the poller checks which commands are due.
+TICK = 0.5
+#: Inspect commands polled, the message type their changes are pushed as, and how replies are parsed.
+POLLED_COMMANDS: dict[str, tuple[WorkerDetailsType, TypeAdapter]] = {
+    "stats": (WorkerDetailsType.STATS, TypeAdapter(Stats)),
+    "active": (WorkerDetailsType.ACTIVE, TypeAdapter(list[TaskRequest])),
+    "reserved": (WorkerDetailsType.RESERVED, TypeAdapter(list[TaskRequest])),
+    "scheduled": (WorkerDetailsType.SCHEDULED, TypeAdapter(list[ScheduledTask])),
+    "active_queues": (WorkerDetailsType.QUEUES, TypeAdapter(list[QueueInfo])),
+}
+
+
+class WorkerDetailsPoller:
+    """Polls the worker details of every cluster through the inspect gateway and pushes what changed to ``ws/workers``.
+
+    Each command is polled every ``intervals[command]`` seconds while clients are connected. The
+    interval doubles (up to ``max_backoff`` times) for as long as replies do not change, and falls
+    back as soon as they do. Without clients, commands are polled every ``idle_interval`` seconds
+    (or not at all if None), and a full poll runs as soon as the first client connects. Newly
+    connected clients get the latest details of every worker, then only the changes.
+    """
+
+    def __init__(
+            self,
+            intervals: dict[str, float],
+            idle_interval: float | None = 60.0,
+            max_backoff: float = 4.0,
+            gateway: InspectGateway = inspect_gateway,
+            manager: WebsocketManager = workers_manager,
+            registry: ClusterRegistry = clusters,
+    ):
+        unknown = set(intervals) - set(POLLED_COMMANDS)
+        if unknown:
+            raise ValueError(f"Cannot poll inspect commands {', '.join(sorted(unknown))}")
+        self.intervals = intervals
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self.gateway = gateway
+        self.manager = manager
+        self.clusters = [cluster.id for cluster in registry]
+        # (cluster, command) -> worker -> last raw reply, compared to detect changes before parsing anything
+        self._replies: dict[tuple[str, str], dict[str, Any]] = {
+            (cluster, command): {} for cluster in self.clusters for command in intervals
+        }
+        self._latest: dict[tuple[WorkerDetailsType, str, str], Payload] = {}
+        self._next_poll = dict.fromkeys(intervals, 0.0)
+        self._backoff = dict.fromkeys(intervals, 1.0)
+        self._watched = False
+        self._task: AioTask | None = None
+
+    @classmethod
+    def from_settings(cls, settings: dict = WorkerPollerSettings) -> Self | None:
+        if not settings.get("ENABLED"):
+            return None
+        return cls(
+            intervals=settings["INTERVALS"],
+            idle_interval=settings.get("IDLE_INTERVAL", 60.0),
+            max_backoff=settings.get("MAX_BACKOFF", 4.0),
+        )
+
+    def start(self) -> None:
+        self._task = create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def interval(self, command: str) -> float | None:
+        if not self.manager.has_subscribers:
+            return self.idle_interval
+        return self.intervals[command] * self._backoff[command]
+
+    async def _run(self) -> None:
+        while True:
+            watched = self.manager.has_subscribers
+            if watched and not self._watched:
+                # Someone started watching, poll everything right away
+                self._next_poll = dict.fromkeys(self.intervals, 0.0)
+                self._backoff = dict.fromkeys(self.intervals, 1.0)
+            self._watched = watched
+
+            now = time.monotonic()
+            due = [command for command, next_poll in self._next_poll.items() if next_poll <= now]
+            try:
+                if due:
+                    await self.poll(due)
+                await asyncio.sleep(TICK)
+            except CancelledError:
+                break
+            except Exception as e:
+                logger.exception(f"Failed to poll worker details: {e}")
+
+    async def poll(self, commands: list[str]) -> None:
+        polls = [(command, cluster) for command in commands for cluster in self.clusters]
+        results = await asyncio.gather(
+            *(self.gateway.inspect(command, cluster=cluster) for command, cluster in polls), return_exceptions=True,
+        )
+        now = time.monotonic()
+        changes = dict.fromkeys(commands, False)
+        for (command, cluster), replies in zip(polls, results):
+            if isinstance(replies, BaseException):
+                logger.warning(f"Failed to inspect {command} of cluster {cluster}: {replies}")
+            elif self._apply(command, cluster, replies):
+                changes[command] = True
+        for command, changed in changes.items():
+            self._backoff[command] = 1.0 if changed else min(self._backoff[command] * 2, self.max_backoff)
+            interval = self.interval(command)
+            self._next_poll[command] = now + interval if interval is not None else float("inf")
+
+    def _apply(self, command: str, cluster: str, replies: dict[str, Any]) -> bool:
+        """Push the replies that differ from the previous poll. Returns whether any did."""
+        message_type, adapter = POLLED_COMMANDS[command]
+        previous = self._replies[(cluster, command)]
+        changed = False
+        for hostname, reply in replies.items():
+            if previous.get(hostname) == reply:
+                continue
+            try:
+                data = adapter.validate_python(reply)
+            except ValidationError as e:
+                logger.warning(f"Ignoring unexpected {command} reply from {hostname}: {e}")
+                continue
+            previous[hostname] = reply
+            self._push(WorkerDetailsMessage(type=message_type, hostname=hostname, cluster=cluster, data=data))
+            changed = True
+
+        for hostname in [hostname for hostname in previous if hostname not in replies]:
+            del previous[hostname]
+            self._push(WorkerDetailsMessage(type=message_type, hostname=hostname, cluster=cluster, data=None))
+            changed = True
+        return changed
+
+    def _push(self, message: WorkerDetailsMessage) -> None:
+        key = (message.type, message.cluster, message.hostname)
+        payload = Payload(message)
+        if message.data is None:
+            self._latest.pop(key, None)
+        else:
+            self._latest[key] = payload
+        if not self.manager.has_subscribers:
+            return
+        attributes = EventAttributes(
+            category=message.category.value, type=message.type.value, worker=message.hostname, cluster=message.cluster,
+        )
+        self.manager.send(self.manager.route(attributes), payload, key=key)
+
+    def send_snapshot(self, websocket: AsyncWebsocketConsumer) -> None:
+        """Send the latest known details of every worker to a newly connected client."""
+        sender = self.manager.active_connections.get(websocket)
+        if sender is None:
+            return
+        for key, payload in list(self._latest.items()):
+            self.manager.send([sender], payload, key=key)
+
+
+worker_poller = WorkerDetailsPoller.from_settings()
@@ -1,30 +1,199 @@
-import asyncio
 import logging
 import time
 from threading import Event, Thread
+from typing import Self
 
 from celery import Celery
 from celery.events import EventReceiver
 from celery.events.state import State
 
-from celery_detect.settings import CELERY_MAX_WORKERS, CELERY_MAX_TASKS
+from celery_detect.settings import (
+    CELERY_DEFAULT_CLUSTER,
+    CELERY_EVENT_BATCH_SIZE,
+    CELERY_EVENT_BATCH_WINDOW,
+    CELERY_EVENT_QUEUE_OVERFLOW,
+    CELERY_EVENT_QUEUE_SIZE,
+    RetentionSettings,
+)
+from events.channel import EventChannel, OverflowPolicy
+from events.clusters import Cluster, ClusterRegistry, clusters
+from events.journal import EventJournal, event_journal
+from events.models import AppliedEvent
+from events.sharding import ShardPool
+from events.store import copy_task, copy_worker, stored_tasks
+from history.archive import task_archive
+from metrics.engine import metrics_engine
+from metrics.exporter import prometheus_exporter
+from metrics.tracing import EventTrace, latency_tracer
 
 logger = logging.getLogger(__name__)
 
-state = State(
-    max_tasks_in_memory=CELERY_MAX_TASKS,
-    max_workers_in_memory=CELERY_MAX_WORKERS,
-)
+# The default cluster, the only one unless more are configured in CELERY_CLUSTERS
+state: State = clusters.default.state
+snapshots = clusters.default.snapshots
+retention = clusters.default.retention
+
+
+def applied_event_key(event: AppliedEvent) -> tuple[str, str] | tuple[str, str, str] | None:
+    """Identify the task or worker an event belongs to, so pending events can be coalesced."""
+    if event.category == "task":
+        return event.category, event.event.get("uuid")
+    elif event.category == "worker":
+        # Hostnames are only unique within a cluster
+        return event.category, event.event.get("cluster"), event.event.get("hostname")
+    return None
+
+
+# One hand-off queue per cluster, so the receivers of different clusters never contend for one
+event_queues: dict[str, EventChannel[AppliedEvent]] = {
+    cluster.id: EventChannel(
+        max_size=CELERY_EVENT_QUEUE_SIZE,
+        overflow=OverflowPolicy(CELERY_EVENT_QUEUE_OVERFLOW),
+        batch_size=CELERY_EVENT_BATCH_SIZE,
+        batch_window=CELERY_EVENT_BATCH_WINDOW,
+        key=applied_event_key,
+    )
+    for cluster in clusters
+}
+event_queue = event_queues[clusters.default.id]
+
+
+def apply_event(event: dict, trace: EventTrace | None = None, journal: EventJournal | None = None) -> AppliedEvent:
+    """Apply an event to the state of its cluster. This is the only place the states are mutated by events.
+
+    The event is appended to ``journal`` under the snapshot lock it is applied with, so the journal records
+    events, evictions and clears in the order they are applied in. The tasks the retention policy evicts in
+    turn are recorded there too.
+    """
+    cluster = clusters.get(event.get("cluster"))
+    category, _, subject = event.get("type", "").partition("-")
+    # The applied event is read later on by other threads, while the live entity keeps changing with new events
+    result, copied, version, seq = cluster.snapshots.apply(
+        event,
+        copy=copy_task if category == "task" else copy_worker,
+        record=journal.append if journal is not None else None,
+    )
+    if result is None:
+        applied = AppliedEvent(
+            event=event, category=category, subject=subject, entity=None, created=False, trace=trace, seq=seq
+        )
+        prometheus_exporter.record(applied)
+        return applied
+
+    (entity, created), _ = result
+    applied = AppliedEvent(
+        event=event,
+        category=category,
+        subject=subject,
+        entity=copied,
+        created=created,
+        trace=trace,
+        version=version,
+        seq=seq,
+    )
+    prometheus_exporter.record(applied)
+    if category == "task":
+        cluster.index.update(entity)
+        metrics_engine.record(applied)
+        if task_archive is not None:
+            task_archive.put(applied.entity)
+        evict_tasks(cluster.retention.update(entity, now=event.get("local_received")), cluster, journal)
+    return applied
+
+
+def evict_tasks(uuids: list[str], cluster: Cluster = clusters.default, journal: EventJournal | None = None) -> None:
+    """Remove tasks picked by the retention policy from the cluster's state and the indexes, recording their
+    eviction in ``journal`` if the cluster's events are journaled."""
+    if not uuids:
+        return
+    with cluster.snapshots.changing(uuids):
+        if journal is not None:
+            journal.record_evictions(uuids)
+        for uuid in uuids:
+            cluster.state.tasks.pop(uuid, None)
+    # Outside of the snapshot lock, which index queries take to look the tasks up
+    for uuid in uuids:
+        cluster.index.discard(uuid)
+
+
+def restore_state(journal: EventJournal) -> None:
+    """Rebuild the state of the default cluster and its indexes from the event journal."""
+    journal.restore(state)
+    tasks = stored_tasks(state)
+    clusters.default.index.rebuild(tasks)
+    retention.rebuild(tasks)
+
+
+class RetentionSweeper(Thread):
+    """Thread evicting the tasks whose TTL ran out, every ``interval`` seconds.
+
+    Events expire the tasks of their cluster as they arrive, this catches up on the clusters no events arrived
+    for. Evictions go through :func:`evict_tasks` like the ones of events, or through the shards if sharded.
+    """
+
+    def __init__(
+            self,
+            interval: float,
+            registry: ClusterRegistry = clusters,
+            journal: EventJournal | None = event_journal,
+            shards: ShardPool | None = None,
+    ):
+        super().__init__(name="RetentionSweeper", daemon=True)
+        self.interval = interval
+        self.clusters = registry
+        self.journal = journal
+        self.shards = shards
+        self._stop_signal = Event()
+
+    @classmethod
+    def from_settings(cls, settings: dict = RetentionSettings, **kwargs) -> Self | None:
+        if settings.get("SWEEP_INTERVAL") is None:
+            return None
+        return cls(settings["SWEEP_INTERVAL"], **kwargs)
+
+    def run(self) -> None:
+        while not self._stop_signal.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception(f"Failed to evict expired tasks: {e}")
+
+    def sweep(self) -> None:
+        if self.shards is not None:
+            self.shards.expire_tasks()
+            return
+        for cluster in self.clusters:
+            journal = self.journal if cluster is self.clusters.default else None
+            evict_tasks(cluster.retention.expire(), cluster, journal)
+
+    def stop(self) -> None:
+        self._stop_signal.set()
+        self.join()
 
 
 class CeleryEventReceiver(Thread):
-    """Thread for consuming events from a Celery cluster."""
+    """Thread for consuming events from a Celery cluster, tagging them with the cluster's id.
+
+    With ``shards``, events are handed to the state shards instead of being applied to the state here.
+    """
 
-    def __init__(self, app: Celery):
-        super().__init__()
+    def __init__(
+            self,
+            app: Celery,
+            queue: EventChannel[AppliedEvent] = event_queue,
+            journal: EventJournal | None = event_journal,
+            bus: EventChannel[tuple[int | None, dict]] | None = None,
+            cluster: str = CELERY_DEFAULT_CLUSTER,
+            shards: ShardPool | None = None,
+    ):
+        super().__init__(name=f"celery-event-receiver-{cluster}")
         self.app = app
+        self.cluster = cluster
+        self.journal = journal
+        self.bus = bus
+        self.shards = shards
         self._stop_signal = Event()
-        self.queue = asyncio.Queue()
+        self.queue = queue
         self.receiver: EventReceiver | None = None
 
     def run(self) -> None:
@@ -54,8 +223,24 @@ class CeleryEventReceiver(Thread):
 
     def on_event(self, event: dict) -> None:
         logger.debug(f"Received event: {event}")
-        state.event(event)
-        self.queue.put_nowait(event)
+        event["cluster"] = self.cluster
+        trace = latency_tracer.start(event)
+        if self.shards is not None:
+            seq = self.journal.append(event) if self.journal is not None else None
+            if self.bus is not None:
+                self.bus.put((seq, event))
+            self.shards.put(event)
+            if self._stop_signal.is_set():
+                raise KeyboardInterrupt("Stop signal received")
+            return
+        applied = apply_event(event, trace, self.journal)
+        if self.bus is not None:
+            self.bus.put((applied.seq, event))
+        if trace is not None:
+            trace.mark("ingest")
+        self.queue.put(applied)
+        if self.journal is not None:
+            self.journal.maybe_snapshot(snapshots)
         if self._stop_signal.is_set():
             raise KeyboardInterrupt("Stop signal received")
 
@@ -64,4 +249,7 @@ class CeleryEventReceiver(Thread):
         if self.receiver is not None:
             self.receiver.should_stop = True
         self._stop_signal.set()
+        self.queue.close()
+        if self.bus is not None:
+            self.bus.close()
         self.join()
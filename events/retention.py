@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable
+from typing import Self
+
+from celery.events.state import Task as CeleryTask
+from pydantic import BaseModel, ConfigDict, Field
+
+from celery_detect.settings import RetentionSettings
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(BaseModel):
+    """Which tasks are evicted from memory before the global ``CELERY_MAX_TASKS`` limit is reached."""
+    ttl: dict[str, float] = Field(
+        default_factory=dict, description="Seconds to keep tasks in a state (e.g, SUCCESS) after their last event"
+    )
+    default_ttl: float | None = Field(None, description="Seconds to keep tasks in states without their own TTL")
+    state_quotas: dict[str, int] = Field(default_factory=dict, description="Maximum number of tasks kept per state")
+    type_quotas: dict[str, int] = Field(default_factory=dict, description="Maximum number of tasks kept per task type")
+    default_type_quota: int | None = Field(None, description="Maximum number of tasks kept for other task types")
+
+    model_config = ConfigDict(
+        extra="forbid",
+    )
+
+    @classmethod
+    def from_settings(cls, settings: dict = RetentionSettings) -> Self:
+        return cls(
+            ttl=settings.get("TTL", {}),
+            default_ttl=settings.get("DEFAULT_TTL"),
+            state_quotas=settings.get("STATE_QUOTAS", {}),
+            type_quotas=settings.get("TYPE_QUOTAS", {}),
+            default_type_quota=settings.get("DEFAULT_TYPE_QUOTA"),
+        )
+
+    def ttl_for(self, state: str) -> float | None:
+        return self.ttl.get(state, self.default_ttl)
+
+    def type_quota(self, name: str) -> int | None:
+        return self.type_quotas.get(name, self.default_type_quota)
+
+
+class RetentionStats(BaseModel):
+    policy: RetentionPolicy = Field(description="Policy currently applied")
+    tracked: int = Field(description="Tasks tracked by the retention engine")
+    evicted: dict[str, int] = Field(description="Tasks evicted by reason (ttl / state-quota / type-quota)")
+
+    @classmethod
+    def combine(cls, stats: list[Self]) -> Self:
+        """Stats of several engines applying the same policy, e.g, those of the state shards."""
+        evicted: dict[str, int] = {}
+        for each in stats:
+            for reason, count in each.evicted.items():
+                evicted[reason] = evicted.get(reason, 0) + count
+        return cls(policy=stats[0].policy, tracked=sum(each.tracked for each in stats), evicted=evicted)
+
+
+class _Queue:
+    """Tasks of one state or type, oldest update first.
+
+    Like the task index postings, entries are never removed in place: an entry is live while its
+    seq is the task's latest, and stale entries are compacted away once they outnumber live ones.
+    """
+
+    __slots__ = ("entries", "live")
+
+    def __init__(self):
+        self.entries: deque[tuple[int, str, float]] = deque()
+        self.live = 0
+
+    def append(self, seq: int, uuid: str, at: float) -> None:
+        self.entries.append((seq, uuid, at))
+        self.live += 1
+
+    def needs_compaction(self) -> bool:
+        return len(self.entries) > 2 * self.live + 64
+
+    def compact(self, current: dict[str, tuple[int, str | None, str]]) -> None:
+        self.entries = deque(entry for entry in self.entries if current.get(entry[1], (None,))[0] == entry[0])
+        self.live = len(self.entries)
+
+
+class RetentionEngine:
+    """Incremental per-state/per-type quotas and time-to-live eviction of tasks.
+
+    Every task event re-files the task at the tail of its state's and type's queues, then only
+    the heads of the queues that may be over their limits are examined, so the work per event is
+    amortized O(1). TTLs also run out while no events arrive, so :meth:`expire` is called
+    periodically as well, see :class:`events.receiver.RetentionSweeper`. The engine only decides which
+    tasks to evict; ``contains`` and ``size`` tell it which tasks are still stored, as tasks are
+    also evicted by the state's own count limit.
+    """
+
+    def __init__(self, contains: Callable[[str], bool], size: Callable[[], int], policy: RetentionPolicy | None = None):
+        self.contains = contains
+        self.size = size
+        self.policy = policy or RetentionPolicy()
+        self._lock = threading.Lock()
+        self._seq = 0
+        # uuid -> (seq, type, state) of its latest update
+        self._current: dict[str, tuple[int, str | None, str]] = {}
+        self._states: dict[str, _Queue] = {}
+        self._types: dict[str, _Queue] = {}
+        self.evicted = {"ttl": 0, "state-quota": 0, "type-quota": 0}
+
+    @classmethod
+    def from_settings(
+            cls, contains: Callable[[str], bool], size: Callable[[], int], settings: dict = RetentionSettings
+    ) -> Self:
+        return cls(contains, size, RetentionPolicy.from_settings(settings))
+
+    def update(self, task: CeleryTask, now: float | None = None) -> list[str]:
+        """Track a task after an event was applied to it. Returns the uuids of the tasks to evict."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._track(task, now)
+            evicted: list[str] = []
+            policy = self.policy
+            state_quota = policy.state_quotas.get(task.state)
+            self._enforce_quota(self._states.get(task.state), state_quota, "state-quota", evicted)
+            if task.name is not None:
+                self._enforce_quota(self._types.get(task.name), policy.type_quota(task.name), "type-quota", evicted)
+            self._expire(now, evicted)
+            return evicted
+
+    def _track(self, task: CeleryTask, now: float) -> None:
+        uuid = task.uuid
+        self._untrack(uuid)
+        self._seq += 1
+        self._current[uuid] = (self._seq, task.name, task.state)
+        for queues, key in ((self._states, task.state), (self._types, task.name)):
+            if key is None:
+                continue
+            queue = queues.get(key)
+            if queue is None:
+                queue = queues[key] = _Queue()
+            queue.append(self._seq, uuid, now)
+            if queue.needs_compaction():
+                queue.compact(self._current)
+        # Tasks evicted by the state's count limit are never seen again, forget them once they add up
+        if len(self._current) > 2 * self.size() + 1024:
+            self._forget_evicted()
+
+    def _untrack(self, uuid: str) -> bool:
+        current = self._current.pop(uuid, None)
+        if current is None:
+            return False
+        _, name, state = current
+        for queues, key in ((self._states, state), (self._types, name)):
+            queue = queues.get(key)
+            if queue is not None:
+                queue.live -= 1
+        return True
+
+    def _forget_evicted(self) -> None:
+        gone = [uuid for uuid in self._current if not self.contains(uuid)]
+        for uuid in gone:
+            self._untrack(uuid)
+        if gone:
+            for queue in (*self._states.values(), *self._types.values()):
+                queue.compact(self._current)
+
+    def _pop_head(self, queue: _Queue) -> tuple[str, float] | None:
+        """Remove the oldest entry of a queue, returning it if it is live and still stored."""
+        seq, uuid, at = queue.entries.popleft()
+        current = self._current.get(uuid)
+        if current is None or current[0] != seq:
+            return None
+        if not self.contains(uuid):
+            self._untrack(uuid)
+            return None
+        return uuid, at
+
+    def _enforce_quota(self, queue: _Queue | None, quota: int | None, reason: str, evicted: list[str]) -> None:
+        if queue is None or quota is None:
+            return
+        while queue.live > quota and queue.entries:
+            head = self._pop_head(queue)
+            if head is not None:
+                self._evict(head[0], reason, evicted)
+
+    def _expire(self, now: float, evicted: list[str]) -> None:
+        for state, queue in self._states.items():
+            ttl = self.policy.ttl_for(state)
+            if ttl is None:
+                continue
+            deadline = now - ttl
+            entries = queue.entries
+            while entries and entries[0][2] < deadline:
+                head = self._pop_head(queue)
+                if head is not None:
+                    self._evict(head[0], "ttl", evicted)
+
+    def expire(self, now: float | None = None) -> list[str]:
+        """Returns the uuids of the tasks whose TTL ran out by ``now``, the current time by default."""
+        evicted: list[str] = []
+        with self._lock:
+            self._expire(now if now is not None else time.time(), evicted)
+        return evicted
+
+    def _evict(self, uuid: str, reason: str, evicted: list[str]) -> None:
+        self._untrack(uuid)
+        self.evicted[reason] += 1
+        evicted.append(uuid)
+
+    def discard(self, uuid: str) -> None:
+        with self._lock:
+            self._untrack(uuid)
+
+    def rebuild(self, tasks: Iterable[CeleryTask]) -> None:
+        """Re-track ``tasks``, given oldest first, e.g, after the state was cleared or restored."""
+        with self._lock:
+            self._current.clear()
+            self._states.clear()
+            self._types.clear()
+            for task in tasks:
+                self._track(task, task.timestamp or time.time())
+
+    def set_policy(self, policy: RetentionPolicy) -> list[str]:
+        """Apply a new policy right away. Returns the uuids of the tasks to evict under it."""
+        evicted: list[str] = []
+        with self._lock:
+            self.policy = policy
+            logger.info(f"Applying task retention policy: {policy}")
+            for state, queue in self._states.items():
+                self._enforce_quota(queue, policy.state_quotas.get(state), "state-quota", evicted)
+            for name, queue in self._types.items():
+                self._enforce_quota(queue, policy.type_quota(name), "type-quota", evicted)
+            self._expire(time.time(), evicted)
+        return evicted
+
+    def stats(self) -> RetentionStats:
+        with self._lock:
+            return RetentionStats(policy=self.policy, tracked=len(self._current), evicted=dict(self.evicted))
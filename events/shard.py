@@ -0,0 +1,197 @@
+import logging
+from multiprocessing import Queue
+
+import django
+
+from celery.events.state import Task as CeleryTask
+
+from celery_detect.settings import CELERY_DEFAULT_CLUSTER, CELERY_MAX_TASKS
+from events.apps import EventsConfig
+from events.broadcaster import event_attributes, parse_event
+from events.clusters import Cluster
+from events.models import AppliedEvent
+from events.receiver import applied_event_key, evict_tasks
+from events.retention import RetentionPolicy
+from events.sharding import ShardedEvent, ShardSummary, shard_of
+from events.store import copy_task
+from history.archive import task_archive
+from metrics.engine import MetricsEngine, SeriesTotals
+from metrics.exporter import ExporterCounts, PrometheusExporter
+from tasks.index import TaskFilter
+from tasks.workflow import build_workflow
+from ws.subscriptions import NOT_APPLICABLE
+
+logger = logging.getLogger(__name__)
+
+
+class Shard:
+    """The part of the state owned by one shard process, see :class:`events.sharding.ShardPool`.
+
+    The metrics, exporter counters and archive of the shard's events are kept here too, and read by
+    the server process through queries. The tasks the shard evicts are reported back, so the server
+    process forgets their routes.
+    """
+
+    def __init__(self, index: int, shards: int):
+        self.index = index
+        self.shards = shards
+        # CELERY_MAX_TASKS bounds the tasks of all the shards together
+        self.cluster = Cluster(CELERY_DEFAULT_CLUSTER, max_tasks=max(CELERY_MAX_TASKS // shards, 1))
+        self.metrics = MetricsEngine.from_settings()
+        self.exporter = PrometheusExporter()
+        self.archive = task_archive
+        self.evicted: list[str] = []
+
+    def apply(self, event: dict) -> ShardedEvent:
+        tasks = self.cluster.state.tasks.data
+        # The oldest task is evicted by the state itself when a new one comes in while it is full
+        overflow = (
+            next(iter(tasks))
+            if tasks and event.get("uuid") not in tasks and len(tasks) >= self.cluster.state.max_tasks_in_memory
+            else None
+        )
+        result = self.cluster.snapshots.apply(event).result
+        if overflow is not None and overflow not in tasks:
+            self.evicted.append(overflow)
+        category, _, subject = event.get("type", "").partition("-")
+        entity, created = result[0] if result is not None else (None, False)
+        applied = AppliedEvent(event=event, category=category, subject=subject, entity=entity, created=created)
+        self.exporter.record(applied)
+        if category == "task" and entity is not None:
+            self.cluster.index.update(entity)
+            self.metrics.record(applied)
+            if self.archive is not None:
+                # The archive converts tasks on its own thread, while this one keeps changing them
+                self.archive.put(copy_task(entity))
+            self._evict(self.cluster.retention.update(entity, now=event.get("local_received")))
+
+        try:
+            message = parse_event(applied, self.cluster.snapshots.models).model_dump_json()
+        except Exception as e:
+            logger.warning(f"Failed to parse event message: {e}")
+            message = None
+        attributes = {
+            field: value for field, value in event_attributes(applied)._asdict().items() if value is not NOT_APPLICABLE
+        }
+        return ShardedEvent(
+            category=category,
+            subject=subject,
+            key=applied_event_key(applied),
+            attributes=attributes,
+            message=message,
+        )
+
+    def _get_task(self, uuid: str) -> CeleryTask | None:
+        return self.cluster.state.tasks.data.get(uuid)
+
+    def tasks(self, filters: TaskFilter, limit: int) -> tuple[int, list[tuple[float, bytes]]]:
+        """This shard's total and first ``limit`` tasks as JSON, with the timestamp of their last event to merge
+        them by."""
+        page = self.cluster.index.query(self._get_task, filters=filters, limit=limit)
+        models = self.cluster.snapshots.models
+        return page.total, [(task.timestamp or 0, models.task(task).json) for task in page.tasks]
+
+    def task_page(self, cursor: int | None, limit: int) -> tuple[list[bytes], int | None]:
+        """This shard's ``limit`` tasks as JSON updated last before ``cursor``, and the cursor of the next ones."""
+        page = self.cluster.index.query(self._get_task, cursor=cursor, limit=limit)
+        models = self.cluster.snapshots.models
+        return [models.task(task).json for task in page.tasks], page.next_cursor
+
+    def task(self, uuid: str) -> bytes | None:
+        task = self._get_task(uuid)
+        return self.cluster.snapshots.models.task(task).json if task is not None else None
+
+    def workflow(self, uuid: str) -> dict | None:
+        task = self._get_task(uuid)
+        if task is None:
+            return None
+        return build_workflow(task, self.cluster.snapshots.snapshot(), self.cluster.index).model_dump()
+
+    def workers(self) -> list[tuple[bool, dict]]:
+        """Workers whose events this shard applies, with whether they are alive.
+
+        Task events create their worker in the task's shard too, without any of the worker's own details.
+        """
+        return [
+            (worker.alive, self.cluster.snapshots.models.worker(worker).json)
+            for worker in list(self.cluster.state.workers.data.values())
+            if shard_of(worker.hostname, self.shards) == self.index
+        ]
+
+    def summary(self) -> ShardSummary:
+        state = self.cluster.state
+        return ShardSummary(
+            version=self.cluster.snapshots.version,
+            tasks=len(state.tasks),
+            workers=[
+                (worker.hostname, worker.alive)
+                for worker in list(state.workers.data.values())
+                if shard_of(worker.hostname, self.shards) == self.index
+            ],
+            retention=self.cluster.retention.stats(),
+        )
+
+    def clear(self, ready: bool) -> None:
+        uuids = list(self.cluster.state.tasks.data)
+        self.cluster.clear(ready)
+        self.evicted.extend(uuids)
+
+    def set_retention_policy(self, policy: RetentionPolicy) -> None:
+        self._evict(self.cluster.retention.set_policy(policy))
+
+    def expire_tasks(self) -> None:
+        self._evict(self.cluster.retention.expire())
+
+    def _evict(self, uuids: list[str]) -> None:
+        evict_tasks(uuids, self.cluster)
+        self.evicted.extend(uuids)
+
+    def pop_evicted(self) -> list[str]:
+        """Tasks evicted since the last call, leaving out the ones events stored again in the meantime."""
+        tasks = self.cluster.state.tasks.data
+        evicted, self.evicted = self.evicted, []
+        return [uuid for uuid in evicted if uuid not in tasks]
+
+    def metric_totals(self, *args) -> dict[tuple[str, str], SeriesTotals]:
+        return self.metrics.totals(*args)
+
+    def exporter_counts(self) -> ExporterCounts:
+        return self.exporter.counts()
+
+
+QUERIES = (
+    "tasks", "task_page", "task", "workflow", "workers", "summary", "clear", "set_retention_policy", "expire_tasks",
+    "metric_totals", "exporter_counts",
+)
+
+
+def run_shard(index: int, shards: int, inbox: Queue, outbox: Queue) -> None:
+    """Main loop of a shard process, applying the batches of events and answering the queries in its inbox."""
+    shard = Shard(index, shards)
+    if shard.archive is not None:
+        # Spawned processes start without the Django apps the archive writes with, and must not start another
+        # event system along with them
+        EventsConfig.start_event_system = False
+        django.setup()
+        shard.archive.start()
+    while (message := inbox.get()) is not None:
+        kind, payload = message
+        if kind == "events":
+            applied = []
+            for event in payload:
+                try:
+                    applied.append(shard.apply(event))
+                except Exception as e:
+                    logger.exception(f"Failed to apply event: {e}")
+            outbox.put(("events", index, applied))
+        elif kind in QUERIES:
+            request_id, args = payload
+            try:
+                outbox.put(("reply", request_id, getattr(shard, kind)(*args)))
+            except Exception as e:
+                logger.exception(f"Failed to answer {kind!r} query: {e}")
+                outbox.put(("error", request_id, e))
+        if shard.evicted:
+            outbox.put(("evicted", index, shard.pop_evicted()))
+    if shard.archive is not None:
+        shard.archive.stop()
@@ -0,0 +1,351 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import zlib
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, wait
+from operator import itemgetter
+from typing import Any, NamedTuple, Self
+
+from celery_detect.settings import (
+    CELERY_EVENT_BATCH_SIZE,
+    CELERY_EVENT_BATCH_WINDOW,
+    CELERY_EVENT_QUEUE_OVERFLOW,
+    CELERY_EVENT_QUEUE_SIZE,
+    ShardingSettings,
+)
+from events.channel import EventChannel, OverflowPolicy
+from events.exceptions import ShardUnavailableError
+from events.retention import RetentionPolicy, RetentionStats
+from metrics.engine import SeriesTotals
+from metrics.exporter import ExporterCounts
+from tasks.index import TaskFilter
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(key: str, shards: int) -> int:
+    """Shard owning a task or worker key, the same in every process (unlike ``hash``)."""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+class ShardedEvent(NamedTuple):
+    """An event applied by a shard process, with everything the server process needs to broadcast it."""
+    category: str
+    subject: str
+    key: tuple | None
+    attributes: dict[str, Any]
+    message: str | None  # JSON encoded event message, None if it could not be built
+
+
+class ShardSummary(NamedTuple):
+    """Size of the state of a shard, or of all of them."""
+    version: int
+    tasks: int
+    workers: list[tuple[str, bool]]  # hostname and whether it is alive, of the workers whose events it applies
+    retention: RetentionStats
+
+
+class ShardPool:
+    """Applies events in ``shards`` processes, each owning the part of the state hashed to it.
+
+    Task events are routed by root id, so a workflow lives in a single shard and is assembled there,
+    and worker events by hostname. Shards build and encode the event messages, which the server
+    process only has to hand to the broadcaster: ``on_applied`` is called with every batch of applied
+    events. They also keep the metrics, exporter counters and archive of their events, so nothing else
+    is done per event in the server process. Queries are sent to the owning shard, or to all of them
+    with the answers merged. Shards that do not answer within ``query_timeout`` raise
+    :class:`ShardUnavailableError`.
+
+    Each shard's inbox holds up to ``inbox_size`` batches. Once it is full, events wait in the server
+    process, and beyond ``max_pending`` of them ``overflow`` applies: the oldest are dropped, or the
+    receiver waits for the shard if it blocks. Raw events cannot be merged into one another without
+    losing what they changed, so coalescing drops the oldest too.
+    """
+
+    def __init__(
+            self,
+            shards: int,
+            batch_size: int = CELERY_EVENT_BATCH_SIZE,
+            batch_window: float = CELERY_EVENT_BATCH_WINDOW,
+            query_timeout: float = 10.0,
+            inbox_size: int = 64,
+            max_pending: int = CELERY_EVENT_QUEUE_SIZE,
+            overflow: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+            on_applied: Callable[[list[ShardedEvent]], None] | None = None,
+    ):
+        self.shards = shards
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.query_timeout = query_timeout
+        self.inbox_size = inbox_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.on_applied = on_applied
+        # Shards of tasks routed by root id, which only the first events of a task carry. They are kept until
+        # the shard reports the task evicted.
+        self.routes: dict[str, int] = {}
+        self.dropped = 0
+        self._pending: list[list[dict]] = [[] for _ in range(shards)]
+        self._lock = threading.Lock()
+        self._requests: dict[int, Future] = {}
+        self._request_ids = itertools.count()
+        self._stop_signal = threading.Event()
+        self._processes: list[multiprocessing.Process] = []
+        self._inboxes: list[multiprocessing.Queue] = []
+        self._outbox: multiprocessing.Queue | None = None
+        self._threads: list[threading.Thread] = []
+
+    @classmethod
+    def from_settings(
+            cls, settings: dict = ShardingSettings, on_applied: Callable[[list[ShardedEvent]], None] | None = None,
+    ) -> Self | None:
+        shards = settings.get("SHARDS", 0)
+        if shards < 2:
+            return None
+        return cls(
+            shards,
+            batch_size=settings.get("BATCH_SIZE", CELERY_EVENT_BATCH_SIZE),
+            batch_window=settings.get("BATCH_WINDOW", CELERY_EVENT_BATCH_WINDOW),
+            query_timeout=settings.get("QUERY_TIMEOUT", 10.0),
+            inbox_size=settings.get("INBOX_SIZE", 64),
+            max_pending=settings.get("MAX_PENDING", CELERY_EVENT_QUEUE_SIZE),
+            overflow=OverflowPolicy(settings.get("OVERFLOW", OverflowPolicy.DROP_OLDEST)),
+            on_applied=on_applied,
+        )
+
+    def start(self) -> None:
+        # The shard module imports the broadcaster, which imports the receiver, which imports this one
+        from events.shard import run_shard
+
+        logger.info(f"Starting {self.shards} state shards...")
+        # Spawned rather than forked, as the server process runs threads and an event loop
+        context = multiprocessing.get_context("spawn")
+        self._outbox = context.Queue()
+        self._inboxes = [context.Queue(self.inbox_size) for _ in range(self.shards)]
+        self._processes = [
+            context.Process(
+                target=run_shard, args=(index, self.shards, inbox, self._outbox), name=f"state-shard-{index}",
+                daemon=True,
+            )
+            for index, inbox in enumerate(self._inboxes)
+        ]
+        for process in self._processes:
+            process.start()
+        self._threads = [
+            threading.Thread(target=self._collect, name="shard-collector", daemon=True),
+            threading.Thread(target=self._flush_periodically, name="shard-flusher", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        logger.info("Stopping state shards...")
+        self._stop_signal.set()
+        self.flush()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join()
+        self._outbox.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def route(self, event: dict) -> int:
+        """Shard an event is applied by. Called with the lock held."""
+        if not event.get("type", "").startswith("task-"):
+            return shard_of(event.get("hostname") or "", self.shards)
+        uuid = event.get("uuid") or ""
+        shard = self.routes.get(uuid)
+        if shard is not None:
+            return shard
+        root_id = event.get("root_id")
+        if not root_id or root_id == uuid:
+            return shard_of(uuid, self.shards)
+        shard = self.routes[uuid] = shard_of(root_id, self.shards)
+        return shard
+
+    def task_shard(self, uuid: str) -> int:
+        return self.routes.get(uuid, shard_of(uuid, self.shards))
+
+    def put(self, event: dict) -> None:
+        # Batches are sent under the lock, so a shard receives them in order
+        with self._lock:
+            shard = self.route(event)
+            batch = self._pending[shard]
+            batch.append(event)
+            if len(batch) >= self.batch_size:
+                self._send(shard)
+
+    def flush(self) -> None:
+        with self._lock:
+            for shard, batch in enumerate(self._pending):
+                if batch:
+                    self._send(shard)
+
+    def _send(self, shard: int) -> None:
+        """Send the pending events of a shard, or keep them for the next flush if its inbox is full."""
+        batch = self._pending[shard]
+        if self.overflow == OverflowPolicy.BLOCK:
+            self._inboxes[shard].put(("events", batch))
+        else:
+            try:
+                self._inboxes[shard].put_nowait(("events", batch))
+            except queue.Full:
+                if len(batch) > self.max_pending:
+                    dropped = len(batch) - self.max_pending
+                    del batch[:dropped]
+                    self.dropped += dropped
+                    logger.warning(f"Dropped {dropped} events, state shard {shard} is falling behind")
+                return
+        self._pending[shard] = []
+
+    def _forget_routes(self, uuids: list[str]) -> None:
+        with self._lock:
+            for uuid in uuids:
+                self.routes.pop(uuid, None)
+
+    def _flush_periodically(self) -> None:
+        while not self._stop_signal.wait(self.batch_window):
+            self.flush()
+
+    def _collect(self) -> None:
+        while (message := self._outbox.get()) is not None:
+            kind, key, payload = message
+            if kind == "events":
+                self._record(payload)
+                continue
+            if kind == "evicted":
+                self._forget_routes(payload)
+                continue
+            future = self._requests.pop(key, None)
+            if future is None:
+                continue
+            if kind == "error":
+                future.set_exception(payload)
+            else:
+                future.set_result(payload)
+
+    def _record(self, batch: list[ShardedEvent]) -> None:
+        if self.on_applied is None:
+            return
+        try:
+            self.on_applied(batch)
+        except Exception as e:
+            logger.exception(f"Failed to record sharded events: {e}")
+
+    def query(self, shard: int, name: str, *args) -> tuple[int, Future]:
+        """Ask a shard for ``name`` (see :class:`events.shard.Shard`), answered in the future returned with the
+        request's id."""
+        future = Future()
+        request_id = next(self._request_ids)
+        self._requests[request_id] = future
+        try:
+            self._inboxes[shard].put((name, (request_id, args)), timeout=self.query_timeout)
+        except queue.Full:
+            self._requests.pop(request_id, None)
+            raise ShardUnavailableError(f"State shard {shard} is too far behind to answer {name!r}") from None
+        return request_id, future
+
+    def _wait(self, name: str, requests: dict[int, tuple[int, Future]]) -> list:
+        """Answers to the requests sent to each shard, waiting up to the query timeout for all of them."""
+        _, missing = wait([future for _, future in requests.values()], timeout=self.query_timeout)
+        if missing:
+            late = []
+            for shard, (request_id, future) in requests.items():
+                if future in missing:
+                    # Answers arriving later are dropped
+                    self._requests.pop(request_id, None)
+                    late.append(str(shard))
+            raise ShardUnavailableError(
+                f"State shard {', '.join(late)} did not answer {name!r} within {self.query_timeout}s"
+            )
+        return [future.result() for _, future in requests.values()]
+
+    def gather(self, name: str, *args) -> list:
+        """Ask every shard for ``name``, waiting up to the query timeout for all the answers."""
+        return self._wait(name, {shard: self.query(shard, name, *args) for shard in range(self.shards)})
+
+    def tasks(self, filters: TaskFilter, limit: int, offset: int = 0) -> tuple[list[bytes], int]:
+        """A page of JSON encoded tasks of every shard, most recently updated first, and their total."""
+        replies = self.gather("tasks", filters, offset + limit)
+        totals = [total for total, _ in replies]
+        items = sorted((item for _, items in replies for item in items), key=itemgetter(0), reverse=True)
+        return [task for _, task in items[offset:offset + limit]], sum(totals)
+
+    def iter_tasks(self, page_size: int) -> Iterator[list[bytes]]:
+        """JSON encoded tasks of every shard, fetched a page of at most ``page_size`` tasks at a time as they are
+        read. Tasks updated in the meantime move ahead of the shard's cursor, and are left out."""
+        for shard in range(self.shards):
+            cursor = None
+            while True:
+                [(tasks, cursor)] = self._wait("task_page", {shard: self.query(shard, "task_page", cursor, page_size)})
+                if tasks:
+                    yield tasks
+                if cursor is None:
+                    break
+
+    def task(self, uuid: str) -> bytes | None:
+        """JSON encoded task."""
+        return self._find("task", uuid)
+
+    def workflow(self, uuid: str) -> dict | None:
+        return self._find("workflow", uuid)
+
+    def _find(self, name: str, uuid: str):
+        """Answer of the shard owning a task, or of the first other shard knowing it if its route was forgotten."""
+        owner = self.task_shard(uuid)
+        [found] = self._wait(name, {owner: self.query(owner, name, uuid)})
+        if found is not None:
+            return found
+        others = {shard: self.query(shard, name, uuid) for shard in range(self.shards) if shard != owner}
+        return next((found for found in self._wait(name, others) if found is not None), None)
+
+    def workers(self, alive: bool | None = None) -> list[bytes]:
+        """JSON encoded workers of every shard."""
+        return [
+            worker
+            for shard in self.gather("workers")
+            for is_alive, worker in shard
+            if alive is None or is_alive == alive
+        ]
+
+    def summary(self) -> ShardSummary:
+        """Size of the state of all the shards together."""
+        summaries = self.gather("summary")
+        return ShardSummary(
+            # Versions start from the time their shard started, so the latest one is the one still increasing
+            version=max(summary.version for summary in summaries),
+            tasks=sum(summary.tasks for summary in summaries),
+            workers=[worker for summary in summaries for worker in summary.workers],
+            retention=RetentionStats.combine([summary.retention for summary in summaries]),
+        )
+
+    def clear(self, ready: bool = True) -> None:
+        self.gather("clear", ready)
+
+    def set_retention_policy(self, policy: RetentionPolicy) -> None:
+        self.gather("set_retention_policy", policy)
+
+    def expire_tasks(self) -> None:
+        self.gather("expire_tasks")
+
+    def metric_totals(self, *args) -> list[dict[tuple[str, str], SeriesTotals]]:
+        """Metric series of every shard, see :meth:`metrics.engine.MetricsEngine.totals`."""
+        return self.gather("metric_totals", *args)
+
+    def exporter_counts(self) -> list[ExporterCounts]:
+        return self.gather("exporter_counts")
+
+
+sharded_event_queue: EventChannel[ShardedEvent] = EventChannel(
+    max_size=CELERY_EVENT_QUEUE_SIZE,
+    overflow=OverflowPolicy(CELERY_EVENT_QUEUE_OVERFLOW),
+    batch_size=CELERY_EVENT_BATCH_SIZE,
+    batch_window=CELERY_EVENT_BATCH_WINDOW,
+    key=lambda event: event.key,
+)
+
+shard_pool = ShardPool.from_settings(on_applied=sharded_event_queue.put_many)
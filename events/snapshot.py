@@ -0,0 +1,219 @@
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from typing import Any, NamedTuple
+from weakref import WeakSet
+
+from celery.events.state import State, Task as CeleryTask, Worker as CeleryWorker
+
+from events.changelog import ChangeLog
+from events.conversion import ConversionCache, ConvertedModel
+from events.store import copy_task, copy_worker
+
+
+def format_etag(version: int | str) -> str:
+    return f'W/"{version}"'
+
+
+class StateSnapshot:
+    """Read-only view of the state as it was at ``version``.
+
+    Nothing is copied when a snapshot is taken. Instead, while the snapshot is alive, the ingestion
+    thread copies the records it is about to change or evict into the snapshot first, and records
+    that did not exist yet are marked as missing (``None``). Reads copy the live records under the
+    manager's lock, which changes are applied under too, so a record is never seen half updated.
+    """
+
+    def __init__(self, manager: "SnapshotManager", version: int):
+        self._manager = manager
+        self.version = version
+        self.etag = format_etag(version)
+        self._tasks: dict[str, CeleryTask | None] = {}
+        self._workers: dict[str, CeleryWorker | None] = {}
+
+    def _preserve(self, state: State, uuids: Iterable[str], hostnames: Iterable[str]) -> None:
+        for preserved, records, keys, copy in (
+                (self._tasks, state.tasks.data, uuids, copy_task),
+                (self._workers, state.workers.data, hostnames, copy_worker),
+        ):
+            for key in keys:
+                if key is not None and key not in preserved:
+                    record = records.get(key)
+                    preserved[key] = copy(record) if record is not None else None
+
+    def get_task(self, uuid: str) -> CeleryTask | None:
+        return self.get_tasks((uuid,))[0]
+
+    def get_tasks(self, uuids: Iterable[str]) -> list[CeleryTask | None]:
+        tasks: list[CeleryTask | None] = []
+        with self._manager.lock:
+            live = self._manager.state.tasks.data
+            for uuid in uuids:
+                if uuid in self._tasks:
+                    tasks.append(self._tasks[uuid])
+                else:
+                    task = live.get(uuid)
+                    tasks.append(copy_task(task) if task is not None else None)
+        return tasks
+
+    def get_workers(self, hostnames: Iterable[str]) -> list[CeleryWorker | None]:
+        workers: list[CeleryWorker | None] = []
+        with self._manager.lock:
+            live = self._manager.state.workers.data
+            for hostname in hostnames:
+                if hostname in self._workers:
+                    workers.append(self._workers[hostname])
+                else:
+                    worker = live.get(hostname)
+                    workers.append(copy_worker(worker) if worker is not None else None)
+        return workers
+
+    def task_ids(self) -> list[str]:
+        """Ids of the tasks stored at ``version``, least recently updated first."""
+        with self._manager.lock:
+            live = list(self._manager.state.tasks.data)
+            preserved = dict(self._tasks)
+        evicted = preserved.keys() - set(live)
+        return [uuid for uuid in live if preserved.get(uuid, True) is not None] + [
+            uuid for uuid in evicted if preserved[uuid] is not None
+        ]
+
+    def iter_tasks(self, chunk_size: int = 1000) -> Iterator[list[CeleryTask]]:
+        """All tasks stored at ``version``, a chunk at a time, holding the lock for one chunk at most."""
+        uuids = self.task_ids()
+        for start in range(0, len(uuids), chunk_size):
+            yield [task for task in self.get_tasks(uuids[start:start + chunk_size]) if task is not None]
+
+    def workers(self) -> list[CeleryWorker]:
+        with self._manager.lock:
+            workers = {
+                hostname: self._workers[hostname] if hostname in self._workers else copy_worker(worker)
+                for hostname, worker in self._manager.state.workers.data.items()
+            }
+            for hostname, worker in self._workers.items():
+                if worker is not None:
+                    workers.setdefault(hostname, worker)
+                elif hostname in workers:
+                    del workers[hostname]
+        return list(workers.values())
+
+    def cluster_workers(self) -> Iterator[tuple[str | None, CeleryWorker]]:
+        """Workers with the id of the cluster they belong to, as read from a merged snapshot."""
+        cluster = getattr(self._manager.state, "cluster", None)
+        for worker in self.workers():
+            yield cluster, worker
+
+    def convert_task(self, task: CeleryTask) -> ConvertedModel:
+        """API model of a task read from this snapshot, converted at most once per version of the task."""
+        return self._manager.models.task(task, self.version)
+
+    def convert_worker(self, worker: CeleryWorker, cluster: str | None = None) -> ConvertedModel:
+        return self._manager.models.worker(worker, self.version)
+
+
+class AppliedChange(NamedTuple):
+    """What an event changed, read under the lock it was applied with, see :meth:`SnapshotManager.apply`."""
+    result: Any
+    entity: Any
+    version: int
+    seq: int | None
+
+
+class SnapshotManager:
+    """Versions the state and hands out consistent :class:`StateSnapshot` views of it.
+
+    ``version`` increases with every change applied through :meth:`apply` or :meth:`changing`,
+    and the tasks and workers each change touched are recorded in ``changes`` and invalidated in
+    ``models``. It starts from the current time in microseconds, so versions keep increasing across
+    restarts too. Taking a snapshot is O(1) and the ingestion thread never waits on readers for longer
+    than it takes to copy one chunk of records.
+    """
+
+    def __init__(self, state: State, changes: ChangeLog):
+        self.state = state
+        self.changes = changes
+        self.version = time.time_ns() // 1000
+        self.changes.oldest = self.version
+        self.models = ConversionCache.from_settings(state)
+        self.lock = threading.Lock()
+        self._active: WeakSet[StateSnapshot] = WeakSet()
+
+    def snapshot(self) -> StateSnapshot:
+        with self.lock:
+            snapshot = StateSnapshot(self, self.version)
+            self._active.add(snapshot)
+        return snapshot
+
+    def apply(
+            self,
+            event: dict,
+            copy: Callable[[Any], Any] | None = None,
+            record: Callable[[dict], int] | None = None,
+    ) -> AppliedChange:
+        """Apply an event to the state, preserving what it changes for the snapshots being read.
+
+        Returns the result of the event, ``copy`` of the task or worker it changed, the version it made and
+        the sequence number ``record`` (e.g, a journal's append) returned for it, all taken before the lock
+        is released so that no other change can land in between.
+        """
+        with self.lock:
+            seq = record(event) if record is not None else None
+            uuids, hostnames = self._touched(event)
+            if self._active:
+                self._preserve(uuids, hostnames)
+            result = self.state.event(event)
+            self.version += 1
+            self.changes.record(self.version, uuids, hostnames)
+            self.models.invalidate(self.version, uuids, hostnames)
+            copied = copy(result[0][0]) if copy is not None and result is not None else None
+            return AppliedChange(result, copied, self.version, seq)
+
+    def etag(self, request=None, *args, **kwargs) -> str:
+        """ETag of the current version, usable as the ``etag_func`` of Django's ``condition`` decorator."""
+        return format_etag(self.version)
+
+    @contextmanager
+    def changing(self, uuids: Iterable[str] = (), hostnames: Iterable[str] = ()):
+        """Change the given tasks and workers (e.g, evict them) in the body, as one new version."""
+        with self.lock:
+            uuids, hostnames = list(uuids), list(hostnames)
+            uuids += self._parents(uuids)
+            if self._active:
+                self._preserve(uuids, hostnames)
+            yield
+            self.version += 1
+            self.changes.record(self.version, uuids, hostnames)
+            self.models.invalidate(self.version, uuids, hostnames)
+
+    def _preserve(self, uuids: list[str], hostnames: list[str]) -> None:
+        for snapshot in list(self._active):
+            snapshot._preserve(self.state, uuids, hostnames)
+
+    def _touched(self, event: dict) -> tuple[list[str], list[str]]:
+        """Tasks and workers an event may change, including the ones it may evict from a full state."""
+        tasks, workers = self.state.tasks.data, self.state.workers.data
+        uuids: list[str] = []
+        hostnames: list[str] = []
+        type_ = event.get("type", "")
+        # task-sent events come from clients, not workers
+        if type_ != "task-sent" and (hostname := event.get("hostname")) is not None:
+            hostnames.append(hostname)
+            if hostname not in workers and workers and len(workers) >= self.state.max_workers_in_memory:
+                hostnames.append(next(iter(workers)))
+        if type_.startswith("task-"):
+            uuid = event.get("uuid")
+            task = tasks.get(uuid)
+            uuids.append(uuid)
+            # Its parent's children are updated too
+            uuids.append(event.get("parent_id") or (task.parent_id if task is not None else None))
+            if task is None and tasks and len(tasks) >= self.state.max_tasks_in_memory:
+                evicted = next(iter(tasks))
+                uuids.append(evicted)
+                uuids.extend(self._parents([evicted]))
+        return uuids, hostnames
+
+    def _parents(self, uuids: list[str]) -> list[str]:
+        """Parents of tasks about to be evicted, which lose them from their (weak) children sets."""
+        tasks = self.state.tasks.data
+        return [task.parent_id for task in map(tasks.get, uuids) if task is not None and task.parent_id]
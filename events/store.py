@@ -0,0 +1,235 @@
+import logging
+import sys
+from collections.abc import Iterator
+from itertools import islice
+from weakref import WeakSet
+
+from celery import states
+from celery.events.state import CallableDefaultdict, State, Task as CeleryTask, TASK_EVENT_TO_STATE, Worker
+
+from celery_detect.settings import TaskStoreSettings
+
+logger = logging.getLogger(__name__)
+
+#: Task fields kept by compact tasks; any other event field (pid, utcoffset, hostname...) is dropped.
+STORED_FIELDS = tuple(field for field in CeleryTask._fields if field not in ("children", "root", "parent"))
+#: String fields repeated across many tasks, stored once.
+INTERNED_FIELDS = frozenset(("name", "state", "exchange", "routing_key", "client"))
+#: Task ids referring to other tasks, which share the referred task's uuid string when it is in memory.
+TASK_ID_FIELDS = frozenset(("root_id", "parent_id"))
+TRUNCATION_MARK = "..."
+
+
+def _max_lengths(settings: dict) -> dict[str, int]:
+    return {
+        "args": settings.get("MAX_ARGS_LENGTH", 1024),
+        "kwargs": settings.get("MAX_ARGS_LENGTH", 1024),
+        "result": settings.get("MAX_RESULT_LENGTH", 1024),
+        "exception": settings.get("MAX_RESULT_LENGTH", 1024),
+        "traceback": settings.get("MAX_TRACEBACK_LENGTH", 16 * 1024),
+    }
+
+
+class _NoChildren:
+    """Children of a task that has none yet. The weak set is only allocated when a child is added."""
+
+    __slots__ = ("task",)
+
+    def __init__(self, task: "CompactTask"):
+        self.task = task
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self) -> int:
+        return 0
+
+    def __contains__(self, item) -> bool:
+        return False
+
+    def add(self, child: CeleryTask) -> None:
+        self.task._children = WeakSet((child,))
+
+    def update(self, children) -> None:
+        self.task._children = WeakSet(children)
+
+
+class CompactTask(CeleryTask):
+    """Drop-in replacement for :class:`celery.events.state.Task` with a fraction of its memory.
+
+    Fields live in ``__slots__``, event fields that are not task fields are dropped, repeated
+    strings are interned, long args/kwargs/results/tracebacks are truncated, and the children set
+    is only allocated for tasks that have children. Celery's Task declares a ``__dict__`` slot, so
+    instances still have one, but it is only allocated if something reads it, as no field is stored
+    there.
+    """
+
+    __slots__ = (*STORED_FIELDS, "cluster_state", "_children")
+    max_lengths: dict[str, int] = _max_lengths(TaskStoreSettings)
+
+    def __init__(self, uuid=None, cluster_state=None, children=None, **kwargs):
+        for field in STORED_FIELDS:
+            setattr(self, field, None)
+        self.state = states.PENDING
+        self.clock = 0
+        self.uuid = uuid
+        self.cluster_state = cluster_state
+        self._children = None
+        if children and cluster_state is not None:
+            tasks = cluster_state.tasks
+            self._children = WeakSet(tasks.get(task_id) for task_id in children if task_id in tasks)
+        if kwargs:
+            self._update(kwargs)
+
+    def event(self, type_, timestamp=None, local_received=None, fields=None,
+              precedence=states.precedence, task_event_to_state=TASK_EVENT_TO_STATE.get, RETRY=states.RETRY):
+        fields = fields or {}
+        # Same merge rules as celery's Task.event, only the storage differs
+        state = task_event_to_state(type_)
+        if state is not None:
+            setattr(self, type_, timestamp)
+        else:
+            state = type_.upper()
+
+        if state != RETRY and self.state != RETRY and precedence(state) > precedence(self.state):
+            keep = self.merge_rules.get(state)
+            if keep is not None:
+                fields = {k: v for k, v in fields.items() if k in keep}
+        else:
+            fields.update(state=state, timestamp=timestamp)
+
+        self._update(fields)
+
+    def _update(self, fields: dict) -> None:
+        max_lengths = self.max_lengths
+        for field, value in fields.items():
+            if field not in STORED_FIELDS or field == "uuid":
+                continue
+            if isinstance(value, str):
+                if field in INTERNED_FIELDS:
+                    value = sys.intern(value)
+                elif field in TASK_ID_FIELDS and self.cluster_state is not None:
+                    other = self.cluster_state.tasks.data.get(value)
+                    if other is not None:
+                        value = other.uuid
+                elif field in max_lengths and len(value) > max_lengths[field]:
+                    value = value[:max_lengths[field]] + TRUNCATION_MARK
+            setattr(self, field, value)
+
+    def copy(self) -> "CompactTask":
+        clone = CompactTask.__new__(type(self))
+        for field in self.__slots__:
+            setattr(clone, field, getattr(self, field))
+        if self._children is not None:
+            clone._children = _stored_children(self)
+        return clone
+
+    @property
+    def children(self) -> WeakSet | _NoChildren:
+        return self._children if self._children is not None else _NoChildren(self)
+
+    @property
+    def _serializer_handlers(self) -> dict:
+        return {
+            "children": self._serializable_children,
+            "root": self._serializable_root,
+            "parent": self._serializable_parent,
+        }
+
+    @property
+    def parent(self) -> CeleryTask | None:
+        return self.parent_id and self.cluster_state.tasks.data.get(self.parent_id)
+
+    @property
+    def root(self) -> CeleryTask | None:
+        return self.root_id and self.cluster_state.tasks.data.get(self.root_id)
+
+
+class _NullHeap(list):
+    """Task heap that records nothing, tasks are ordered by their own timestamps instead."""
+
+    def append(self, item) -> None:
+        pass
+
+    def insert(self, index, item) -> None:
+        pass
+
+
+class _NullSet:
+    """Stand-in for the per type/worker weak sets of tasks, which nothing in celery-detect reads."""
+
+    def add(self, item) -> None:
+        pass
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self) -> int:
+        return 0
+
+
+_NULL_SET = _NullSet()
+
+
+class CompactState(State):
+    """Celery's State storing :class:`CompactTask` records, without its per-event heap and per-task indexes.
+
+    ``tasks_by_time`` sorts the stored tasks by timestamp instead of keeping a heap of up to
+    four entries per task, and ``tasks_by_type``/``tasks_by_worker`` scan the stored tasks.
+    """
+
+    Task = CompactTask
+
+    def __init__(self, callback=None, workers=None, tasks=None, taskheap=None, *args, **kwargs):
+        super().__init__(callback, workers, tasks, _NullHeap(), *args, **kwargs)
+        self.tasks_by_type = CallableDefaultdict(self._tasks_by_type, lambda: _NULL_SET)
+        self.tasks_by_worker = CallableDefaultdict(self._tasks_by_worker, lambda: _NULL_SET)
+
+    def rebuild_taskheap(self, *args, **kwargs) -> None:
+        pass
+
+    def tasks_by_time(self, limit=None, reverse: bool = True) -> Iterator[tuple[str, CeleryTask]]:
+        # Not the order of the LRU cache of tasks: celery reads tasks from it without moving them to its end
+        tasks = sorted(self.tasks.data.items(), key=lambda item: item[1].timestamp or 0, reverse=reverse)
+        return islice(tasks, 0, limit)
+
+
+def _stored_children(task: CeleryTask) -> set[CeleryTask]:
+    """Children of a task still in its state, by strong reference: children evicted afterwards remain children of
+    the copy, and evicted children that have not been garbage collected yet are left out."""
+    stored = task.cluster_state.tasks.data if task.cluster_state is not None else None
+    return {child for child in task.children if stored is None or child.uuid in stored}
+
+
+def copy_task(task: CeleryTask) -> CeleryTask:
+    """Copy of a task record that is not affected by events applied to the task afterwards."""
+    if isinstance(task, CompactTask):
+        return task.copy()
+    clone = type(task)(task.uuid, cluster_state=task.cluster_state)
+    clone.__dict__.update(
+        (field, value) for field, value in task.__dict__.items() if field not in ("children", "_serializer_handlers")
+    )
+    clone.children = _stored_children(task)
+    return clone
+
+
+def copy_worker(worker: Worker) -> Worker:
+    """Copy of a worker record that is not affected by events applied to the worker afterwards."""
+    cls, args = worker.__reduce__()
+    clone = cls(*args)
+    clone.__dict__.update(worker.__dict__)
+    clone.heartbeats = list(worker.heartbeats)
+    return clone
+
+
+def stored_tasks(state: State) -> list[CeleryTask]:
+    """Tasks of ``state``, least recently updated first, e.g, to re-track them after the state was cleared or restored.
+
+    Not read from ``tasks_by_time``: ``State.clear`` empties celery's task heap, even of the tasks it keeps.
+    """
+    return sorted(state.tasks.data.values(), key=lambda task: task.timestamp or 0)
+
+
+def create_state(max_tasks_in_memory: int, max_workers_in_memory: int, settings: dict = TaskStoreSettings) -> State:
+    state_cls = CompactState if settings.get("COMPACT") else State
+    return state_cls(max_tasks_in_memory=max_tasks_in_memory, max_workers_in_memory=max_workers_in_memory)
@@ -1,14 +1,16 @@
 import logging
 from abc import ABC, abstractmethod
-from asyncio import CancelledError, Event, Queue, Task as AioTask, create_task
+from asyncio import CancelledError, Event, Task as AioTask, create_task
 from typing import Generic, TypeVar
 
+from events.channel import EventChannel
+
 logger = logging.getLogger(__name__)
 T = TypeVar("T")
 
 
 class QueueSubscriber(Generic[T], ABC):
-    def __init__(self, queue: Queue[T], name: str | None = None):
+    def __init__(self, queue: EventChannel[T], name: str | None = None):
         self.queue = queue
         self.name = name or self.__class__.__name__
         self._stop_signal = Event()
@@ -21,15 +23,21 @@ class QueueSubscriber(Generic[T], ABC):
         logger.info(f"Subscribing to events from {self.name!r}...")
         while not self._stop_signal.is_set():
             try:
-                event = await self.queue.get()
+                events = await self.queue.get_batch()
             except CancelledError:
                 break
             else:
-                logger.debug(f"Received event from {self.name!r}: {event}")
-                try:
-                    await self.handle_event(event)
-                except Exception as e:
-                    logger.exception(f"Failed to handle event: {e}")
+                if not events and self.queue.closed:
+                    break
+                logger.debug(f"Received {len(events)} events from {self.name!r}")
+                await self.handle_batch(events)
+
+    async def handle_batch(self, events: list[T]) -> None:
+        for event in events:
+            try:
+                await self.handle_event(event)
+            except Exception as e:
+                logger.exception(f"Failed to handle event: {e}")
 
     @abstractmethod
     async def handle_event(self, event: T) -> None:
@@ -1,3 +1,854 @@
-from django.test import TestCase
+import asyncio
+import json
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from types import SimpleNamespace
 
-# Create your tests here.
+from channels.layers import InMemoryChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+from celery.events.state import State
+from django.test import SimpleTestCase
+
+from events.bus import EventBusPublisher, EventBusReceiver
+from events.changelog import ChangeLog
+from events.channel import EventChannel, OverflowPolicy
+from events.clusters import ClusterRegistry, UnknownClusterError
+from events.coalescer import HeartbeatCoalescer
+from events.conversion import ConversionCache
+from events.exceptions import ShardUnavailableError
+from events.handler import check_role
+from events.journal import EventJournal
+from events.models import WorkerDetailsType
+from events.poller import WorkerDetailsPoller
+from events.receiver import RetentionSweeper, apply_event, restore_state, snapshots, state
+from events.retention import RetentionEngine, RetentionPolicy
+from events.sharding import ShardPool, shard_of
+from events.snapshot import SnapshotManager
+from events.store import TRUNCATION_MARK, CompactState, CompactTask, copy_task, create_state
+from tasks.index import TaskFilter
+from ws.managers import events_manager
+from ws.subscriptions import SubscriptionFilter
+from ws.websocket_manager import WebsocketManager
+
+
+def task_event(task_id: str, type_: str, **fields) -> dict:
+    now = time.time()
+    return {
+        "type": type_, "uuid": task_id, "name": "tests.add", "hostname": "worker@tests",
+        "timestamp": now, "local_received": now, "clock": 1, **fields,
+    }
+
+
+def worker_event(hostname: str, type_: str, **fields) -> dict:
+    now = time.time()
+    return {
+        "type": type_, "hostname": hostname, "pid": 1000, "freq": 2.0, "sw_ident": "py-celery", "sw_ver": "5.4.0",
+        "sw_sys": "Linux", "active": 0, "processed": 0, "loadavg": [0.0, 0.0, 0.0],
+        "timestamp": now, "local_received": now, "clock": 1, **fields,
+    }
+
+
+class RecordingConnection:
+    """Stands in for a WebSocket consumer, recording the frames sent to it."""
+
+    def __init__(self):
+        self.scope = {"client": ("127.0.0.1", 8000)}
+        self.frames: list[str | bytes] = []
+
+    async def send(self, text_data: str | None = None, bytes_data: bytes | None = None) -> None:
+        self.frames.append(text_data if text_data is not None else bytes_data)
+
+    async def messages(self, count: int) -> list[dict]:
+        async with asyncio.timeout(5):
+            while len(self.frames) < count:
+                await asyncio.sleep(0.001)
+        return [json.loads(frame) for frame in self.frames]
+
+
+class ApplyEventTests(SimpleTestCase):
+    def test_events_carry_a_copy_of_their_entity_as_of_their_version(self):
+        task_id = str(uuid.uuid4())
+        received = apply_event(task_event(task_id, "task-received"))
+        started = apply_event(task_event(task_id, "task-started"))
+
+        self.assertEqual((received.category, received.subject, received.created), ("task", "received", True))
+        self.assertEqual((received.entity.state, started.entity.state), ("RECEIVED", "STARTED"))
+        self.assertIsNot(started.entity, state.tasks[task_id])
+        self.assertLess(received.version, started.version)
+        self.assertLessEqual(started.version, snapshots.version)
+
+    def test_events_are_applied_to_the_state_once(self):
+        hostname = f"worker-{uuid.uuid4().hex}@tests"
+        apply_event(worker_event(hostname, "worker-online"))
+        applied = apply_event(worker_event(hostname, "worker-heartbeat", active=1))
+        parent_id, child_id = str(uuid.uuid4()), str(uuid.uuid4())
+        apply_event(task_event(parent_id, "task-received"))
+        apply_event(task_event(child_id, "task-received", parent_id=parent_id, root_id=parent_id))
+
+        self.assertEqual(applied.entity.active, 1)
+        self.assertEqual(len(state.workers[hostname].heartbeats), 2)
+        self.assertEqual([child.uuid for child in state.tasks[parent_id].children], [child_id])
+
+    def test_events_of_unknown_types_are_not_applied_to_any_entity(self):
+        applied = apply_event({"type": "tests-unknown", "timestamp": time.time(), "clock": 1})
+        self.assertIsNone(applied.entity)
+        self.assertFalse(applied.created)
+
+
+class SnapshotManagerTests(SimpleTestCase):
+    def setUp(self):
+        self.manager = SnapshotManager(State(), ChangeLog(1000))
+        self.tasks = [str(uuid.uuid4()) for _ in range(3)]
+        for task_id in self.tasks[:2]:
+            self.manager.apply(task_event(task_id, "task-received"))
+        self.manager.apply(worker_event("celery@a", "worker-online"))
+
+    def test_snapshots_see_the_state_as_of_their_version(self):
+        snapshot = self.manager.snapshot()
+        first, second, third = self.tasks
+        self.manager.apply(task_event(first, "task-succeeded"))
+        self.manager.apply(task_event(third, "task-received"))
+        with self.manager.changing([second]):
+            del self.manager.state.tasks[second]
+        self.manager.apply(worker_event("celery@b", "worker-online"))
+
+        self.assertEqual([task.state for task in snapshot.get_tasks(self.tasks[:2])], ["RECEIVED", "RECEIVED"])
+        self.assertIsNone(snapshot.get_task(third))
+        self.assertEqual(sorted(snapshot.task_ids()), sorted(self.tasks[:2]))
+        self.assertEqual(sorted(worker.hostname for worker in snapshot.workers()), ["celery@a", "worker@tests"])
+        # New snapshots see the changes
+        self.assertEqual(sorted(self.manager.snapshot().task_ids()), sorted([first, third]))
+
+    def test_tasks_are_read_a_chunk_at_a_time(self):
+        self.manager.apply(task_event(self.tasks[2], "task-received"))
+        chunks = list(self.manager.snapshot().iter_tasks(chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual([task.uuid for chunk in chunks for task in chunk], self.tasks)
+
+    def test_snapshots_hand_out_copies(self):
+        task = self.manager.snapshot().get_task(self.tasks[0])
+        self.assertIsNot(task, self.manager.state.tasks[self.tasks[0]])
+        task.state = "FAILURE"
+        self.assertEqual(self.manager.state.tasks[self.tasks[0]].state, "RECEIVED")
+
+    def test_the_change_log_lists_what_changed_since_a_version(self):
+        version = self.manager.version
+        self.manager.apply(task_event(self.tasks[0], "task-started"))
+        self.manager.apply(worker_event("celery@a", "worker-heartbeat"))
+        with self.manager.changing([self.tasks[1]]):
+            del self.manager.state.tasks[self.tasks[1]]
+
+        changes = self.manager.changes.since(version)
+        self.assertEqual(changes.tasks, [self.tasks[1], self.tasks[0]])
+        # The worker of a task event changes too
+        self.assertEqual(changes.workers, ["celery@a", "worker@tests"])
+        self.assertEqual(self.manager.version, version + 3)
+        self.assertEqual(self.manager.changes.since(self.manager.version).tasks, [])
+
+    def test_changes_older_than_the_change_log_are_unknown(self):
+        manager = SnapshotManager(State(), ChangeLog(2))
+        version = manager.version
+        for task_id in self.tasks:
+            manager.apply(task_event(task_id, "task-received"))
+        self.assertIsNone(manager.changes.since(version))
+
+
+class CompactStateTests(SimpleTestCase):
+    def setUp(self):
+        self.state = CompactState(max_tasks_in_memory=100)
+        self.root_id = str(uuid.uuid4())
+        self.state.event(task_event(self.root_id, "task-received", root_id=self.root_id, pid=1000))
+
+    def child(self, **fields) -> CompactTask:
+        # Ids equal to, but not the same string as, the uuid of the stored root
+        task_id, root_id = str(uuid.uuid4()), "".join(self.root_id)
+        self.state.event(task_event(task_id, "task-received", root_id=root_id, parent_id=root_id, **fields))
+        return self.state.tasks[task_id]
+
+    def test_tasks_keep_their_fields_only(self):
+        task = self.state.tasks[self.root_id]
+        self.assertIsInstance(task, CompactTask)
+        self.assertEqual((task.name, task.state, task.worker.hostname), ("tests.add", "RECEIVED", "worker@tests"))
+        self.assertFalse(hasattr(task, "pid"))
+        self.assertFalse(hasattr(task, "hostname"))
+        self.assertEqual(vars(task), {})
+
+        self.state.event(task_event(self.root_id, "task-succeeded", result="4", runtime=0.5))
+        self.assertEqual((task.state, task.result, task.runtime), ("SUCCESS", "4", 0.5))
+
+    def test_long_values_are_truncated(self):
+        task = self.child(args="x" * 2000, kwargs="{}")
+        self.assertEqual(task.args, "x" * CompactTask.max_lengths["args"] + TRUNCATION_MARK)
+        self.assertEqual(task.kwargs, "{}")
+
+    def test_repeated_strings_are_stored_once(self):
+        first, second = self.child(routing_key="".join("default")), self.child(routing_key="".join("default"))
+        self.assertIs(first.routing_key, second.routing_key)
+        self.assertIs(first.root_id, self.root_id)
+        self.assertIs(first.parent, self.state.tasks[self.root_id])
+        self.assertEqual(set(self.state.tasks[self.root_id].children), {first, second})
+
+    def test_children_are_only_allocated_for_tasks_that_have_children(self):
+        child = self.child()
+        self.assertIsNone(child._children)
+        self.assertEqual((len(child.children), list(child.children)), (0, []))
+        self.assertIsNotNone(self.state.tasks[self.root_id]._children)
+
+    def test_tasks_are_listed_most_recently_updated_first(self):
+        child = self.child()
+        self.state.event(task_event(self.root_id, "task-started", timestamp=child.timestamp + 1))
+        self.assertEqual([task_id for task_id, _ in self.state.tasks_by_time()], [self.root_id, child.uuid])
+        self.assertEqual(
+            [task_id for task_id, _ in self.state.tasks_by_time(reverse=False)], [child.uuid, self.root_id],
+        )
+        self.assertEqual(len(self.state._taskheap), 0)
+
+    def test_copies_are_not_affected_by_later_events(self):
+        child = self.child()
+        copy = copy_task(self.state.tasks[self.root_id])
+        self.state.event(task_event(self.root_id, "task-succeeded"))
+        self.assertEqual((copy.state, set(copy.children)), ("RECEIVED", {child}))
+        self.assertEqual(self.state.tasks[self.root_id].state, "SUCCESS")
+
+    def test_the_compact_store_is_opt_in(self):
+        self.assertIsInstance(create_state(10, 10, {"COMPACT": True}), CompactState)
+        self.assertNotIsInstance(create_state(10, 10, {}), CompactState)
+
+
+class HeartbeatCoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.hostnames = [f"worker-{uuid.uuid4().hex}@tests" for _ in range(2)]
+        for hostname in self.hostnames:
+            apply_event(worker_event(hostname, "worker-online"))
+        self.coalescer = HeartbeatCoalescer(window=60)
+
+    def subscribe(self, subscription: SubscriptionFilter | None = None) -> RecordingConnection:
+        connection = RecordingConnection()
+        events_manager.subscribe(connection)
+        self.addCleanup(events_manager.unsubscribe, connection)
+        if subscription is not None:
+            events_manager.set_filter(connection, subscription)
+        return connection
+
+    def heartbeat(self, hostname: str, active: int) -> None:
+        self.coalescer.add(apply_event(worker_event(hostname, "worker-heartbeat", active=active)))
+
+    async def test_heartbeats_are_merged_into_the_latest_state_of_each_worker(self):
+        connection = self.subscribe()
+        self.heartbeat(self.hostnames[0], active=1)
+        self.heartbeat(self.hostnames[1], active=1)
+        self.heartbeat(self.hostnames[0], active=2)
+        await self.coalescer.flush()
+        await self.coalescer.flush()
+
+        [message] = await connection.messages(1)
+        self.assertEqual(message["type"], "workers-changed")
+        self.assertEqual(
+            [(worker["hostname"], worker["active_tasks"]) for worker in message["data"]],
+            [(self.hostnames[0], 2), (self.hostnames[1], 1)],
+        )
+
+    async def test_discarded_heartbeats_are_not_broadcast(self):
+        connection = self.subscribe()
+        self.heartbeat(self.hostnames[0], active=1)
+        self.coalescer.discard(self.hostnames[0])
+        await self.coalescer.flush()
+        await asyncio.sleep(0.01)
+        self.assertEqual(connection.frames, [])
+
+    async def test_clients_only_receive_the_workers_they_subscribed_to(self):
+        everything = self.subscribe()
+        filtered = self.subscribe(SubscriptionFilter(workers=[self.hostnames[1]]))
+        self.heartbeat(self.hostnames[0], active=1)
+        self.heartbeat(self.hostnames[1], active=1)
+        await self.coalescer.flush()
+
+        [message] = await filtered.messages(1)
+        self.assertEqual([worker["hostname"] for worker in message["data"]], [self.hostnames[1]])
+        [message] = await everything.messages(1)
+        self.assertEqual([worker["hostname"] for worker in message["data"]], self.hostnames)
+
+
+class FakeGateway:
+    """Answers inspect requests with ``replies[command]``, whatever the cluster."""
+
+    def __init__(self):
+        self.replies: dict[str, dict] = {}
+
+    async def inspect(self, command: str, worker: str | None = None, cluster: str = "default") -> dict:
+        return self.replies[command]
+
+
+class WorkerDetailsPollerTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = FakeGateway()
+        self.gateway.replies["active_queues"] = {"celery@a": [{"name": "default"}]}
+        self.manager = WebsocketManager("Tests")
+        self.poller = WorkerDetailsPoller(
+            intervals={"active_queues": 2.0}, idle_interval=60.0, max_backoff=4.0, gateway=self.gateway,
+            manager=self.manager, registry=[SimpleNamespace(id="default")],
+        )
+
+    def subscribe(self) -> RecordingConnection:
+        connection = RecordingConnection()
+        self.manager.subscribe(connection)
+        self.addCleanup(self.manager.unsubscribe, connection)
+        return connection
+
+    async def test_the_interval_backs_off_while_replies_do_not_change(self):
+        self.subscribe()
+        intervals = []
+        for _ in range(4):
+            await self.poller.poll(["active_queues"])
+            intervals.append(self.poller.interval("active_queues"))
+        self.assertEqual(intervals, [2.0, 4.0, 8.0, 8.0])
+
+        self.gateway.replies["active_queues"] = {"celery@a": [{"name": "default"}, {"name": "high"}]}
+        await self.poller.poll(["active_queues"])
+        self.assertEqual(self.poller.interval("active_queues"), 2.0)
+
+    async def test_commands_are_polled_at_the_idle_interval_without_clients(self):
+        await self.poller.poll(["active_queues"])
+        self.assertEqual(self.poller.interval("active_queues"), 60.0)
+
+    async def test_only_changed_replies_are_pushed(self):
+        connection = self.subscribe()
+        await self.poller.poll(["active_queues"])
+        await self.poller.poll(["active_queues"])
+        self.gateway.replies["active_queues"] = {}
+        await self.poller.poll(["active_queues"])
+
+        changed, stopped = await connection.messages(2)
+        self.assertEqual((changed["type"], changed["hostname"]), (WorkerDetailsType.QUEUES.value, "celery@a"))
+        self.assertEqual([queue["name"] for queue in changed["data"]], ["default"])
+        # Workers that stop replying are pushed with no details
+        self.assertEqual((stopped["hostname"], stopped["data"]), ("celery@a", None))
+
+    async def test_new_clients_get_the_latest_details_of_every_worker(self):
+        await self.poller.poll(["active_queues"])
+        connection = self.subscribe()
+        self.poller.send_snapshot(connection)
+
+        [message] = await connection.messages(1)
+        self.assertEqual((message["hostname"], message["data"][0]["name"]), ("celery@a", "default"))
+
+    def test_unknown_commands_are_rejected(self):
+        with self.assertRaises(ValueError):
+            WorkerDetailsPoller(intervals={"shutdown": 1.0}, gateway=self.gateway, manager=self.manager)
+
+
+class EventChannelTests(SimpleTestCase):
+    async def test_items_are_handed_over_in_batches_in_order(self):
+        channel = EventChannel(batch_window=0)
+        channel.put(1)
+        channel.put_many([2, 3])
+        self.assertEqual(await channel.get_batch(), [1, 2, 3])
+        channel.put(4)
+        self.assertEqual(await channel.get_batch(), [4])
+        self.assertEqual((channel.stats().received, channel.stats().batches), (4, 2))
+
+    async def test_drop_oldest_drops_the_oldest_pending_items(self):
+        channel = EventChannel(max_size=3, overflow=OverflowPolicy.DROP_OLDEST, batch_window=0)
+        channel.put_many(range(5))
+        self.assertEqual(await channel.get_batch(), [2, 3, 4])
+        self.assertEqual(channel.stats().dropped, 2)
+
+    async def test_coalesce_replaces_pending_items_of_the_same_key_once_full(self):
+        channel = EventChannel(max_size=3, overflow=OverflowPolicy.COALESCE, batch_window=0, key=lambda item: item[0])
+        channel.put_many([("a", 1), ("a", 2), ("b", 1)])
+        channel.put(("a", 3))
+        channel.put(("c", 1))
+        self.assertEqual(await channel.get_batch(), [("b", 1), ("a", 3), ("c", 1)])
+        self.assertEqual((channel.stats().coalesced, channel.stats().dropped), (1, 1))
+
+    async def test_coalesce_keeps_every_item_below_max_size(self):
+        channel = EventChannel(max_size=10, overflow=OverflowPolicy.COALESCE, batch_window=0, key=lambda item: item[0])
+        channel.put_many([("a", 1), ("a", 2), ("b", 1)])
+        self.assertEqual(await channel.get_batch(), [("a", 1), ("a", 2), ("b", 1)])
+        self.assertEqual(channel.stats().coalesced, 0)
+
+    async def test_block_makes_the_producer_wait_for_the_consumer(self):
+        channel = EventChannel(max_size=2, overflow=OverflowPolicy.BLOCK, batch_window=0)
+        channel.put_many([1, 2])
+        producer = threading.Thread(target=channel.put, args=(3,))
+        producer.start()
+        while not channel.stats().blocked:
+            await asyncio.sleep(0.01)
+        self.assertEqual(await channel.get_batch(), [1, 2])
+        await asyncio.to_thread(producer.join, 5)
+        self.assertEqual(await channel.get_batch(), [3])
+        self.assertEqual(channel.stats().dropped, 0)
+
+    async def test_closing_wakes_up_the_consumer(self):
+        channel = EventChannel(batch_window=0)
+        consumer = asyncio.create_task(channel.get_batch())
+        await asyncio.sleep(0)
+        channel.close()
+        self.assertEqual(await asyncio.wait_for(consumer, timeout=5), [])
+        channel.put(1)
+        self.assertEqual(len(channel), 0)
+
+
+class EventBusTests(SimpleTestCase):
+    """Publisher to replica round trips over the in-memory channel layer, standing in for Redis."""
+
+    def setUp(self):
+        self.layer = InMemoryChannelLayer()
+        self.group = f"tests.{uuid.uuid4().hex}"
+
+    async def receive(self, receiver: EventBusReceiver) -> None:
+        message = await asyncio.wait_for(self.layer.receive(receiver.channel), timeout=5)
+        receiver.handle_message(message)
+
+    async def test_published_events_are_applied_by_replicas(self):
+        publisher = EventBusPublisher(EventChannel(), group=self.group, layer=self.layer)
+        replica = EventBusReceiver(EventChannel(), group=self.group, layer=self.layer)
+        await replica.subscribe()
+        task_id = str(uuid.uuid4())
+
+        publisher.start()
+        publisher.queue.put((None, task_event(task_id, "task-received")))
+        publisher.queue.put((None, task_event(task_id, "task-started")))
+        await self.receive(replica)
+        publisher.stop()
+        await replica.stop()
+
+        applied = await replica.queue.get_batch()
+        self.assertEqual([event.subject for event in applied], ["received", "started"])
+        self.assertEqual(state.tasks[task_id].state, "STARTED")
+        self.assertEqual((replica.last_seq, replica.gaps), (1, 0))
+
+    async def test_replica_skips_events_restored_from_the_journal(self):
+        publisher = EventBusPublisher(EventChannel(), group=self.group, layer=self.layer)
+        replica = EventBusReceiver(EventChannel(), group=self.group, layer=self.layer)
+        # The replica joins the bus before restoring, so the journaled events are buffered on the bus too
+        await replica.subscribe()
+        task_id = str(uuid.uuid4())
+        events = [task_event(task_id, type_) for type_ in ("task-received", "task-started", "task-succeeded")]
+
+        with tempfile.TemporaryDirectory() as path:
+            journal = EventJournal(path)
+            journal.start()
+            journaled = [(journal.append(event), event) for event in events[:2]]
+            await publisher.handle_batch(journaled)
+            journal.close()
+
+            await asyncio.to_thread(restore_state, EventJournal(path))
+            replica.journal_seq = journal.seq
+            await publisher.handle_batch([(journal.seq + 1, events[2])])
+            await self.receive(replica)
+            await self.receive(replica)
+        await replica.stop()
+
+        applied = await replica.queue.get_batch()
+        self.assertEqual([event.subject for event in applied], ["succeeded"])
+        self.assertEqual((replica.received, replica.skipped, replica.gaps), (3, 2, 0))
+        self.assertEqual(state.tasks[task_id].state, "SUCCESS")
+
+
+class EventJournalTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.task_ids = [str(uuid.uuid4()) for _ in range(3)]
+
+    def journal(self, **kwargs) -> EventJournal:
+        journal = EventJournal(self.path, **kwargs)
+        self.addCleanup(journal.close)
+        return journal
+
+    def record(self, journal: EventJournal, state_: State, event: dict) -> None:
+        journal.append(event)
+        state_.event(event)
+
+    def test_restore_replays_the_events_clears_and_evictions(self):
+        journal, live = self.journal(), State()
+        first, second, third = self.task_ids
+        for task_id in self.task_ids:
+            self.record(journal, live, task_event(task_id, "task-received"))
+        self.record(journal, live, task_event(second, "task-succeeded"))
+        journal.record_evictions([first])
+        journal.record_clear(ready=True)
+        journal.close()
+
+        restored = State()
+        self.assertEqual(self.journal().restore(restored), 6)
+        # The evicted task is gone, and the clear only removed the finished one
+        self.assertEqual(set(restored.tasks), {third})
+        self.assertEqual(restored.tasks[third].state, "RECEIVED")
+
+    def test_restore_starts_from_the_latest_snapshot(self):
+        journal, live = self.journal(), State()
+        first, second, _ = self.task_ids
+        self.record(journal, live, task_event(first, "task-received"))
+        self.record(journal, live, task_event(second, "task-received"))
+        journal.snapshot(live)
+        self.record(journal, live, task_event(first, "task-succeeded"))
+        journal.close()
+
+        restored, reopened = State(), self.journal()
+        self.assertEqual(reopened.restore(restored), 1)
+        self.assertEqual(reopened.seq, 3)
+        self.assertEqual({task_id: task.state for task_id, task in restored.tasks.items()}, {
+            first: "SUCCESS", second: "RECEIVED",
+        })
+
+    def test_events_are_replayed_across_segments_in_order(self):
+        journal, live = self.journal(segment_size=1), State()
+        task_id = self.task_ids[0]
+        for type_ in ("task-received", "task-started", "task-succeeded"):
+            self.record(journal, live, task_event(task_id, type_))
+        journal.close()
+        self.assertEqual(len(journal.segments()), 3)
+
+        restored = State()
+        self.assertEqual(self.journal().restore(restored), 3)
+        self.assertEqual(restored.tasks[task_id].state, "SUCCESS")
+
+    def test_a_torn_record_at_the_tail_is_skipped(self):
+        journal, live = self.journal(), State()
+        self.record(journal, live, task_event(self.task_ids[0], "task-received"))
+        journal.close()
+        with journal.segments()[-1].open("ab") as f:
+            f.write(b'{"type": "task-start')
+
+        restored, reopened = State(), self.journal()
+        self.assertEqual(reopened.restore(restored), 1)
+        self.assertEqual(list(restored.tasks), [self.task_ids[0]])
+        # Later events go to a new segment, and are replayed after the last complete record
+        self.assertEqual(reopened.append(task_event(self.task_ids[1], "task-received")), 2)
+        reopened.close()
+        restored = State()
+        self.assertEqual(self.journal().restore(restored), 2)
+        self.assertEqual(set(restored.tasks), set(self.task_ids[:2]))
+
+
+class RetentionEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.state = State()
+        self.engine = RetentionEngine(contains=self.state.tasks.__contains__, size=lambda: len(self.state.tasks))
+        self.now = time.time()
+        self.tasks: list[str] = []
+
+    def task(self, type_: str = "task-succeeded", name: str = "tests.add", at: float = 0.0) -> list[str]:
+        """Apply an event to a new task, ``at`` seconds from now, returning the tasks the engine evicts."""
+        task_id = str(uuid.uuid4())
+        self.state.event(task_event(task_id, "task-received", name=name))
+        if type_ != "task-received":
+            self.state.event(task_event(task_id, type_, name=name))
+        self.tasks.append(task_id)
+        return self.engine.update(self.state.tasks[task_id], now=self.now + at)
+
+    def test_state_quotas_evict_the_oldest_tasks_of_the_state(self):
+        self.engine.policy = RetentionPolicy(state_quotas={"SUCCESS": 2})
+        self.assertEqual([self.task() for _ in range(3)], [[], [], [self.tasks[0]]])
+        self.assertEqual(self.task("task-received"), [])
+        self.assertEqual(self.engine.stats().evicted["state-quota"], 1)
+
+    def test_type_quotas_apply_to_every_type_without_a_quota_of_its_own(self):
+        self.engine.policy = RetentionPolicy(type_quotas={"tests.add": 2}, default_type_quota=1)
+        self.assertEqual([self.task(name="tests.add") for _ in range(2)], [[], []])
+        self.assertEqual(self.task(name="tests.mul"), [])
+        self.assertEqual(self.task(name="tests.mul"), [self.tasks[2]])
+        self.assertEqual(self.task(name="tests.add"), [self.tasks[0]])
+
+    def test_tasks_expire_once_the_ttl_of_their_state_runs_out(self):
+        self.engine.policy = RetentionPolicy(ttl={"SUCCESS": 60})
+        self.task()
+        self.task("task-received")
+        self.task(at=30)
+        self.assertEqual(self.engine.expire(self.now + 59), [])
+        self.assertEqual(self.engine.expire(self.now + 61), [self.tasks[0]])
+        # Tasks are also expired when the events of other tasks are tracked
+        self.assertEqual(self.task(at=91), [self.tasks[2]])
+        self.assertEqual(self.engine.stats().evicted["ttl"], 2)
+
+    def test_a_new_policy_applies_to_the_tracked_tasks_right_away(self):
+        for _ in range(3):
+            self.task()
+        self.assertEqual(self.engine.set_policy(RetentionPolicy(state_quotas={"SUCCESS": 1})), self.tasks[:2])
+
+    def test_tasks_evicted_from_the_state_are_not_evicted_again(self):
+        self.engine.policy = RetentionPolicy(state_quotas={"SUCCESS": 1})
+        self.task()
+        del self.state.tasks[self.tasks[0]]
+        self.task()
+        self.assertEqual(self.task(), [self.tasks[1]])
+
+
+class RetentionSweeperTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = ClusterRegistry(["other"], default="main")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = EventJournal(directory.name)
+        self.addCleanup(self.journal.close)
+
+    def expired_task(self, cluster) -> str:
+        """A task of ``cluster`` whose TTL ran out an hour ago."""
+        task_id = str(uuid.uuid4())
+        for type_ in ("task-received", "task-succeeded"):
+            cluster.snapshots.apply(task_event(task_id, type_))
+        task = cluster.state.tasks[task_id]
+        cluster.index.update(task)
+        cluster.retention.set_policy(RetentionPolicy(ttl={"SUCCESS": 60}))
+        cluster.retention.update(task, now=time.time() - 3600)
+        return task_id
+
+    def test_expired_tasks_of_every_cluster_are_evicted(self):
+        tasks = {cluster.id: self.expired_task(cluster) for cluster in self.registry}
+        RetentionSweeper(60, registry=self.registry, journal=self.journal).sweep()
+
+        for cluster in self.registry:
+            self.assertNotIn(tasks[cluster.id], cluster.state.tasks)
+            self.assertEqual(len(cluster.index), 0)
+        # Only the events of the default cluster are journaled, so only its evictions are recorded
+        self.assertEqual(self.journal.seq, 1)
+
+    def test_the_sweeper_is_disabled_without_an_interval(self):
+        self.assertIsNone(RetentionSweeper.from_settings({"SWEEP_INTERVAL": None}))
+        self.assertEqual(RetentionSweeper.from_settings({"SWEEP_INTERVAL": 5.0}, registry=self.registry).interval, 5.0)
+
+
+class ClusterRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = ClusterRegistry(["other"], default="main")
+        self.main, self.other = self.registry.clusters["main"], self.registry.clusters["other"]
+
+    def task(self, cluster, *types: str) -> str:
+        task_id = str(uuid.uuid4())
+        for type_ in types:
+            cluster.snapshots.apply(task_event(task_id, type_))
+        cluster.index.update(cluster.state.tasks[task_id])
+        return task_id
+
+    def test_events_are_routed_to_the_cluster_they_are_tagged_with(self):
+        self.assertIs(self.registry.get(None), self.main)
+        self.assertIs(self.registry.get("other"), self.other)
+        with self.assertRaises(UnknownClusterError):
+            self.registry.get("unknown")
+        self.assertEqual(self.registry.select(), [self.main, self.other])
+        self.assertEqual(self.registry.select("other"), [self.other])
+
+    def test_clusters_keep_states_and_versions_of_their_own(self):
+        version = self.main.snapshots.version
+        task_id = self.task(self.other, "task-received")
+        self.assertEqual(len(self.main.state.tasks), 0)
+        self.assertEqual(self.main.snapshots.version, version)
+        self.assertEqual(self.other.state.tasks[task_id].cluster_state.cluster, "other")
+
+    def test_snapshots_of_every_cluster_are_read_as_one(self):
+        tasks = [self.task(self.main, "task-received"), self.task(self.other, "task-received")]
+        snapshot = self.registry.snapshot()
+        self.assertIsNone(snapshot.version)
+        self.assertEqual([task.uuid for task in snapshot.get_tasks(tasks)], tasks)
+        self.assertEqual(sorted(task.uuid for chunk in snapshot.iter_tasks() for task in chunk), sorted(tasks))
+
+        etag = self.registry.etag()
+        self.task(self.other, "task-received")
+        self.assertNotEqual(self.registry.etag(), etag)
+        self.assertEqual(self.registry.snapshot("main").etag, self.registry.etag("main"))
+
+    def test_clearing_a_cluster_keeps_its_unfinished_tasks_and_the_other_clusters(self):
+        running = self.task(self.main, "task-received", "task-started")
+        finished = self.task(self.main, "task-received", "task-succeeded")
+        other = self.task(self.other, "task-received", "task-succeeded")
+        with tempfile.TemporaryDirectory() as path:
+            journal = EventJournal(path)
+            self.main.clear(ready=True, journal=journal)
+            journal.close()
+            self.assertEqual(journal.seq, 1)
+
+        self.assertEqual(list(self.main.state.tasks), [running])
+        self.assertEqual([task.uuid for task in self.main.index.query(self.main.state.tasks.get).tasks], [running])
+        self.assertNotIn(finished, self.main.snapshots.snapshot().task_ids())
+        self.assertIn(other, self.other.state.tasks)
+
+        self.main.clear(ready=False)
+        self.assertEqual(len(self.main.state.tasks), 0)
+        self.assertEqual(len(self.main.index), 0)
+
+
+class ConversionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.snapshots = SnapshotManager(State(), ChangeLog(100))
+        self.models = self.snapshots.models
+        self.task_id = str(uuid.uuid4())
+        self.snapshots.apply(task_event(self.task_id, "task-received"))
+
+    @property
+    def task(self):
+        return self.snapshots.state.tasks[self.task_id]
+
+    def test_models_are_converted_once_per_change(self):
+        converted = self.models.task(self.task)
+        self.assertIs(self.models.task(self.task), converted)
+        self.assertIs(converted.json, converted.json)
+        self.assertEqual(json.loads(converted.json)["state"], "RECEIVED")
+
+        self.snapshots.apply(task_event(self.task_id, "task-started"))
+        self.assertEqual(self.models.task(self.task).model.state, "STARTED")
+        self.assertIs(self.models.task(self.task), self.models.task(self.task))
+
+    def test_records_of_snapshots_taken_before_their_last_change_are_not_cached(self):
+        snapshot = self.snapshots.snapshot()
+        self.snapshots.apply(task_event(self.task_id, "task-started"))
+
+        stale = snapshot.convert_task(snapshot.get_task(self.task_id))
+        self.assertEqual(stale.model.state, "RECEIVED")
+        self.assertIsNot(snapshot.convert_task(snapshot.get_task(self.task_id)), stale)
+        self.assertEqual(len(self.models), 0)
+        self.assertEqual(self.snapshots.snapshot().convert_task(self.task).model.state, "STARTED")
+        self.assertEqual(len(self.models), 1)
+
+    def test_evicted_records_are_dropped_and_not_cached(self):
+        self.snapshots.apply(worker_event("worker@tests", "worker-heartbeat"))
+        task = self.task
+        self.models.task(task)
+        self.models.worker(self.snapshots.state.workers["worker@tests"])
+        self.assertEqual(len(self.models), 2)
+
+        with self.snapshots.changing(uuids=[self.task_id]):
+            del self.snapshots.state.tasks[self.task_id]
+        self.assertEqual(len(self.models), 1)
+        self.assertEqual(self.models.task(task).model.id, self.task_id)
+        self.assertEqual(len(self.models), 1)
+
+    def test_the_least_recently_read_models_are_dropped(self):
+        models = ConversionCache(self.snapshots.state, max_entries=2)
+        task_ids = [self.task_id] + [str(uuid.uuid4()) for _ in range(2)]
+        for task_id in task_ids[1:]:
+            self.snapshots.apply(task_event(task_id, "task-received"))
+        tasks = [self.snapshots.state.tasks[task_id] for task_id in task_ids]
+
+        first = models.task(tasks[0])
+        second = models.task(tasks[1])
+        self.assertIs(models.task(tasks[0]), first)
+        models.task(tasks[2])
+        self.assertEqual(len(models), 2)
+        self.assertIs(models.task(tasks[0]), first)
+        self.assertIsNot(models.task(tasks[1]), second)
+
+    def test_nothing_is_cached_without_entries(self):
+        models = ConversionCache(self.snapshots.state, max_entries=0)
+        self.assertIsNot(models.task(self.task), models.task(self.task))
+        self.assertEqual(len(models), 0)
+
+
+class ShardPoolTests(SimpleTestCase):
+    def pool(self, shards: int = 2, **kwargs) -> ShardPool:
+        """A pool whose shards are in-process queues, answered by ``answer`` if given rather than by processes."""
+        answer = kwargs.pop("answer", None)
+        pool = ShardPool(shards, query_timeout=kwargs.pop("query_timeout", 0.05), **kwargs)
+        pool._inboxes = [queue.Queue(pool.inbox_size) for _ in range(shards)]
+        pool._outbox = queue.Queue()
+        collector = threading.Thread(target=pool._collect)
+        collector.start()
+        self.addCleanup(collector.join)
+        self.addCleanup(pool._outbox.put, None)
+        if answer is not None:
+            for index, inbox in enumerate(pool._inboxes):
+                thread = threading.Thread(target=self.run_shard, args=(index, inbox, pool._outbox, answer))
+                thread.start()
+                self.addCleanup(thread.join)
+                self.addCleanup(inbox.put, None)
+        return pool
+
+    @staticmethod
+    def run_shard(index: int, inbox: queue.Queue, outbox: queue.Queue, answer) -> None:
+        while (message := inbox.get()) is not None:
+            kind, payload = message
+            if kind != "events":
+                request_id, args = payload
+                outbox.put(("reply", request_id, answer(index, kind, *args)))
+
+    def uuid_of_shard(self, shard: int, shards: int = 2) -> str:
+        while shard_of(task_id := str(uuid.uuid4()), shards) != shard:
+            pass
+        return task_id
+
+    def test_task_events_follow_the_shard_of_their_workflow_root(self):
+        pool = ShardPool(4)
+        root_id, child_id = str(uuid.uuid4()), str(uuid.uuid4())
+        shard = shard_of(root_id, 4)
+        self.assertEqual(pool.route(task_event(root_id, "task-received", root_id=root_id)), shard)
+        self.assertEqual(pool.route(task_event(child_id, "task-received", root_id=root_id)), shard)
+        # Later events of a task do not carry its root id
+        self.assertEqual(pool.route(task_event(child_id, "task-succeeded")), shard)
+        self.assertEqual(pool.task_shard(child_id), shard)
+        self.assertEqual(pool.route(worker_event("celery@a", "worker-heartbeat")), shard_of("celery@a", 4))
+
+        pool._forget_routes([child_id])
+        self.assertEqual(pool.task_shard(child_id), shard_of(child_id, 4))
+
+    def test_routes_are_forgotten_once_the_shard_evicts_the_task(self):
+        pool = self.pool()
+        child_id = str(uuid.uuid4())
+        pool.route(task_event(child_id, "task-received", root_id=str(uuid.uuid4())))
+        pool._outbox.put(("evicted", 0, [child_id]))
+        deadline = time.monotonic() + 5
+        while pool.routes and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(pool.routes, {})
+
+    def test_events_are_sent_to_their_shard_in_batches(self):
+        pool = self.pool(batch_size=2)
+        shard = shard_of("celery@a", 2)
+        events = [worker_event("celery@a", "worker-heartbeat", active=active) for active in range(3)]
+        for event in events:
+            pool.put(event)
+        pool.flush()
+        inbox = pool._inboxes[shard]
+        self.assertEqual([inbox.get_nowait(), inbox.get_nowait()], [("events", events[:2]), ("events", events[2:])])
+        self.assertTrue(pool._inboxes[1 - shard].empty())
+
+    def test_the_oldest_pending_events_are_dropped_once_the_inbox_is_full(self):
+        pool = self.pool(batch_size=1, inbox_size=1, max_pending=3)
+        events = [worker_event("celery@a", "worker-heartbeat", active=active) for active in range(5)]
+        with self.assertLogs("events.sharding", "WARNING"):
+            for event in events:
+                pool.put(event)
+        self.assertEqual(pool.dropped, 1)
+
+        inbox = pool._inboxes[shard_of("celery@a", 2)]
+        self.assertEqual(inbox.get_nowait(), ("events", events[:1]))
+        pool.flush()
+        self.assertEqual(inbox.get_nowait(), ("events", events[2:]))
+
+    def test_queries_to_a_full_inbox_fail(self):
+        pool = self.pool(inbox_size=1)
+        pool._inboxes[0].put(("events", []))
+        with self.assertRaises(ShardUnavailableError):
+            pool.query(0, "summary")
+        self.assertEqual(pool._requests, {})
+
+    def test_shards_that_do_not_answer_in_time_are_reported(self):
+        pool = self.pool()
+        with self.assertRaisesRegex(ShardUnavailableError, "State shard 0, 1 did not answer 'summary'"):
+            pool.gather("summary")
+        self.assertEqual(pool._requests, {})
+
+    def test_pages_of_every_shard_are_merged_by_last_update(self):
+        def answer(shard, name, filters, limit):
+            items = [(seq, f"{shard}-{seq}".encode()) for seq in range(10 + shard, 0, -2)][:limit]
+            return 5, items
+
+        pool = self.pool(answer=answer)
+        self.assertEqual(pool.tasks(TaskFilter(), limit=3, offset=1), ([b"0-10", b"1-9", b"0-8"], 10))
+
+    def test_tasks_are_looked_up_in_every_shard_once_their_route_is_forgotten(self):
+        task_id = self.uuid_of_shard(0)
+        pool = self.pool(answer=lambda shard, name, uuid: b"{}" if shard == 1 and uuid == task_id else None)
+        self.assertEqual(pool.task(task_id), b"{}")
+        self.assertIsNone(pool.task(self.uuid_of_shard(1)))
+
+
+class RoleTests(SimpleTestCase):
+    def test_unknown_role_is_rejected(self):
+        check_role("replica")
+        with self.assertRaises(ImproperlyConfigured):
+            check_role("replicas")
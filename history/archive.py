@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from typing import Self
+
+from celery.events.state import Task as CeleryTask
+
+from celery_detect.settings import CELERY_DETECT_ROLE, TaskArchiveSettings
+from tasks.models import Task
+
+logger = logging.getLogger(__name__)
+
+UPDATE_FIELDS = ["type", "state", "worker", "root_id", "sent_at", "last_updated", "data"]
+
+
+class TaskArchive(threading.Thread):
+    """Background writer persisting task snapshots to the database in batched upserts.
+
+    The ingestion thread only records which tasks changed. Every ``flush_interval`` seconds the
+    writer converts the latest state of each changed task and upserts them with ``bulk_create``,
+    so a task updated many times between flushes costs a single row write.
+    """
+
+    def __init__(self, batch_size: int = 1000, flush_interval: float = 1.0, max_pending: int = 100_000):
+        super().__init__(name="TaskArchive", daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: dict[str, CeleryTask] = {}
+        self._lock = threading.Lock()
+        self._stop_signal = threading.Event()
+        self.written = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict = TaskArchiveSettings) -> Self | None:
+        # Replicas see the same events as the ingest process, which archives them once
+        if not settings.get("ENABLED") or CELERY_DETECT_ROLE == "replica":
+            return None
+        return cls(
+            batch_size=settings.get("BATCH_SIZE", 1000),
+            flush_interval=settings.get("FLUSH_INTERVAL", 1.0),
+            max_pending=settings.get("MAX_PENDING", 100_000),
+        )
+
+    def put(self, task: CeleryTask) -> None:
+        with self._lock:
+            if task.uuid not in self._pending and len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending[task.uuid] = task
+
+    def run(self) -> None:
+        logger.info("Starting task archive writer...")
+        while not self._stop_signal.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        from django.db import close_old_connections
+
+        started = time.monotonic()
+        tasks = list(pending.values())
+        try:
+            for i in range(0, len(tasks), self.batch_size):
+                self._write(tasks[i:i + self.batch_size])
+        except Exception as e:
+            logger.exception(f"Failed to archive {len(tasks)} tasks: {e}")
+        finally:
+            close_old_connections()
+        logger.debug(f"Archived {len(tasks)} tasks in {time.monotonic() - started:.3f}s")
+
+    def _write(self, tasks: list[CeleryTask]) -> None:
+        from django.db import connection
+
+        from history.models import ArchivedTask
+
+        rows = []
+        for celery_task in tasks:
+            try:
+                task = Task.from_celery_task(celery_task)
+            except Exception as e:
+                logger.warning(f"Failed to convert task {celery_task.uuid!r} for archiving: {e}")
+                continue
+            rows.append(ArchivedTask(
+                task_id=task.id,
+                type=task.type,
+                state=task.state.value,
+                worker=celery_task.worker.hostname if celery_task.worker is not None else None,
+                root_id=task.root_id,
+                sent_at=task.sent_at,
+                last_updated=task.last_updated,
+                data=task.model_dump(mode="json"),
+            ))
+
+        # MySQL upserts on any unique key and does not accept a conflict target
+        unique_fields = ["task_id"] if connection.features.supports_update_conflicts_with_target else None
+        ArchivedTask.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=UPDATE_FIELDS,
+        )
+        self.written += len(rows)
+
+    def stop(self) -> None:
+        logger.info("Stopping task archive writer...")
+        self._stop_signal.set()
+        self.join()
+
+
+task_archive = TaskArchive.from_settings()
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(max_length=255, null=True)),
+                ('state', models.CharField(max_length=16)),
+                ('worker', models.CharField(max_length=255, null=True)),
+                ('root_id', models.CharField(max_length=255, null=True)),
+                ('sent_at', models.FloatField()),
+                ('last_updated', models.FloatField()),
+                ('data', models.JSONField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sent_at', 'id'], name='archived_task_sent_at'), models.Index(fields=['state', 'sent_at', 'id'], name='archived_task_state'), models.Index(fields=['type', 'sent_at', 'id'], name='archived_task_type'), models.Index(fields=['worker', 'sent_at', 'id'], name='archived_task_worker'), models.Index(fields=['root_id', 'sent_at', 'id'], name='archived_task_root_id')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import models
+
+
+class ArchivedTask(models.Model):
+    """Latest known snapshot of a task, kept after it is evicted from the in-memory state."""
+    task_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255, null=True)
+    state = models.CharField(max_length=16)
+    worker = models.CharField(max_length=255, null=True)
+    root_id = models.CharField(max_length=255, null=True)
+    sent_at = models.FloatField()
+    last_updated = models.FloatField()
+    data = models.JSONField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sent_at", "id"], name="archived_task_sent_at"),
+            # Filtered pages are ordered by (sent_at, id) too
+            models.Index(fields=["state", "sent_at", "id"], name="archived_task_state"),
+            models.Index(fields=["type", "sent_at", "id"], name="archived_task_type"),
+            models.Index(fields=["worker", "sent_at", "id"], name="archived_task_worker"),
+            models.Index(fields=["root_id", "sent_at", "id"], name="archived_task_root_id"),
+        ]
@@ -0,0 +1,96 @@
+import time
+import uuid
+
+from celery.events.state import State
+from django.test import TestCase
+
+from history.archive import TaskArchive
+from history.models import ArchivedTask
+
+
+def archived_task(sent_at: float, state: str = "SUCCESS", **fields) -> ArchivedTask:
+    task_id = str(uuid.uuid4())
+    return ArchivedTask.objects.create(
+        task_id=task_id, state=state, sent_at=sent_at, last_updated=sent_at, data={"id": task_id}, **fields,
+    )
+
+
+class TaskArchiveTests(TestCase):
+    def setUp(self):
+        self.state = State()
+
+    def task_event(self, task_id: str, type_: str) -> None:
+        now = time.time()
+        self.state.event({
+            "type": type_, "uuid": task_id, "name": "tests.add", "hostname": "worker@tests",
+            "timestamp": now, "local_received": now, "clock": 1,
+        })
+
+    def test_flush_upserts_the_latest_state_of_each_task(self):
+        archive = TaskArchive()
+        task_ids = [str(uuid.uuid4()) for _ in range(2)]
+        for task_id in task_ids:
+            self.task_event(task_id, "task-received")
+            archive.put(self.state.tasks[task_id])
+        archive.flush()
+
+        self.task_event(task_ids[0], "task-succeeded")
+        archive.put(self.state.tasks[task_ids[0]])
+        archive.put(self.state.tasks[task_ids[0]])
+        archive.flush()
+
+        self.assertEqual(
+            dict(ArchivedTask.objects.values_list("task_id", "state")),
+            {task_ids[0]: "SUCCESS", task_ids[1]: "RECEIVED"},
+        )
+        self.assertEqual(ArchivedTask.objects.get(task_id=task_ids[0]).worker, "worker@tests")
+        self.assertEqual(archive.written, 3)
+
+    def test_new_tasks_are_dropped_once_max_pending_are_waiting(self):
+        archive = TaskArchive(max_pending=1)
+        task_ids = [str(uuid.uuid4()) for _ in range(2)]
+        for task_id in task_ids:
+            self.task_event(task_id, "task-received")
+            archive.put(self.state.tasks[task_id])
+        # Tasks already waiting are still updated
+        self.task_event(task_ids[0], "task-started")
+        archive.put(self.state.tasks[task_ids[0]])
+        archive.flush()
+
+        self.assertEqual(list(ArchivedTask.objects.values_list("task_id", "state")), [(task_ids[0], "STARTED")])
+        self.assertEqual(archive.dropped, 1)
+
+
+class TaskHistoryViewTests(TestCase):
+    def get(self, **params) -> dict:
+        response = self.client.get("/api/tasks/history", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cursor_pages_list_every_task_once_newest_sent_first(self):
+        # Tasks sent at the same time are ordered by id
+        tasks = [archived_task(sent_at) for sent_at in (1.0, 2.0, 2.0, 2.0, 3.0)]
+        expected = [task.data for task in sorted(tasks, key=lambda task: (task.sent_at, task.id), reverse=True)]
+
+        items, cursor = [], None
+        while True:
+            page = self.get(limit=2, **({"cursor": cursor} if cursor else {}))
+            items += page["items"]
+            if (cursor := page["next_cursor"]) is None:
+                break
+        self.assertEqual(items, expected)
+
+    def test_tasks_are_filtered_by_field_and_sent_time(self):
+        failed = archived_task(2.0, state="FAILURE", worker="celery@a")
+        archived_task(2.0, state="FAILURE", worker="celery@b")
+        archived_task(1.0, state="FAILURE", worker="celery@a")
+        archived_task(2.0, worker="celery@a")
+
+        page = self.get(state="FAILURE", worker="celery@a", since=1.5, until=3)
+        self.assertEqual(page["items"], [failed.data])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_invalid_parameters_are_rejected(self):
+        for params in ({"limit": "many"}, {"since": "yesterday"}, {"cursor": "2.0"}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/api/tasks/history", params).status_code, 400)
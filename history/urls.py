@@ -0,0 +1,7 @@
+# urls.py
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('', views.get_task_history, name='get_task_history'),
+]
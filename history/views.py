@@ -0,0 +1,49 @@
+from django.db.models import Q
+from django.http import HttpResponseBadRequest, JsonResponse
+
+from history.models import ArchivedTask
+
+FILTER_FIELDS = ("state", "type", "worker", "root_id")
+
+
+def parse_cursor(cursor: str) -> tuple[float, int]:
+    sent_at, _, row_id = cursor.partition(":")
+    return float(sent_at), int(row_id)
+
+
+def get_task_history(request):
+    """Archived tasks, newest sent first, with keyset pagination over ``(sent_at, id)``."""
+    try:
+        limit = min(max(int(request.GET.get('limit', 100)), 1), 1000)
+        cursor = request.GET.get('cursor')
+        cursor = parse_cursor(cursor) if cursor else None
+        since = request.GET.get('since')
+        until = request.GET.get('until')
+        since = float(since) if since else None
+        until = float(until) if until else None
+    except ValueError:
+        return HttpResponseBadRequest("limit must be an integer, since/until epoch timestamps, cursor as returned")
+
+    queryset = ArchivedTask.objects.filter(**{
+        field: request.GET[field] for field in FILTER_FIELDS if request.GET.get(field)
+    })
+    if since is not None:
+        queryset = queryset.filter(sent_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(sent_at__lt=until)
+    if cursor is not None:
+        sent_at, row_id = cursor
+        queryset = queryset.filter(Q(sent_at__lt=sent_at) | Q(sent_at=sent_at, id__lt=row_id))
+
+    rows = list(queryset.order_by('-sent_at', '-id').values_list('id', 'sent_at', 'data')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_id, last_sent_at, _ = rows[-1]
+        next_cursor = f"{last_sent_at!r}:{last_id}"
+
+    return JsonResponse({
+        'items': [data for _, _, data in rows],
+        'limit': limit,
+        'next_cursor': next_cursor,
+    })
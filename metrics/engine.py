@@ -0,0 +1,286 @@
+import logging
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import NamedTuple, Self
+
+from celery_detect.settings import MetricsSettings
+from events.models import AppliedEvent
+from metrics.models import DIMENSIONS, LatencySummary, MetricSeries, MetricsReport
+from metrics.sketch import QuantileSketch
+
+logger = logging.getLogger(__name__)
+
+#: Fractions reported for the latency distributions.
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+#: Key of the series aggregating every task.
+TOTAL_KEY = "*"
+TOTAL_SERIES = ("total", TOTAL_KEY)
+COUNTERS = ("received", "succeeded", "failed", "retried")
+
+
+class MetricSample(NamedTuple):
+    """What the engine records of one task event, so events applied elsewhere (e.g, by a shard) can be recorded."""
+    counter: str
+    received_at: float | None
+    keys: tuple[tuple[str, str | None], ...]
+    queue_wait: float | None = None
+    runtime: float | None = None
+    cluster: str | None = None
+
+
+class _Series:
+    """Ring of time buckets for one task type, worker or routing key.
+
+    Each slot holds the counters and latency sketches of one bucket of ``bucket_seconds``,
+    and is reset when the ring wraps around to it, so the memory of a series is fixed.
+    """
+
+    __slots__ = ("buckets", "epochs", "counters", "queue_wait", "runtime")
+
+    def __init__(self, buckets: int):
+        self.buckets = buckets
+        self.epochs = array("q", [-1] * buckets)
+        self.counters = {counter: array("Q", bytes(8 * buckets)) for counter in COUNTERS}
+        self.queue_wait = [QuantileSketch() for _ in range(buckets)]
+        self.runtime = [QuantileSketch() for _ in range(buckets)]
+
+    def slot(self, epoch: int) -> int | None:
+        """Slot holding ``epoch``, recycling it if it holds an older bucket. None if ``epoch`` is too old."""
+        slot = epoch % self.buckets
+        current = self.epochs[slot]
+        if current == epoch:
+            return slot
+        if current > epoch:
+            return None
+        self.epochs[slot] = epoch
+        for counts in self.counters.values():
+            counts[slot] = 0
+        self.queue_wait[slot].reset()
+        self.runtime[slot].reset()
+        return slot
+
+    def add_to(self, totals: "SeriesTotals", first_epoch: int, last_epoch: int) -> None:
+        """Add the buckets from ``first_epoch`` to ``last_epoch`` to ``totals``."""
+        for slot, epoch in enumerate(self.epochs):
+            if not first_epoch <= epoch <= last_epoch:
+                continue
+            for counter, counts in self.counters.items():
+                totals.counters[counter] += counts[slot]
+            totals.queue_wait.merge(self.queue_wait[slot])
+            totals.runtime.merge(self.runtime[slot])
+
+
+class SeriesTotals:
+    """Counters and latency sketches of a series over a window, summed across clusters (and state shards)."""
+
+    __slots__ = ("counters", "queue_wait", "runtime")
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.queue_wait = QuantileSketch()
+        self.runtime = QuantileSketch()
+
+    def merge(self, other: Self) -> None:
+        for counter, count in other.counters.items():
+            self.counters[counter] += count
+        self.queue_wait.merge(other.queue_wait)
+        self.runtime.merge(other.runtime)
+
+    def summarize(self, dimension: str, key: str, seconds: float) -> MetricSeries:
+        finished = self.counters["succeeded"] + self.counters["failed"]
+        return MetricSeries(
+            dimension=dimension,
+            key=key,
+            **self.counters,
+            throughput=finished / seconds,
+            failure_rate=self.counters["failed"] / finished if finished else None,
+            queue_wait=summarize_latency(self.queue_wait),
+            runtime=summarize_latency(self.runtime),
+        )
+
+
+class _Partition:
+    """Series of the events of one cluster, under a lock of their own."""
+
+    __slots__ = ("lock", "series")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series: OrderedDict[tuple[str, str], _Series] = OrderedDict()
+
+
+def summarize_latency(sketch: QuantileSketch) -> LatencySummary:
+    p50, p90, p95, p99 = sketch.quantiles(QUANTILES)
+    return LatencySummary(count=sketch.count, mean=sketch.mean, p50=p50, p90=p90, p95=p95, p99=p99)
+
+
+class MetricsEngine:
+    """Rolling per task type, worker and routing key metrics, fed by the ingestion stage.
+
+    Events are counted into time buckets when they are received, and percentiles of a window
+    are computed by merging the sketches of its buckets, so neither recording nor querying
+    depends on how many tasks passed through. Each cluster's series are kept and locked apart,
+    so recording the events of one cluster never waits on another, and the least recently
+    updated series of a cluster are dropped beyond ``max_series``.
+    """
+
+    def __init__(self, bucket_seconds: float = 10.0, buckets: int = 60, max_series: int = 500):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._partitions: dict[str | None, _Partition] = {}
+
+    @classmethod
+    def from_settings(cls, settings: dict = MetricsSettings) -> Self:
+        return cls(
+            bucket_seconds=settings.get("BUCKET_SECONDS", 10.0),
+            buckets=settings.get("BUCKETS", 60),
+            max_series=settings.get("MAX_SERIES", 500),
+        )
+
+    @property
+    def max_window(self) -> float:
+        return self.bucket_seconds * self.buckets
+
+    def record(self, applied: AppliedEvent) -> None:
+        sample = self.sample(applied)
+        if sample is not None:
+            self.add(sample)
+
+    @staticmethod
+    def sample(applied: AppliedEvent) -> MetricSample | None:
+        task = applied.entity
+        if applied.category != "task" or task is None:
+            return None
+
+        subject = applied.subject
+        counter = queue_wait = runtime = None
+        if subject == "received":
+            counter = "received"
+            if task.sent and task.received:
+                queue_wait = max(task.received - task.sent, 0.0)
+        elif subject == "succeeded":
+            counter = "succeeded"
+            runtime = task.runtime
+        elif subject == "failed":
+            counter = "failed"
+            if task.started and task.failed:
+                runtime = max(task.failed - task.started, 0.0)
+        elif subject == "retried":
+            counter = "retried"
+        if counter is None:
+            return None
+
+        keys = (
+            ("type", task.name),
+            ("worker", task.worker.hostname if task.worker is not None else None),
+            ("routing_key", task.routing_key),
+            ("total", TOTAL_KEY),
+        )
+        return MetricSample(
+            counter, applied.event.get("local_received"), keys, queue_wait, runtime, applied.event.get("cluster"),
+        )
+
+    def _partition(self, cluster: str | None) -> _Partition:
+        partition = self._partitions.get(cluster)
+        if partition is None:
+            with self._lock:
+                partition = self._partitions.setdefault(cluster, _Partition())
+        return partition
+
+    def add(self, sample: MetricSample) -> None:
+        epoch = int((sample.received_at or time.time()) // self.bucket_seconds)
+        partition = self._partition(sample.cluster)
+        with partition.lock:
+            for key in sample.keys:
+                if key[1] is None:
+                    continue
+                series = self._get_series(partition.series, key)
+                slot = series.slot(epoch)
+                if slot is None:
+                    continue
+                series.counters[sample.counter][slot] += 1
+                if sample.queue_wait is not None:
+                    series.queue_wait[slot].add(sample.queue_wait)
+                if sample.runtime is not None:
+                    series.runtime[slot].add(sample.runtime)
+
+    def _get_series(self, partition: OrderedDict[tuple[str, str], _Series], key: tuple[str, str]) -> _Series:
+        series = partition.get(key)
+        if series is None:
+            series = partition[key] = _Series(self.buckets)
+            if len(partition) > self.max_series:
+                evicted, _ = partition.popitem(last=False)
+                logger.debug(f"Dropping metrics series {evicted}")
+        else:
+            partition.move_to_end(key)
+        return series
+
+    def report(
+            self,
+            window: float,
+            dimension: str = "type",
+            key: str | None = None,
+            cluster: str | None = None,
+            gather: Callable[..., list[dict[tuple[str, str], SeriesTotals]]] | None = None,
+    ) -> MetricsReport:
+        """Metrics over the last ``window`` seconds, one series per key of ``dimension``, of the events of every
+        cluster or of ``cluster`` only.
+
+        With ``gather``, the series are those of the engines it returns the :meth:`totals` of (called with the same
+        arguments), e.g, the engines of the state shards, instead of this engine's."""
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension {dimension!r}, expected one of {', '.join(DIMENSIONS)}")
+        window = min(max(window, self.bucket_seconds), self.max_window)
+        now = time.time()
+        last_epoch = int(now // self.bucket_seconds)
+        first_epoch = last_epoch - int(window // self.bucket_seconds) + 1
+        # The current bucket is only partially elapsed
+        seconds = (last_epoch - first_epoch) * self.bucket_seconds + (now % self.bucket_seconds)
+
+        arguments = (first_epoch, last_epoch, dimension, key, cluster)
+        totals: dict[tuple[str, str], SeriesTotals] = {}
+        for each in gather(*arguments) if gather is not None else [self.totals(*arguments)]:
+            for series_key, summed in each.items():
+                if series_key in totals:
+                    totals[series_key].merge(summed)
+                else:
+                    totals[series_key] = summed
+        total = totals.pop(TOTAL_SERIES, None)
+        total = total.summarize(*TOTAL_SERIES, seconds) if total is not None else None
+        series = [summed.summarize(*series_key, seconds) for series_key, summed in totals.items()]
+
+        series.sort(key=lambda item: item.throughput, reverse=True)
+        return MetricsReport(
+            window=seconds,
+            bucket_seconds=self.bucket_seconds,
+            generated_at=now,
+            total=total,
+            series=series,
+        )
+
+    def totals(
+            self, first_epoch: int, last_epoch: int, dimension: str, key: str | None = None, cluster: str | None = None,
+    ) -> dict[tuple[str, str], SeriesTotals]:
+        """Series of ``dimension`` (and the total) summed over the buckets from ``first_epoch`` to ``last_epoch``."""
+        with self._lock:
+            partitions = list(self._partitions.values()) if cluster is None else [self._partitions.get(cluster)]
+        totals: dict[tuple[str, str], SeriesTotals] = {}
+        for partition in filter(None, partitions):
+            with partition.lock:
+                for series_key, series in partition.series.items():
+                    series_dimension, name = series_key
+                    if series_key == TOTAL_SERIES or (series_dimension == dimension and key in (None, name)):
+                        series.add_to(totals.setdefault(series_key, SeriesTotals()), first_epoch, last_epoch)
+        return totals
+
+    def clear(self) -> None:
+        with self._lock:
+            self._partitions.clear()
+
+
+metrics_engine = MetricsEngine.from_settings()
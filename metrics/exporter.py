@@ -0,0 +1,209 @@
+import threading
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+from typing import NamedTuple
+
+from events.models import AppliedEvent
+
+#: Upper bounds (in seconds) of the task runtime histogram buckets.
+RUNTIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+#: Task names beyond this many are exported under a single label, to bound the number of series.
+MAX_TASK_NAMES = 1000
+OTHER_TASK_NAME = "other"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Sample = tuple[dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_metric(name: str, kind: str, description: str, samples: Iterable[Sample]) -> str:
+    """Render one metric family in the Prometheus text exposition format."""
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+class ExporterSample(NamedTuple):
+    """What the exporter counts of one event, so events applied elsewhere (e.g, by a shard) can be counted."""
+    event_type: str
+    task_name: str | None = None
+    task_state: str | None = None
+    runtime: float | None = None
+    is_task: bool = False
+    cluster: str = ""
+
+
+class ExporterCounts(NamedTuple):
+    """Everything an exporter counted, to render it together with what other exporters (e.g, of the shards) did."""
+    events: dict[tuple[str, str], int]  # (cluster, event type) -> count
+    task_events: dict[tuple[str, str, str, str], int]  # (cluster, task name, event type, state) -> count
+    runtimes: dict[tuple[str, str], tuple[list[int], float, int]]  # (cluster, task name) -> (buckets, sum, count)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self, size: int):
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class _Counters:
+    """Counters of the events of one cluster, under a lock of their own."""
+
+    __slots__ = ("lock", "events", "task_events", "runtimes")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events: dict[str, int] = {}
+        self.task_events: dict[tuple[str, str, str], int] = {}
+        self.runtimes: dict[str, _Histogram] = {}
+
+
+class PrometheusExporter:
+    """Cumulative event counters and runtime histograms, kept incrementally by the ingestion stage.
+
+    A scrape only renders what was counted, so its cost depends on the number of task names and
+    event types, not on how many tasks passed through. Each cluster is counted apart, so counting
+    the events of one cluster never waits on another, and exported with a ``cluster`` label.
+    """
+
+    def __init__(self, runtime_buckets: tuple[float, ...] = RUNTIME_BUCKETS, max_task_names: int = MAX_TASK_NAMES):
+        self.runtime_buckets = runtime_buckets
+        self.max_task_names = max_task_names
+        self._lock = threading.Lock()
+        self._clusters: dict[str, _Counters] = {}
+        self._task_names: set[str] = set()
+
+    def _counters(self, cluster: str) -> _Counters:
+        counters = self._clusters.get(cluster)
+        if counters is None:
+            with self._lock:
+                counters = self._clusters.setdefault(cluster, _Counters())
+        return counters
+
+    def _task_name(self, name: str | None) -> str:
+        if name is None:
+            return ""
+        if name in self._task_names:
+            return name
+        with self._lock:
+            if name in self._task_names:
+                return name
+            if len(self._task_names) >= self.max_task_names:
+                return OTHER_TASK_NAME
+            self._task_names.add(name)
+        return name
+
+    def record(self, applied: AppliedEvent) -> None:
+        self.add(self.sample(applied))
+
+    @staticmethod
+    def sample(applied: AppliedEvent) -> ExporterSample:
+        event_type = applied.event.get("type", "")
+        cluster = applied.event.get("cluster") or ""
+        task = applied.entity if applied.category == "task" else None
+        if task is None:
+            return ExporterSample(event_type, cluster=cluster)
+        runtime = task.runtime if applied.subject == "succeeded" else None
+        return ExporterSample(event_type, task.name, task.state, runtime, is_task=True, cluster=cluster)
+
+    def add(self, sample: ExporterSample) -> None:
+        event_type = sample.event_type
+        counters = self._counters(sample.cluster)
+        name = self._task_name(sample.task_name) if sample.is_task else None
+        with counters.lock:
+            counters.events[event_type] = counters.events.get(event_type, 0) + 1
+            if not sample.is_task:
+                return
+
+            key = (name, event_type, sample.task_state or "")
+            counters.task_events[key] = counters.task_events.get(key, 0) + 1
+
+            if sample.runtime is not None:
+                histogram = counters.runtimes.get(name)
+                if histogram is None:
+                    histogram = counters.runtimes[name] = _Histogram(len(self.runtime_buckets) + 1)
+                histogram.buckets[bisect_left(self.runtime_buckets, sample.runtime)] += 1
+                histogram.sum += sample.runtime
+                histogram.count += 1
+
+    def counts(self) -> ExporterCounts:
+        with self._lock:
+            clusters = list(self._clusters.items())
+        counts = ExporterCounts({}, {}, {})
+        for cluster, counters in clusters:
+            with counters.lock:
+                counts.events.update(((cluster, event_type), count) for event_type, count in counters.events.items())
+                counts.task_events.update(((cluster, *key), count) for key, count in counters.task_events.items())
+                counts.runtimes.update(
+                    ((cluster, name), (list(histogram.buckets), histogram.sum, histogram.count))
+                    for name, histogram in counters.runtimes.items()
+                )
+        return counts
+
+    def render(self, gather: Callable[[], list[ExporterCounts]] | None = None) -> str:
+        """Render what was counted, or with ``gather`` the sum of the counts it returns (e.g, of the shards')."""
+        counts = ExporterCounts({}, {}, {})
+        for each in gather() if gather is not None else [self.counts()]:
+            for key, count in each.events.items():
+                counts.events[key] = counts.events.get(key, 0) + count
+            for key, count in each.task_events.items():
+                counts.task_events[key] = counts.task_events.get(key, 0) + count
+            for key, (buckets, total, count) in each.runtimes.items():
+                merged = counts.runtimes.get(key)
+                if merged is not None:
+                    buckets = [a + b for a, b in zip(merged[0], buckets)]
+                    total, count = merged[1] + total, merged[2] + count
+                counts.runtimes[key] = (buckets, total, count)
+
+        parts = [
+            format_metric(
+                "celery_detect_events_total", "counter", "Events received from the cluster, by event type",
+                (({"cluster": cluster, "type": event_type}, count)
+                 for (cluster, event_type), count in counts.events.items()),
+            ),
+            format_metric(
+                "celery_detect_task_events_total", "counter",
+                "Task events, by task name, event type and the task state after the event",
+                (({"cluster": cluster, "task": name, "type": event_type, "state": state}, count)
+                 for (cluster, name, event_type, state), count in counts.task_events.items()),
+            ),
+        ]
+
+        samples = []
+        bounds = (*self.runtime_buckets, float("inf"))
+        for (cluster, name), (buckets, total, count) in counts.runtimes.items():
+            labels = {"cluster": cluster, "task": name}
+            cumulative = 0
+            for bound, bucket in zip(bounds, buckets):
+                cumulative += bucket
+                samples.append(("_bucket", {**labels, "le": _format_value(float(bound))}, cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        name = "celery_detect_task_runtime_seconds"
+        lines = [f"# HELP {name} Runtime of succeeded tasks", f"# TYPE {name} histogram"]
+        lines.extend(
+            f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}" for suffix, labels, value in samples
+        )
+        parts.append("\n".join(lines) + "\n")
+        return "".join(parts)
+
+
+prometheus_exporter = PrometheusExporter()
@@ -0,0 +1,50 @@
+from pydantic import BaseModel, Field
+
+#: Task attributes metrics are broken down by.
+DIMENSIONS = ("type", "worker", "routing_key")
+
+
+class LatencySummary(BaseModel):
+    count: int = Field(description="Number of measured tasks")
+    mean: float | None = Field(description="Mean in seconds")
+    p50: float | None = Field(description="Median in seconds")
+    p90: float | None = Field(description="90th percentile in seconds")
+    p95: float | None = Field(description="95th percentile in seconds")
+    p99: float | None = Field(description="99th percentile in seconds")
+
+
+class MetricSeries(BaseModel):
+    dimension: str = Field(description="Attribute the series is keyed by (type / worker / routing_key / total)")
+    key: str = Field(description="Task type, worker hostname or routing key")
+    received: int = Field(description="Tasks received by a worker")
+    succeeded: int = Field(description="Tasks succeeded")
+    failed: int = Field(description="Tasks failed")
+    retried: int = Field(description="Task retries")
+    throughput: float = Field(description="Finished (succeeded or failed) tasks per second")
+    failure_rate: float | None = Field(description="Fraction of finished tasks that failed")
+    queue_wait: LatencySummary = Field(description="Time between a task being sent and received by a worker")
+    runtime: LatencySummary = Field(description="Task runtime")
+
+
+class MetricsReport(BaseModel):
+    window: float = Field(description="Seconds covered by the report")
+    bucket_seconds: float = Field(description="Resolution of the underlying time buckets")
+    generated_at: float = Field(description="Timestamp of the report")
+    total: MetricSeries | None = Field(description="All tasks, regardless of the breakdown")
+    series: list[MetricSeries] = Field(description="One series per key, busiest first")
+
+
+class StageLatency(BaseModel):
+    count: int = Field(description="Number of sampled events that went through the stage")
+    mean: float | None = Field(description="Mean in milliseconds")
+    p50: float | None = Field(description="Median in milliseconds")
+    p90: float | None = Field(description="90th percentile in milliseconds")
+    p99: float | None = Field(description="99th percentile in milliseconds")
+
+
+class LatencyReport(BaseModel):
+    sample_rate: float = Field(description="Fraction of the events traced, 0 when tracing is disabled")
+    traced: int = Field(description="Number of events traced")
+    stages: dict[str, StageLatency] = Field(
+        description="Latency of each stage from broker receipt to WebSocket delivery, and the broker lag"
+    )
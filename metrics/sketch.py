@@ -0,0 +1,84 @@
+import math
+from array import array
+from collections.abc import Iterable
+from typing import Self
+
+#: Smallest and largest durations (in seconds) told apart; values outside fall in the edge bins.
+MIN_VALUE = 1e-4
+MAX_VALUE = 1e5
+#: Ratio between consecutive bin bounds, quantiles are accurate to about ``sqrt(GAMMA) - 1`` (10%).
+GAMMA = 1.2
+_LOG_GAMMA = math.log(GAMMA)
+BINS = math.ceil(math.log(MAX_VALUE / MIN_VALUE) / _LOG_GAMMA) + 2
+
+
+def _bin(value: float) -> int:
+    if value <= MIN_VALUE:
+        return 0
+    if value >= MAX_VALUE:
+        return BINS - 1
+    return 1 + int(math.log(value / MIN_VALUE) / _LOG_GAMMA)
+
+
+def _bin_value(position: int) -> float:
+    """Representative value of a bin, the geometric middle of its bounds."""
+    if position == 0:
+        return MIN_VALUE
+    if position == BINS - 1:
+        return MAX_VALUE
+    return MIN_VALUE * GAMMA ** (position - 0.5)
+
+
+class QuantileSketch:
+    """Fixed-size histogram over logarithmic bins, for approximate quantiles of durations.
+
+    Every sketch uses the same bins, so sketches are merged by adding their counts, and memory
+    does not depend on how many values were added.
+    """
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = array("I", bytes(4 * BINS))
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value: float) -> None:
+        self.counts[_bin(value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: Self) -> None:
+        counts = self.counts
+        for position, count in enumerate(other.counts):
+            if count:
+                counts[position] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def reset(self) -> None:
+        self.counts = array("I", bytes(4 * BINS))
+        self.count = 0
+        self.sum = 0.0
+
+    @property
+    def mean(self) -> float | None:
+        return self.sum / self.count if self.count else None
+
+    def quantiles(self, qs: Iterable[float]) -> list[float | None]:
+        """Values below which the fractions ``qs`` (given ascending) of the added values fall."""
+        qs = list(qs)
+        if not self.count:
+            return [None] * len(qs)
+        results = []
+        ranks = iter([q * (self.count - 1) for q in qs])
+        rank = next(ranks, None)
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            while rank is not None and seen > rank:
+                results.append(_bin_value(position))
+                rank = next(ranks, None)
+            if rank is None:
+                break
+        return results
@@ -0,0 +1,207 @@
+import random
+import time
+
+from django.test import SimpleTestCase
+
+from metrics.engine import MetricSample, MetricsEngine
+from metrics.exporter import CONTENT_TYPE, ExporterSample, PrometheusExporter
+from metrics.sketch import QuantileSketch
+from metrics.tracing import STAGES, LatencyTracer
+
+
+def sample(
+        counter: str, task_name: str, received_at: float | None = None, cluster: str | None = None, **latencies,
+) -> MetricSample:
+    keys = (("type", task_name), ("worker", "celery@a"), ("routing_key", None), ("total", "*"))
+    return MetricSample(counter, received_at or time.time(), keys, cluster=cluster, **latencies)
+
+
+class QuantileSketchTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        self.values = sorted(rng.lognormvariate(0, 2) for _ in range(10_000))
+
+    def test_quantiles_are_within_the_relative_accuracy_of_the_bins(self):
+        sketch = QuantileSketch()
+        for value in self.values:
+            sketch.add(value)
+        qs = (0.5, 0.9, 0.99)
+        for q, estimate in zip(qs, sketch.quantiles(qs)):
+            with self.subTest(q=q):
+                exact = self.values[int(q * (len(self.values) - 1))]
+                self.assertAlmostEqual(estimate / exact, 1, delta=0.1)
+        self.assertAlmostEqual(sketch.mean, sum(self.values) / len(self.values))
+
+    def test_merged_sketches_equal_a_sketch_of_all_the_values(self):
+        merged, whole = QuantileSketch(), QuantileSketch()
+        halves = QuantileSketch(), QuantileSketch()
+        for position, value in enumerate(self.values):
+            whole.add(value)
+            halves[position % 2].add(value)
+        merged.merge(halves[0])
+        merged.merge(halves[1])
+        self.assertEqual(list(merged.counts), list(whole.counts))
+        self.assertEqual(merged.count, whole.count)
+
+    def test_empty_sketches_have_no_quantiles(self):
+        sketch = QuantileSketch()
+        self.assertEqual(sketch.quantiles((0.5, 0.99)), [None, None])
+        self.assertIsNone(sketch.mean)
+
+
+class MetricsEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = MetricsEngine(bucket_seconds=10, buckets=60, max_series=10)
+
+    def test_series_count_the_events_of_each_task_type(self):
+        for runtime in (1.0, 2.0, 3.0):
+            self.engine.add(sample("succeeded", "app.add", runtime=runtime))
+        self.engine.add(sample("failed", "app.add", runtime=10.0))
+        self.engine.add(sample("received", "app.mul", queue_wait=0.5))
+
+        report = self.engine.report(window=60)
+        series = {item.key: item for item in report.series}
+        self.assertEqual([item.key for item in report.series], ["app.add", "app.mul"])
+        self.assertEqual((series["app.add"].succeeded, series["app.add"].failed), (3, 1))
+        self.assertEqual(series["app.add"].failure_rate, 0.25)
+        self.assertAlmostEqual(series["app.add"].throughput, 4 / report.window)
+        self.assertEqual(series["app.add"].runtime.count, 4)
+        self.assertAlmostEqual(series["app.add"].runtime.p50, 2.0, delta=0.2)
+        self.assertEqual(series["app.mul"].received, 1)
+        self.assertIsNone(series["app.mul"].failure_rate)
+        self.assertAlmostEqual(series["app.mul"].queue_wait.p50, 0.5, delta=0.05)
+        self.assertEqual((report.total.key, report.total.succeeded, report.total.received), ("*", 3, 1))
+
+    def test_events_before_the_window_are_left_out(self):
+        self.engine.add(sample("succeeded", "app.add", received_at=time.time() - 300))
+        self.engine.add(sample("succeeded", "app.add"))
+        self.assertEqual(self.engine.report(window=60).total.succeeded, 1)
+        self.assertEqual(self.engine.report(window=600).total.succeeded, 2)
+
+    def test_reports_break_down_by_dimension_and_cluster(self):
+        self.engine.add(sample("succeeded", "app.add", cluster="a"))
+        self.engine.add(sample("succeeded", "app.mul", cluster="b"))
+
+        report = self.engine.report(window=60, dimension="worker")
+        self.assertEqual([(item.key, item.succeeded) for item in report.series], [("celery@a", 2)])
+        report = self.engine.report(window=60, cluster="b")
+        self.assertEqual([(item.key, item.succeeded) for item in report.series], [("app.mul", 1)])
+        self.assertEqual(self.engine.report(window=60, key="app.add").series[0].key, "app.add")
+        with self.assertRaises(ValueError):
+            self.engine.report(window=60, dimension="queue")
+
+    def test_the_least_recently_updated_series_are_dropped(self):
+        # Each sample updates a type, the worker and the total series
+        for position in range(10):
+            self.engine.add(sample("succeeded", f"app.task{position}"))
+        self.assertEqual(
+            [item.key for item in self.engine.report(window=60).series], [f"app.task{i}" for i in range(2, 10)],
+        )
+
+
+class LatencyTracerTests(SimpleTestCase):
+    def event(self, lag: float = 0.0) -> dict:
+        now = time.time()
+        return {"type": "task-received", "timestamp": now - lag, "local_received": now}
+
+    def counts(self, tracer: LatencyTracer) -> dict[str, int]:
+        return {stage: latency.count for stage, latency in tracer.report().stages.items()}
+
+    def test_one_in_every_1_over_the_sample_rate_events_is_traced(self):
+        tracer = LatencyTracer(sample_rate=0.25)
+        traces = [tracer.start(self.event()) for _ in range(8)]
+        self.assertEqual([trace is not None for trace in traces], [True, False, False, False] * 2)
+        self.assertEqual(tracer.report().traced, 2)
+        self.assertIsNone(LatencyTracer(sample_rate=0).start(self.event()))
+
+    def test_the_broker_lag_is_recorded_in_milliseconds(self):
+        tracer = LatencyTracer(sample_rate=1)
+        tracer.start(self.event(lag=0.5))
+        # Worker clocks ahead of ours count as no lag
+        tracer.start(self.event(lag=-10))
+        broker_lag = tracer.report().stages["broker_lag"]
+        self.assertEqual(broker_lag.count, 2)
+        self.assertAlmostEqual(broker_lag.mean, 250, delta=5)
+
+    def test_each_stage_is_timed_from_the_end_of_the_previous_one(self):
+        tracer = LatencyTracer(sample_rate=1)
+        trace = tracer.start(self.event())
+        time.sleep(0.01)
+        trace.mark("ingest")
+        trace.mark("queue")
+        handed_off = trace.last
+        trace.mark("parse")
+        trace.measure("dispatch", handed_off)
+        self.assertTrue(trace.claim())
+        self.assertFalse(trace.claim())
+        trace.finish()
+
+        report = tracer.report()
+        self.assertEqual(set(report.stages), set(STAGES))
+        self.assertEqual(self.counts(tracer), {**dict.fromkeys(STAGES, 1), "client_queue": 0, "serialize": 0})
+        self.assertGreaterEqual(report.stages["ingest"].mean, 10)
+        self.assertGreaterEqual(report.stages["total"].mean, report.stages["ingest"].mean)
+
+    def test_reset_clears_the_stages(self):
+        tracer = LatencyTracer(sample_rate=1)
+        tracer.start(self.event()).finish()
+        tracer.reset()
+        self.assertEqual(tracer.report().traced, 0)
+        self.assertEqual(set(self.counts(tracer).values()), {0})
+
+
+class PrometheusExporterTests(SimpleTestCase):
+    def setUp(self):
+        self.exporter = PrometheusExporter(runtime_buckets=(0.1, 1.0), max_task_names=2)
+
+    def succeeded(self, task_name: str, runtime: float, cluster: str = "default") -> ExporterSample:
+        return ExporterSample("task-succeeded", task_name, "SUCCESS", runtime, is_task=True, cluster=cluster)
+
+    def lines(self, text: str) -> list[str]:
+        return [line for line in text.splitlines() if not line.startswith("#")]
+
+    def test_events_are_counted_by_cluster_task_type_and_state(self):
+        self.exporter.add(ExporterSample("worker-heartbeat", cluster="default"))
+        self.exporter.add(self.succeeded("app.add", 0.05))
+        self.exporter.add(self.succeeded("app.add", 0.5))
+        self.exporter.add(self.succeeded("app.add", 5.0, cluster="other"))
+
+        lines = self.lines(self.exporter.render())
+        self.assertIn('celery_detect_events_total{cluster="default",type="worker-heartbeat"} 1', lines)
+        self.assertIn('celery_detect_events_total{cluster="default",type="task-succeeded"} 2', lines)
+        self.assertIn(
+            'celery_detect_task_events_total{cluster="other",task="app.add",type="task-succeeded",state="SUCCESS"} 1',
+            lines,
+        )
+        # Histogram buckets are cumulative
+        runtime = 'celery_detect_task_runtime_seconds_{}{{cluster="default",task="app.add"{}}} {}'
+        for bound, count in (("0.1", 1), ("1.0", 2), ("+Inf", 2)):
+            self.assertIn(runtime.format("bucket", f',le="{bound}"', count), lines)
+        self.assertIn(runtime.format("sum", "", 0.55), lines)
+        self.assertIn(runtime.format("count", "", 2), lines)
+
+    def test_task_names_beyond_the_limit_are_exported_as_other(self):
+        for task_name in ("app.a", "app.b", "app.c", "app.d"):
+            self.exporter.add(self.succeeded(task_name, 0.5))
+        lines = self.lines(self.exporter.render())
+        self.assertIn('celery_detect_task_runtime_seconds_count{cluster="default",task="app.a"} 1', lines)
+        self.assertIn('celery_detect_task_runtime_seconds_count{cluster="default",task="other"} 2', lines)
+
+    def test_gathered_counts_are_summed(self):
+        shards = [PrometheusExporter(runtime_buckets=(0.1, 1.0)) for _ in range(2)]
+        for shard in shards:
+            shard.add(self.succeeded("app.add", 0.5))
+        lines = self.lines(self.exporter.render(lambda: [shard.counts() for shard in shards]))
+        self.assertIn('celery_detect_events_total{cluster="default",type="task-succeeded"} 2', lines)
+        self.assertIn('celery_detect_task_runtime_seconds_count{cluster="default",task="app.add"} 2', lines)
+
+    def test_label_values_are_escaped(self):
+        self.exporter.add(self.succeeded('app."quoted"\\', 0.5))
+        self.assertIn('task="app.\\"quoted\\"\\\\"', self.exporter.render())
+
+    def test_the_scrape_endpoint_serves_the_text_format(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], CONTENT_TYPE)
+        self.assertIn("# TYPE celery_detect_events_total counter", response.content.decode())
+        self.assertIn("# TYPE celery_detect_worker_up gauge", response.content.decode())
@@ -0,0 +1,114 @@
+import itertools
+import threading
+import time
+from typing import Self
+
+from celery_detect.settings import LatencyTracingSettings
+from metrics.models import LatencyReport, StageLatency
+from metrics.sketch import QuantileSketch
+
+#: Stages of an event's way from the broker to the first client it is delivered to, in order.
+STAGES = (
+    "broker_lag",  # event timestamp (worker clock) to receipt by the receiver
+    "ingest",  # receipt to hand-off to the broadcaster (journal, event bus and state update)
+    "queue",  # waiting in the event queue for the broadcaster
+    "parse",  # conversion of the state entity to the event message
+    "dispatch",  # enqueueing for every subscribed client, overlapping with the first client's queue
+    "client_queue",  # hand-off to the clients' send queues to the first client's writer picking the event up
+    "serialize",  # encoding of the message to the client's wire format
+    "send",  # connection.send of the first client
+    "total",  # receipt to delivery to the first client
+)
+#: Fractions reported for every stage.
+QUANTILES = (0.5, 0.9, 0.99)
+#: Durations are sketched in milliseconds, so sub-millisecond stages are told apart.
+_MS = 1000
+
+
+class EventTrace:
+    """Timestamps of one sampled event, each stage measured from the end of the previous one.
+
+    Once the event is handed off to the client send queues, only the first client's writer marks stages.
+    """
+
+    __slots__ = ("tracer", "received", "last", "delivered")
+
+    def __init__(self, tracer: "LatencyTracer"):
+        self.tracer = tracer
+        self.received = self.last = time.perf_counter()
+        self.delivered = False
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.tracer.record(stage, now - self.last)
+        self.last = now
+
+    def measure(self, stage: str, started: float) -> None:
+        """Record a stage from ``started`` until now, leaving the end of the previous stage as it is."""
+        self.tracer.record(stage, time.perf_counter() - started)
+
+    def claim(self) -> bool:
+        """Whether the caller delivers the event first, the only delivery measured."""
+        if self.delivered:
+            return False
+        self.delivered = True
+        return True
+
+    def finish(self) -> None:
+        self.mark("send")
+        self.tracer.record("total", self.last - self.received)
+
+
+class LatencyTracer:
+    """Per-stage latency histograms of a sample of the events, from broker receipt to WebSocket delivery.
+
+    One in every ``1 / sample_rate`` events gets an :class:`EventTrace`, carried along with it
+    through the receiver, the broadcaster and the client send queues. Unsampled events only cost
+    a counter increment.
+    """
+
+    def __init__(self, sample_rate: float):
+        self.sample_rate = sample_rate
+        self._every = round(1 / sample_rate) if sample_rate > 0 else 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._stages = {stage: QuantileSketch() for stage in STAGES}
+        self.traced = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict = LatencyTracingSettings) -> Self:
+        return cls(sample_rate=settings.get("SAMPLE_RATE", 0))
+
+    def start(self, event: dict) -> EventTrace | None:
+        """Trace the event if it is sampled, recording its broker lag."""
+        if not self._every or next(self._counter) % self._every:
+            return None
+        trace = EventTrace(self)
+        timestamp, received = event.get("timestamp"), event.get("local_received")
+        if timestamp is not None and received is not None:
+            # Worker clocks may be ahead of ours
+            self.record("broker_lag", max(received - timestamp, 0.0))
+        with self._lock:
+            self.traced += 1
+        return trace
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._stages[stage].add(seconds * _MS)
+
+    def reset(self) -> None:
+        with self._lock:
+            for sketch in self._stages.values():
+                sketch.reset()
+            self.traced = 0
+
+    def report(self) -> LatencyReport:
+        with self._lock:
+            stages = {}
+            for stage, sketch in self._stages.items():
+                p50, p90, p99 = sketch.quantiles(QUANTILES)
+                stages[stage] = StageLatency(count=sketch.count, mean=sketch.mean, p50=p50, p90=p90, p99=p99)
+            return LatencyReport(sample_rate=self.sample_rate, traced=self.traced, stages=stages)
+
+
+latency_tracer = LatencyTracer.from_settings()
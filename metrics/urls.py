@@ -0,0 +1,7 @@
+# urls.py
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('', views.get_metrics, name='get_metrics'),
+]
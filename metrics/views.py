@@ -0,0 +1,102 @@
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+
+from events.clusters import clusters
+from events.exceptions import ShardUnavailableError
+from events.receiver import event_queues
+from events.sharding import shard_pool, sharded_event_queue
+from metrics.engine import metrics_engine
+from metrics.exporter import CONTENT_TYPE, format_metric, prometheus_exporter
+from ws.managers import events_manager, raw_events_manager
+
+
+def get_metrics(request):
+    """Rolling throughput, failure rate and latency percentiles, broken down by ``by``, of every cluster or of
+    ``cluster``."""
+    try:
+        window = float(request.GET.get('window', 300))
+        report = metrics_engine.report(
+            window=window,
+            dimension=request.GET.get('by', 'type'),
+            key=request.GET.get('key') or None,
+            cluster=request.GET.get('cluster') or None,
+            gather=shard_pool.metric_totals if shard_pool is not None else None,
+        )
+    except ValueError as e:
+        return HttpResponseBadRequest(f"window must be a number of seconds, by one of type/worker/routing_key: {e}")
+    except ShardUnavailableError as e:
+        return HttpResponse(str(e), status=503)
+
+    return JsonResponse(report.model_dump())
+
+
+def render_gauges() -> str:
+    """Point-in-time values, read from bounded structures only (workers, queues and connected clients)."""
+    if shard_pool is not None:
+        summary = shard_pool.summary()
+        default = clusters.default.id
+        queues = [(default, sharded_event_queue.stats())]
+        evicted = summary.retention.evicted
+        workers = [(default, hostname, alive) for hostname, alive in summary.workers]
+        stored = [(default, summary.tasks)]
+    else:
+        queues = [(cluster, queue.stats()) for cluster, queue in event_queues.items()]
+        evicted = {}
+        for cluster in clusters:
+            for reason, count in cluster.retention.stats().evicted.items():
+                evicted[reason] = evicted.get(reason, 0) + count
+        workers = [
+            (cluster.id, worker.hostname, worker.alive)
+            for cluster in clusters for worker in list(cluster.state.workers.data.values())
+        ]
+        stored = [(cluster.id, len(cluster.state.tasks)) for cluster in clusters]
+    managers = [(manager.name, manager.get_clients()) for manager in (events_manager, raw_events_manager)]
+    return "".join([
+        format_metric(
+            "celery_detect_worker_up", "gauge", "Whether the worker sent a heartbeat recently",
+            (({"cluster": cluster, "worker": hostname}, int(alive)) for cluster, hostname, alive in workers),
+        ),
+        format_metric(
+            "celery_detect_tasks_stored", "gauge", "Tasks kept in memory",
+            (({"cluster": cluster}, count) for cluster, count in stored),
+        ),
+        format_metric(
+            "celery_detect_tasks_evicted_total", "counter", "Tasks evicted by the retention policy",
+            (({"reason": reason}, count) for reason, count in evicted.items()),
+        ),
+        format_metric(
+            "celery_detect_event_queue_depth", "gauge", "Events waiting to be broadcast",
+            (({"cluster": cluster}, queue.depth) for cluster, queue in queues),
+        ),
+        format_metric(
+            "celery_detect_event_queue_dropped_total", "counter", "Events dropped because the event queue was full",
+            (({"cluster": cluster}, queue.dropped) for cluster, queue in queues),
+        ),
+        format_metric(
+            "celery_detect_event_queue_coalesced_total", "counter",
+            "Pending events replaced by a newer event for the same entity",
+            (({"cluster": cluster}, queue.coalesced) for cluster, queue in queues),
+        ),
+        format_metric(
+            "celery_detect_websocket_clients", "gauge", "Connected WebSocket clients",
+            (({"manager": name}, len(clients)) for name, clients in managers),
+        ),
+        format_metric(
+            "celery_detect_websocket_pending_messages", "gauge", "Messages waiting to be sent to WebSocket clients",
+            (({"manager": name}, sum(client.stats.pending for client in clients)) for name, clients in managers),
+        ),
+        format_metric(
+            "celery_detect_websocket_lag_seconds", "gauge", "Age of the oldest message not yet sent to a client",
+            (({"manager": name}, max((client.stats.lag for client in clients), default=0.0))
+             for name, clients in managers),
+        ),
+    ])
+
+
+def export_prometheus_metrics(request):
+    """Prometheus scrape endpoint."""
+    try:
+        metrics = prometheus_exporter.render(shard_pool.exporter_counts if shard_pool is not None else None)
+        gauges = render_gauges()
+    except ShardUnavailableError as e:
+        return HttpResponse(str(e), status=503)
+    return HttpResponse(metrics + gauges, content_type=CONTENT_TYPE)
@@ -1,17 +1,22 @@
+import io
 import logging
+import traceback
 import zipfile
-from io import BytesIO
-from typing import Any, NamedTuple
+from collections.abc import AsyncIterator, Iterable, Iterator
 from pathlib import Path
+from typing import Any, NamedTuple
 
 from asgiref.sync import sync_to_async
 from pydantic_core import to_json
 
 from celery_detect import settings
+from events.clusters import MergedSnapshot, clusters
 from events.receiver import state
-from server_info.models import ClientDebugInfo, ServerInfo, StateDump
-from tasks.models import Task
-from workers.models import Worker
+from events.sharding import shard_pool
+from events.snapshot import StateSnapshot
+from metrics.tracing import latency_tracer
+from server_info.models import ClientDebugInfo, ServerInfo
+from server_info.profiler import ProfilerBusyError, profiler
 from ws.managers import events_manager
 from ws.models import ClientInfo, UserAgentInfo
 
@@ -19,24 +24,62 @@ logger = logging.getLogger(__name__)
 
 Settings = settings.DebugBundleSettings
 
+#: Bytes of compressed output buffered before they are sent to the client.
+CHUNK_SIZE = 64 * 1024
+#: Tasks converted and serialized at a time.
+RECORDS_PER_CHUNK = 1000
 
-def dump_model(file: zipfile.ZipFile, filename: str, model: Any) -> None:
-    try:
-        settings_json = to_json(model, indent=4)
-        file.writestr(filename, settings_json)
-    except Exception as e:
-        logger.exception(f"Failed to dump object {model!r} to file {filename!r}: {e}")
 
+class _ChunkWriter(io.RawIOBase):
+    """Unseekable sink the zip file is written to, drained chunk by chunk as the bundle is streamed."""
 
-@sync_to_async
-def dump_file(file: zipfile.ZipFile, filename: str, path: Path) -> None:
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._offset = 0
+        self.pending = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        self.pending += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.pending = 0
+        return data
+
+
+def dump_model(model: Any) -> Iterator[bytes]:
+    yield to_json(model, indent=4)
+
+
+def dump_file(path: Path) -> Iterator[bytes]:
     if not path.is_file():
         logger.info(f"Unable to find file at {path!r}, skipping...")
         return
 
-    with path.open('r', encoding='utf-8') as f:
-        content = f.read()
-        file.writestr(filename, content)
+    with path.open('rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def dump_server_info(scope) -> Iterator[bytes]:
+    yield to_json(ServerInfo.create(scope, state), indent=4)
+
+
+def dump_records(chunks: Iterable[list], encode) -> Iterator[bytes]:
+    """Newline-delimited JSON of the records, as encoded by ``encode``, one chunk of records at a time."""
+    for chunk in chunks:
+        yield b"".join(encode(record) + b"\n" for record in chunk)
 
 
 class DebugBundleData(NamedTuple):
@@ -45,35 +88,67 @@ class DebugBundleData(NamedTuple):
     browser: UserAgentInfo
     client_info: ClientDebugInfo
     connections: list[ClientInfo]
-    state_dump: StateDump
-    server_info: ServerInfo
-
-
-def generate_bundle_file(data: DebugBundleData) -> BytesIO:
-    buffer = BytesIO()
-    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as file:
-        dump_file(file, "config.py", Path(data.settings.config_path))
-        dump_file(file, "app.log", Path(data.log_path))
-        dump_model(file, "settings.json", data.settings)
-        dump_model(file, "browser.json", data.browser)
-        dump_model(file, "client_info.json", data.client_info)
-        dump_model(file, "connections.json", data.connections)
-        dump_model(file, "state.json", data.state_dump)
-        dump_model(file, "server_info.json", data.server_info)
-
-    buffer.seek(0)
-    return buffer
-
-
-def get_state_dump() -> StateDump:
-    return StateDump(
-        tasks=[Task.from_celery_task(task) for _, task in state.tasks_by_time()],
-        workers=[Worker.from_celery_worker(worker) for worker in state.workers.itervalues()],
-    )
+    snapshot: StateSnapshot | MergedSnapshot | None  # None when the state is sharded
+    scope: dict
+    profile_seconds: float
+    profile_allocations: int
+
+
+def bundle_entries(data: DebugBundleData) -> Iterator[tuple[str, Iterable[bytes]]]:
+    yield "settings.json", dump_model(data.settings)
+    yield "browser.json", dump_model(data.browser)
+    yield "client_info.json", dump_model(data.client_info)
+    yield "connections.json", dump_model(data.connections)
+    yield "server_info.json", dump_server_info(data.scope)
+    yield "latency.json", dump_model(latency_tracer.report())
+    if data.snapshot is None:
+        yield "workers.ndjson", dump_records([shard_pool.workers()], bytes)
+        yield "tasks.ndjson", dump_records(shard_pool.iter_tasks(RECORDS_PER_CHUNK), bytes)
+    else:
+        yield "workers.ndjson", dump_records(
+            [data.snapshot.cluster_workers()], lambda pair: data.snapshot.convert_worker(pair[1], cluster=pair[0]).json
+        )
+        yield "tasks.ndjson", dump_records(
+            data.snapshot.iter_tasks(RECORDS_PER_CHUNK), lambda task: data.snapshot.convert_task(task).json
+        )
+    yield "app.log", dump_file(Path(data.log_path))
+    if data.profile_seconds > 0:
+        # Taken once the state is dumped, so the profile covers the server rather than the bundle
+        try:
+            report = profiler.profile(data.profile_seconds, data.profile_allocations)
+        except ProfilerBusyError as e:
+            logger.info(f"Leaving the profile out of the debug bundle: {e}")
+            return
+        yield "profile.folded", [report.collapsed().encode("utf-8")]
+        yield "profile.json", dump_model(report)
+
+
+def generate_bundle_file(data: DebugBundleData) -> Iterator[bytes]:
+    """Zip the bundle entries, yielding compressed bytes as they are produced.
+
+    Entries are written one chunk at a time (with zip64 data descriptors, as their sizes are not
+    known upfront), so memory stays bounded by the chunk sizes whatever the size of the state.
+    The chunks of an entry that fails are already streamed, so the entry is left partial (or empty)
+    and the error is written next to it, as ``<entry>.error``.
+    """
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as file:
+        for filename, chunks in bundle_entries(data):
+            try:
+                with file.open(filename, "w", force_zip64=True) as entry:
+                    for chunk in chunks:
+                        entry.write(chunk)
+                        if out.pending >= CHUNK_SIZE:
+                            yield out.drain()
+            except Exception as e:
+                logger.exception(f"Failed to dump {filename!r} to the debug bundle: {e}")
+                file.writestr(f"{filename}.error", "".join(traceback.format_exception(e)))
+    yield out.drain()
 
 
 @sync_to_async
-def create_debug_bundle(scope, client_info: ClientDebugInfo) -> BytesIO:
+def create_debug_bundle(scope, client_info: ClientDebugInfo, profile: bool = False) -> AsyncIterator[bytes]:
+    """Stream the debug bundle, with a profile of the server if ``profile`` (only ever for admins)."""
     headers = dict(scope['headers'])
     user_agent = headers.get(b'user-agent', b"").decode('utf-8')
     bundle_data = DebugBundleData(
@@ -82,7 +157,17 @@ def create_debug_bundle(scope, client_info: ClientDebugInfo) -> BytesIO:
         browser=UserAgentInfo.parse(user_agent),
         client_info=client_info,
         connections=list(events_manager.get_clients()),
-        state_dump=get_state_dump(),
-        server_info=ServerInfo.create(scope, state),
+        snapshot=clusters.snapshot() if shard_pool is None else None,
+        scope=scope,
+        profile_seconds=Settings.get('PROFILE_SECONDS', 0) if profile else 0,
+        profile_allocations=Settings.get('PROFILE_ALLOCATIONS', 0),
     )
-    return generate_bundle_file(bundle_data)
+    return stream_chunks(generate_bundle_file(bundle_data))
+
+
+async def stream_chunks(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """Produce the chunks in a worker thread, as the ASGI handler only streams async iterators."""
+    next_chunk = sync_to_async(next, thread_sensitive=False)
+    while (chunk := await next_chunk(chunks, None)) is not None:
+        if chunk:
+            yield chunk
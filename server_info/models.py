@@ -8,6 +8,13 @@ from typing import Self
 from celery.events.state import State
 from pydantic import BaseModel, Field
 
+from events.channel import ChannelStats
+from events.clusters import clusters
+from events.receiver import event_queue, retention, snapshots
+from events.retention import RetentionStats
+from events.sharding import shard_pool, sharded_event_queue
+from metrics.models import LatencyReport
+from metrics.tracing import latency_tracer
 from tasks.models import Task
 from workers.models import CPULoad, Worker
 
@@ -15,6 +22,13 @@ logger = logging.getLogger(__name__)
 start_time = time.time()
 
 
+class ClusterInfo(BaseModel):
+    id: str = Field(description="Cluster ID")
+    state_version: int = Field(description="Version of the cluster's state")
+    task_count: int = Field(description="Number of tasks of the cluster stored in state")
+    worker_count: int = Field(description="Number of workers of the cluster")
+
+
 class ServerInfo(BaseModel):
     cpu_usage: CPULoad = Field(description="CPU load average in last 1, 5 and 15 minutes")
     memory_usage: float = Field(description="Memory Usage in KB")
@@ -25,28 +39,68 @@ class ServerInfo(BaseModel):
     server_os: str = Field(description="Server OS")
     server_name: str = Field(description="Server Device Name")
     python_version: str = Field(description="Python Version")
+    state_version: int = Field(description="Version of the state, increased by every change applied to it")
     task_count: int = Field(description="Number of tasks stored in state")
     tasks_max_count: int = Field(description="Maximum number of tasks to store in state")
     worker_count: int = Field(description="Number of workers running")
     worker_max_count: int = Field(description="Maximum number of workers to store in state")
+    event_queue: ChannelStats = Field(description="Event hand-off queue depth and drop counts")
+    retention: RetentionStats = Field(description="Task retention policy and eviction counts")
+    latency: LatencyReport = Field(description="Sampled per-stage latency of events, from the broker to the clients")
+    clusters: list[ClusterInfo] = Field(description="Monitored Celery clusters, the default one first")
 
     @classmethod
     def create(cls, scope, state: State) -> Self:
+        """Info of the server and of ``state``, or of the state shards' when sharded."""
         rusage = resource.getrusage(resource.RUSAGE_SELF)
-        client = scope.get('client', ('', 0))
+        client = scope.get('client') or ('', 0)
+        if shard_pool is not None:
+            summary = shard_pool.summary()
+            cluster = ClusterInfo(
+                id=clusters.default.id,
+                state_version=summary.version,
+                task_count=summary.tasks,
+                worker_count=len(summary.workers),
+            )
+            stored = {
+                "state_version": summary.version,
+                "task_count": summary.tasks,
+                "worker_count": len(summary.workers),
+                "event_queue": sharded_event_queue.stats(),
+                "retention": summary.retention,
+                "clusters": [cluster],
+            }
+        else:
+            stored = {
+                "state_version": snapshots.version,
+                "task_count": len(state.tasks),
+                "worker_count": len(state.workers),
+                "event_queue": event_queue.stats(),
+                "retention": retention.stats(),
+                "clusters": [
+                    ClusterInfo(
+                        id=cluster.id,
+                        state_version=cluster.snapshots.version,
+                        task_count=len(cluster.state.tasks),
+                        worker_count=len(cluster.state.workers),
+                    )
+                    for cluster in clusters
+                ],
+            }
         return ServerInfo(
             cpu_usage=os.getloadavg(),
             memory_usage=rusage.ru_maxrss,
             uptime=time.time() - start_time,
             server_hostname=client[0],
             server_port=client[1],
+            server_version=os.environ.get("VERSION", "unknown"),
             server_os=platform.system(),
             server_name=platform.node(),
             python_version=platform.python_version(),
-            task_count=len(state.tasks),
             tasks_max_count=state.max_tasks_in_memory,
-            worker_count=len(state.workers),
             worker_max_count=state.max_workers_in_memory,
+            latency=latency_tracer.report(),
+            **stored,
         )
 
 
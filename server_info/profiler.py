@@ -0,0 +1,128 @@
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import FrameType
+from typing import Self
+
+from pydantic import BaseModel, Field
+
+from celery_detect.settings import ProfilerSettings
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+class AllocationStat(BaseModel):
+    location: str = Field(description="File and line the memory was allocated at")
+    size: int = Field(description="Bytes allocated there during the profile and still alive at its end")
+    count: int = Field(description="Number of those allocations")
+
+
+class ProfileReport(BaseModel):
+    seconds: float = Field(description="Duration of the profile in seconds")
+    interval: float = Field(description="Seconds between samples")
+    samples: int = Field(description="Number of times the threads' stacks were sampled")
+    stacks: dict[str, int] = Field(
+        description="Samples per stack, as semicolon separated frames from the thread name down to the running frame"
+    )
+    allocations: list[AllocationStat] | None = Field(
+        description="Largest allocation sites during the profile, if requested"
+    )
+
+    def collapsed(self) -> str:
+        """The stacks in the collapsed format read by flamegraph.pl, speedscope and similar tools."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    return f"{code.co_qualname} ({os.path.basename(os.path.dirname(path))}/{os.path.basename(path)}:{frame.f_lineno})"
+
+
+def _collapse(thread_name: str, frame: FrameType | None) -> str:
+    frames = []
+    while frame is not None:
+        frames.append(_frame_label(frame))
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+class SamplingProfiler:
+    """Statistical profiler of every thread of the running server, e.g, the event receiver and the event loops.
+
+    A background thread reads the stacks of the other threads every ``interval`` seconds through
+    ``sys._current_frames``, so the profiled code runs unmodified and the overhead does not depend
+    on how busy it is. Only one profile runs at a time.
+    """
+
+    def __init__(self, interval: float, max_seconds: float, token: str | None = None):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.token = token
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: dict = ProfilerSettings) -> Self:
+        return cls(
+            interval=settings.get("INTERVAL", 0.005),
+            max_seconds=settings.get("MAX_SECONDS", 60),
+            token=settings.get("TOKEN"),
+        )
+
+    def profile(self, seconds: float, allocations: int = 0) -> ProfileReport:
+        """Sample the threads for ``seconds``, and trace the ``allocations`` largest allocation sites if > 0."""
+        seconds = min(max(seconds, self.interval), self.max_seconds)
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already running")
+        try:
+            return self._profile(seconds, allocations)
+        finally:
+            self._lock.release()
+
+    def _profile(self, seconds: float, allocations: int) -> ProfileReport:
+        trace_allocations = allocations > 0 and not tracemalloc.is_tracing()
+        if trace_allocations:
+            tracemalloc.start()
+        logger.info(f"Profiling for {seconds} seconds...")
+        stacks: Counter[str] = Counter()
+        samples = 0
+        own = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + seconds
+        try:
+            while (now := time.monotonic()) < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+                samples += 1
+                time.sleep(min(self.interval, max(deadline - now, 0)))
+            top = None
+            if allocations > 0:
+                statistics = tracemalloc.take_snapshot().statistics("lineno")[:allocations]
+                top = [
+                    AllocationStat(location=str(stat.traceback), size=stat.size, count=stat.count)
+                    for stat in statistics
+                ]
+        finally:
+            if trace_allocations:
+                tracemalloc.stop()
+        return ProfileReport(
+            seconds=round(time.monotonic() - started, 3),
+            interval=self.interval,
+            samples=samples,
+            stacks=dict(stacks.most_common()),
+            allocations=top,
+        )
+
+
+profiler = SamplingProfiler.from_settings()
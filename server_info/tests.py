@@ -1,3 +1,155 @@
-from django.test import TestCase
+import io
+import json
+import threading
+import time
+import uuid
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import AsyncClient, SimpleTestCase
+
+from events.clusters import ClusterRegistry, clusters
+from server_info import debug_bundle
+from server_info.debug_bundle import DebugBundleData, dump_records, generate_bundle_file
+from server_info.factories import ClientDebugInfoFactory
+from server_info.profiler import ProfilerBusyError, SamplingProfiler, profiler
+from ws.models import UserAgentInfo
+
+
+class ServerInfoTests(SimpleTestCase):
+    async def test_server_info_reports_the_state_and_pipeline_stats(self):
+        response = await AsyncClient().get("/api/settings/info/")
+
+        self.assertEqual(response.status_code, 200)
+        info = response.json()
+        self.assertEqual([cluster["id"] for cluster in info["clusters"]], [cluster.id for cluster in clusters])
+        self.assertEqual(info["state_version"], clusters.default.snapshots.version)
+        for field in ("event_queue", "retention", "latency"):
+            self.assertIn(field, info)
+
+
+class DebugBundleTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = ClusterRegistry(["other"], default="main")
+        self.tasks = {}
+        for cluster in self.registry:
+            now = time.time()
+            cluster.snapshots.apply({
+                "type": "worker-online", "hostname": f"celery@{cluster.id}", "pid": 1, "freq": 2.0,
+                "sw_ident": "py-celery", "sw_ver": "5.4.0", "sw_sys": "Linux", "active": 0, "processed": 0,
+                "loadavg": [0.0, 0.0, 0.0], "timestamp": now, "local_received": now, "clock": 1,
+            })
+            for _ in range(5):
+                task_id = str(uuid.uuid4())
+                cluster.snapshots.apply({
+                    "type": "task-received", "uuid": task_id, "name": "tests.add", "hostname": f"celery@{cluster.id}",
+                    "timestamp": now, "local_received": now, "clock": 1,
+                })
+                self.tasks[task_id] = cluster.id
+
+    def bundle(self) -> DebugBundleData:
+        return DebugBundleData(
+            settings={"LOG_FILE_PATH": "/nonexistent/app.log"},
+            log_path="/nonexistent/app.log",
+            browser=UserAgentInfo.parse(""),
+            client_info=ClientDebugInfoFactory.build(),
+            connections=[],
+            snapshot=self.registry.snapshot(),
+            scope={"client": ("127.0.0.1", 8000)},
+            profile_seconds=0,
+            profile_allocations=0,
+        )
+
+    def unzip(self, chunks) -> zipfile.ZipFile:
+        return zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+
+    def test_the_state_of_every_cluster_is_dumped_as_ndjson(self):
+        with self.unzip(generate_bundle_file(self.bundle())) as bundle:
+            tasks = [json.loads(line) for line in bundle.read("tasks.ndjson").splitlines()]
+            workers = [json.loads(line) for line in bundle.read("workers.ndjson").splitlines()]
+            names = bundle.namelist()
+            # Missing log files are left empty
+            self.assertEqual(bundle.read("app.log"), b"")
+        self.assertEqual({task["id"]: task["cluster"] for task in tasks}, self.tasks)
+        self.assertEqual(sorted(worker["hostname"] for worker in workers), ["celery@main", "celery@other"])
+        for name in ("settings.json", "client_info.json", "server_info.json", "latency.json"):
+            self.assertIn(name, names)
+
+    def test_the_bundle_is_streamed_in_chunks(self):
+        with (
+            mock.patch.object(debug_bundle, "CHUNK_SIZE", 256),
+            mock.patch.object(debug_bundle, "RECORDS_PER_CHUNK", 2),
+        ):
+            chunks = list(generate_bundle_file(self.bundle()))
+        self.assertGreater(len(chunks), 2)
+        with self.unzip(chunks) as bundle:
+            self.assertEqual(len(bundle.read("tasks.ndjson").splitlines()), len(self.tasks))
+
+    def test_a_failing_entry_is_reported_next_to_it(self):
+        def failing():
+            yield b"partial"
+            raise RuntimeError("dump failed")
+
+        entries = [("good.json", [b"{}"]), ("bad.ndjson", failing()), ("after.json", [b"[]"])]
+        with (
+            mock.patch.object(debug_bundle, "bundle_entries", lambda data: iter(entries)),
+            self.assertLogs("server_info.debug_bundle", "ERROR"),
+        ):
+            chunks = list(generate_bundle_file(self.bundle()))
+        with self.unzip(chunks) as bundle:
+            self.assertEqual(bundle.read("good.json"), b"{}")
+            self.assertIn(b"RuntimeError: dump failed", bundle.read("bad.ndjson.error"))
+            self.assertEqual(bundle.read("after.json"), b"[]")
+
+    def test_records_are_dumped_one_chunk_at_a_time(self):
+        self.assertEqual(list(dump_records([[1, 2], [3]], lambda n: str(n).encode())), [b"1\n2\n", b"3\n"])
+
+
+class ProfilerTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(profiler, "token", "secret")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def get(self, token: str | None = None, **params):
+        headers = {"Authorization": f"Bearer {token}"} if token is not None else {}
+        return await AsyncClient().get("/api/settings/profile/", {"seconds": 0.05, **params}, headers=headers)
+
+    async def test_profiles_are_restricted_to_admins(self):
+        self.assertEqual((await self.get()).status_code, 403)
+        self.assertEqual((await self.get("wrong")).status_code, 403)
+        with mock.patch.object(profiler, "token", None):
+            self.assertEqual((await self.get("")).status_code, 403)
+
+    async def test_admins_get_the_collapsed_stacks_of_every_thread(self):
+        response = await self.get("secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain")
+        for line in response.content.decode().splitlines():
+            stack, _, count = line.rpartition(" ")
+            self.assertTrue(stack)
+            self.assertGreater(int(count), 0)
+
+    async def test_allocations_are_reported_in_the_json_report(self):
+        report = (await self.get("secret", allocations=3)).json()
+        self.assertGreater(report["samples"], 0)
+        self.assertLessEqual(len(report["allocations"]), 3)
+
+    async def test_one_profile_runs_at_a_time(self):
+        with profiler._lock:
+            self.assertEqual((await self.get("secret")).status_code, 409)
+
+    def test_the_other_threads_are_sampled_for_at_most_max_seconds(self):
+        done = threading.Event()
+        thread = threading.Thread(target=done.wait, name="ProfiledThread")
+        thread.start()
+        try:
+            report = SamplingProfiler(interval=0.01, max_seconds=0.05).profile(10)
+        finally:
+            done.set()
+            thread.join()
+        self.assertLess(report.seconds, 1)
+        self.assertTrue(any(stack.startswith("ProfiledThread;") for stack in report.stacks))
+        busy = SamplingProfiler(interval=0.01, max_seconds=0.05)
+        with busy._lock, self.assertRaises(ProfilerBusyError):
+            busy.profile(0.01)
@@ -7,5 +7,7 @@ urlpatterns = [
     path('info/', views.get_server_info),
     path('clients/', views.get_clients),
     path('clear/', views.clear_state),
+    path('retention/', views.retention_policy),
+    path('profile/', views.profile),
     path('download-debug-bundle/', views.download_debug_bundle),
 ]
\ No newline at end of file
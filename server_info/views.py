@@ -1,24 +1,36 @@
+import asyncio
+import hmac
 import json
-from django.http import JsonResponse, StreamingHttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from pydantic import ValidationError
 from django.views.decorators.csrf import csrf_exempt
 
-from events.receiver import state
+from events.clusters import UnknownClusterError, clusters
+from events.exceptions import ShardUnavailableError
+from events.journal import event_journal
+from events.receiver import evict_tasks, state
+from events.sharding import shard_pool
+from events.retention import RetentionPolicy
 from server_info.debug_bundle import create_debug_bundle
 from server_info.models import ClientDebugInfo, ServerInfo
+from server_info.profiler import ProfilerBusyError, profiler
 from ws.managers import events_manager
 from asgiref.sync import sync_to_async
 
 
 @sync_to_async
 def create_server_info(request):
-    return ServerInfo.create(request, state)
+    return ServerInfo.create(request.scope, state)
 
 
 @csrf_exempt
 async def get_server_info(request):
     # 使用同步函数来创建ServerInfo
-    server_info = await create_server_info(request)
-    return JsonResponse(server_info)
+    try:
+        server_info = await create_server_info(request)
+    except ShardUnavailableError as e:
+        return HttpResponse(str(e), status=503)
+    return JsonResponse(server_info.model_dump())
 
 
 @csrf_exempt
@@ -30,18 +42,98 @@ async def get_clients(request):
 
 @csrf_exempt
 async def clear_state(request):
+    """Clear the state of every cluster, or of the one given as ``cluster``."""
     force = request.POST.get('force', 'false').lower() in ['true', '1', 'yes']
-    state.clear(ready=not force)
+    try:
+        selected = clusters.select(request.POST.get('cluster') or None)
+    except UnknownClusterError as e:
+        return HttpResponseBadRequest(str(e))
+    if shard_pool is not None:
+        # The shards hold the state of the default cluster, the only one consumed when sharded
+        try:
+            await asyncio.to_thread(shard_pool.clear, not force)
+        except ShardUnavailableError as e:
+            return HttpResponse(str(e), status=503)
+        return JsonResponse({"success": True})
+    for cluster in selected:
+        journal = event_journal if cluster is clusters.default else None
+        await asyncio.to_thread(cluster.clear, not force, journal)
     return JsonResponse({"success": True})
 
 
+@csrf_exempt
+async def retention_policy(request):
+    """Current task retention policy and eviction counts of the default cluster, or of the one given as
+    ``cluster``; POST a policy to apply it to every cluster without a restart."""
+    try:
+        cluster = clusters.get(request.GET.get('cluster') or None)
+    except UnknownClusterError as e:
+        return HttpResponseBadRequest(str(e))
+    policy = None
+    if request.method == 'POST':
+        try:
+            policy = RetentionPolicy.model_validate_json(request.body)
+        except ValidationError as e:
+            return HttpResponseBadRequest(f"Invalid retention policy: {e}")
+    if shard_pool is not None:
+        try:
+            if policy is not None:
+                await asyncio.to_thread(shard_pool.set_retention_policy, policy)
+            summary = await asyncio.to_thread(shard_pool.summary)
+        except ShardUnavailableError as e:
+            return HttpResponse(str(e), status=503)
+        return JsonResponse(summary.retention.model_dump())
+    if policy is not None:
+        # Evicting the tasks the policy no longer retains takes as long as there are tasks to evict
+        await asyncio.to_thread(set_retention_policy, policy)
+    return JsonResponse(cluster.retention.stats().model_dump())
+
+
+def set_retention_policy(policy: RetentionPolicy) -> None:
+    for each in clusters:
+        evict_tasks(each.retention.set_policy(policy), each, event_journal if each is clusters.default else None)
+
+
+def is_admin(request) -> bool:
+    token = profiler.token
+    if not token:
+        return False
+    provided = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return hmac.compare_digest(provided.encode(), token.encode())
+
+
+@csrf_exempt
+async def profile(request):
+    """Profile the server for ``seconds``, returning collapsed stacks, or the JSON report with ``format=json``.
+
+    ``allocations=N`` also traces the N largest allocation sites, reported in the JSON report (the default then).
+    """
+    if not is_admin(request):
+        return HttpResponseForbidden("Profiling is restricted to admins")
+    try:
+        seconds = float(request.GET.get('seconds', 10))
+        allocations = int(request.GET.get('allocations', 0))
+    except ValueError as e:
+        return HttpResponseBadRequest(f"seconds and allocations must be numbers: {e}")
+
+    try:
+        # Off the shared thread, so other sync views are not held up for the duration of the profile
+        report = await sync_to_async(profiler.profile, thread_sensitive=False)(seconds, allocations)
+    except ProfilerBusyError as e:
+        return HttpResponse(str(e), status=409)
+
+    if request.GET.get('format', 'json' if allocations else 'collapsed') == 'json':
+        return JsonResponse(report.model_dump())
+    return HttpResponse(report.collapsed(), content_type='text/plain')
+
+
 @csrf_exempt
 async def download_debug_bundle(request):
     client_info_data = json.loads(request.body)
     client_info = ClientDebugInfo(**client_info_data)
-    buffer = await create_debug_bundle(request, client_info)
+    chunks = await create_debug_bundle(request.scope, client_info, profile=is_admin(request))
     response = StreamingHttpResponse(
-        buffer, content_type='application/zip'
+        chunks, content_type='application/zip'
     )
     response['Content-Disposition'] = 'attachment; filename=debug_bundle.zip'
     return response
@@ -0,0 +1,338 @@
+import heapq
+import itertools
+import logging
+import threading
+from bisect import bisect_left
+from collections.abc import Callable, Iterable, Iterator
+from operator import itemgetter
+from typing import NamedTuple, Self
+
+from celery.events.state import Task as CeleryTask
+
+from celery_detect.settings import CELERY_MAX_TASKS
+
+logger = logging.getLogger(__name__)
+
+TaskLookup = Callable[[str], CeleryTask | None]
+
+#: Task attributes the index is keyed by, in the order they are stored per task.
+INDEXED_FIELDS = ("state", "type", "worker", "root_id", "cluster")
+#: Sequence of the updates of every index, so the tasks of several indexes are ordered by last update too.
+_updates = itertools.count(1)
+#: Index entries examined per acquisition of the index lock by queries.
+SCAN_CHUNK = 512
+
+
+class TaskFilter(NamedTuple):
+    state: str | None = None
+    type: str | None = None
+    worker: str | None = None
+    root_id: str | None = None
+    cluster: str | None = None
+
+    @classmethod
+    def from_query(cls, params) -> Self:
+        return cls(*(params.get(field) or None for field in INDEXED_FIELDS))
+
+    def items(self) -> list[tuple[int, str]]:
+        return [(position, value) for position, value in enumerate(self) if value is not None]
+
+
+class TaskPage(NamedTuple):
+    tasks: list[CeleryTask]
+    total: int
+    next_cursor: int | None
+    seqs: list[int] = []  # of the tasks, to merge pages by
+
+
+def task_keys(task: CeleryTask) -> TaskFilter:
+    return TaskFilter(
+        state=task.state,
+        type=task.name,
+        worker=task.worker.hostname if task.worker is not None else None,
+        root_id=task.root_id,
+        cluster=getattr(task.cluster_state, "cluster", None),
+    )
+
+
+class _Postings:
+    """Append-only list of ``(seq, uuid)`` entries, ordered by seq.
+
+    Entries are never removed in place. An entry is live only while its seq is
+    the latest seq recorded for the uuid, so re-indexing a task simply appends
+    a new entry and leaves the old one stale. Stale entries are compacted away
+    once they outnumber the live ones, which keeps updates amortized O(1).
+    """
+
+    __slots__ = ("seqs", "uuids", "live")
+
+    def __init__(self):
+        self.seqs: list[int] = []
+        self.uuids: list[str] = []
+        self.live = 0
+
+    def append(self, seq: int, uuid: str) -> None:
+        self.seqs.append(seq)
+        self.uuids.append(uuid)
+        self.live += 1
+
+    def needs_compaction(self) -> bool:
+        return len(self.seqs) > 2 * self.live + 64
+
+    def compact(self, current: dict[str, int]) -> None:
+        seqs, uuids = [], []
+        for seq, uuid in zip(self.seqs, self.uuids):
+            if current.get(uuid) == seq:
+                seqs.append(seq)
+                uuids.append(uuid)
+        self.seqs, self.uuids = seqs, uuids
+        self.live = len(seqs)
+
+    def iter_before(self, cursor: int | None) -> Iterator[tuple[int, str]]:
+        """Yield entries newest first, starting strictly before ``cursor``."""
+        position = len(self.seqs) if cursor is None else bisect_left(self.seqs, cursor)
+        seqs, uuids = self.seqs, self.uuids
+        for i in range(position - 1, -1, -1):
+            yield seqs[i], uuids[i]
+
+
+class TaskIndex:
+    """Secondary index over the tasks stored in the state of a cluster, ordered by last update.
+
+    Every task event bumps the task to the head of the index and re-files it
+    under its current state, type, worker and root id, so tasks are listed in
+    the order of ``State.tasks_by_time``. Queries walk the smallest matching
+    posting list from a cursor, so a page costs O(log n + page size) regardless
+    of how many tasks are stored. The walk takes the index lock for
+    ``SCAN_CHUNK`` entries at a time, and tasks are looked up without it, so
+    skipping an ``offset`` never blocks updates for long. Each cluster has an
+    index of its own, see :func:`query_indexes` to list several of them.
+    """
+
+    def __init__(self, max_tasks: int = CELERY_MAX_TASKS):
+        self.max_tasks = max_tasks
+        self._lock = threading.Lock()
+        self._current: dict[str, int] = {}
+        self._keys: dict[str, TaskFilter] = {}
+        self._all = _Postings()
+        self._head = 0
+        self._postings: tuple[dict[str, _Postings], ...] = tuple({} for _ in INDEXED_FIELDS)
+
+    def __len__(self) -> int:
+        return len(self._current)
+
+    def update(self, task: CeleryTask) -> None:
+        keys = task_keys(task)
+        uuid = task.uuid
+        with self._lock:
+            seq = next(_updates)
+            self._remove(uuid)
+            self._current[uuid] = seq
+            self._keys[uuid] = keys
+            self._all.append(seq, uuid)
+            for position, value in keys.items():
+                postings = self._postings[position].get(value)
+                if postings is None:
+                    postings = self._postings[position][value] = _Postings()
+                postings.append(seq, uuid)
+                if postings.needs_compaction():
+                    postings.compact(self._current)
+            if self._all.needs_compaction():
+                self._all.compact(self._current)
+                self._head = 0
+            self._evict_overflow()
+
+    def discard(self, uuid: str) -> None:
+        with self._lock:
+            self._remove(uuid)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._current.clear()
+            self._keys.clear()
+            self._all = _Postings()
+            self._head = 0
+            self._postings = tuple({} for _ in INDEXED_FIELDS)
+
+    @classmethod
+    def from_tasks(cls, tasks: Iterable[CeleryTask], max_tasks: int = CELERY_MAX_TASKS) -> Self:
+        """A new index of ``tasks``, given oldest first."""
+        index = cls(max_tasks=max_tasks)
+        for task in tasks:
+            index.update(task)
+        return index
+
+    def rebuild(self, tasks: Iterator[CeleryTask]) -> None:
+        """Re-index ``tasks``, given oldest first."""
+        self.clear()
+        for task in tasks:
+            self.update(task)
+
+    def query(
+            self,
+            lookup: TaskLookup,
+            filters: TaskFilter = TaskFilter(),
+            cursor: int | None = None,
+            limit: int = 1000,
+            offset: int = 0,
+            exists: Callable[[str], bool] | None = None,
+    ) -> TaskPage:
+        """Return a page of tasks, most recently updated first, with the number of tasks matching ``filters``.
+
+        ``lookup`` resolves a uuid to the task in state; uuids it no longer knows
+        about have been evicted from state and are dropped from the index. When
+        ``lookup`` reads from a snapshot, ``exists`` tells which of them are still
+        in the live state (i.e, were only added after the snapshot was taken), and
+        the filters are checked again on the tasks it returns, which may be older
+        than the ones indexed.
+        """
+        constraints = filters.items()
+        tasks: list[CeleryTask] = []
+        seqs: list[int] = []
+        evicted: list[tuple[int, str]] = []
+        next_cursor = None
+        scanned, exhausted = cursor, False
+        while not exhausted and next_cursor is None:
+            with self._lock:
+                entries, scanned, exhausted = self._scan(filters, scanned)
+            for seq, uuid in entries:
+                task = lookup(uuid)
+                if task is None:
+                    if exists is None or not exists(uuid):
+                        evicted.append((seq, uuid))
+                    continue
+                if constraints and any(task_keys(task)[position] != value for position, value in constraints):
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                if len(tasks) == limit:
+                    next_cursor = seqs[-1]
+                    break
+                tasks.append(task)
+                seqs.append(seq)
+
+        total = self.count(filters)
+        if evicted:
+            with self._lock:
+                for seq, uuid in evicted:
+                    # Unless an event stored it again in the meantime
+                    if self._current.get(uuid) == seq:
+                        self._remove(uuid)
+                        total -= 1
+        return TaskPage(tasks=tasks, total=total, next_cursor=next_cursor, seqs=seqs)
+
+    def count(self, filters: TaskFilter = TaskFilter()) -> int:
+        """Number of indexed tasks matching ``filters``: O(1) for one filter at most, otherwise in time proportional
+        to the number of tasks matching the most selective filter."""
+        constraints = filters.items()
+        with self._lock:
+            if not constraints:
+                return self._all.live
+            if len(constraints) == 1:
+                [(position, value)] = constraints
+                postings = self._postings[position].get(value)
+                return postings.live if postings is not None else 0
+        total, scanned, exhausted = 0, None, False
+        while not exhausted:
+            with self._lock:
+                entries, scanned, exhausted = self._scan(filters, scanned)
+            total += len(entries)
+        return total
+
+    def workflow(self, root_id: str) -> list[str]:
+        """Uuids of the indexed tasks sharing ``root_id``, in time proportional to the workflow's size."""
+        with self._lock:
+            postings = self._postings[INDEXED_FIELDS.index("root_id")].get(root_id)
+            if postings is None:
+                return []
+            current = self._current
+            return [uuid for seq, uuid in zip(postings.seqs, postings.uuids) if current.get(uuid) == seq]
+
+    def _plan(self, filters: TaskFilter) -> tuple[_Postings | None, list[tuple[int, str]]]:
+        """Pick the smallest posting list to drive the scan; the rest become checks."""
+        constraints = filters.items()
+        if not constraints:
+            return self._all, []
+
+        candidates = []
+        for position, value in constraints:
+            postings = self._postings[position].get(value)
+            if postings is None or not postings.live:
+                return None, []
+            candidates.append((postings.live, position, postings))
+
+        _, driver_position, driver = min(candidates, key=lambda candidate: candidate[0])
+        checks = [(position, value) for position, value in constraints if position != driver_position]
+        return driver, checks
+
+    def _scan(self, filters: TaskFilter, cursor: int | None) -> tuple[list[tuple[int, str]], int | None, bool]:
+        """Live entries matching ``filters`` among the next ``SCAN_CHUNK`` entries before ``cursor``, newest first,
+        with the cursor to continue from and whether the scan is over. Called with the lock held.
+
+        The posting lists may have been compacted or dropped since the previous chunk, so the scan is planned
+        again for every chunk: entries are ordered by seq in every list, so any of them continues from the cursor.
+        """
+        driver, checks = self._plan(filters)
+        if driver is None:
+            return [], None, True
+        current, keys = self._current, self._keys
+        entries = []
+        examined = 0
+        for seq, uuid in driver.iter_before(cursor):
+            if examined == SCAN_CHUNK:
+                return entries, cursor, False
+            examined += 1
+            cursor = seq
+            if current.get(uuid) != seq:
+                continue
+            if checks and any(keys[uuid][position] != value for position, value in checks):
+                continue
+            entries.append((seq, uuid))
+        return entries, cursor, True
+
+    def _remove(self, uuid: str) -> None:
+        if self._current.pop(uuid, None) is None:
+            return
+        self._all.live -= 1
+        for position, value in self._keys.pop(uuid).items():
+            postings = self._postings[position][value]
+            postings.live -= 1
+            if not postings.live:
+                del self._postings[position][value]
+
+    def _evict_overflow(self) -> None:
+        # Everything before _head is known to be stale, so eviction never rescans it.
+        seqs, uuids = self._all.seqs, self._all.uuids
+        while len(self._current) > self.max_tasks:
+            seq, uuid = seqs[self._head], uuids[self._head]
+            self._head += 1
+            if self._current.get(uuid) == seq:
+                self._remove(uuid)
+
+
+def query_indexes(
+        indexes: list[tuple[TaskIndex, TaskLookup, Callable[[str], bool] | None]],
+        filters: TaskFilter = TaskFilter(),
+        cursor: int | None = None,
+        limit: int = 1000,
+        offset: int = 0,
+) -> TaskPage:
+    """A page of the tasks of several indexes, each with its ``lookup`` and ``exists`` (see :meth:`TaskIndex.query`),
+    newest first. Every index is asked for the tasks up to the end of the page, which are merged by last update."""
+    if len(indexes) == 1:
+        index, lookup, exists = indexes[0]
+        return index.query(lookup, filters=filters, cursor=cursor, limit=limit, offset=offset, exists=exists)
+    pages = [
+        index.query(lookup, filters=filters, cursor=cursor, limit=offset + limit, exists=exists)
+        for index, lookup, exists in indexes
+    ]
+    merged = list(heapq.merge(*(zip(page.seqs, page.tasks) for page in pages), key=itemgetter(0), reverse=True))
+    entries = merged[offset:offset + limit]
+    more = len(merged) > offset + limit or any(page.next_cursor is not None for page in pages)
+    return TaskPage(
+        tasks=[task for _, task in entries],
+        total=sum(page.total for page in pages),
+        next_cursor=entries[-1][0] if more and entries else None,
+        seqs=[seq for seq, _ in entries],
+    )
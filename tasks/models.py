@@ -51,6 +51,7 @@ class Task(BaseModel):
     result: str | None = Field(None, description="Task returned result")
     exception: str | None = Field(None, description="Task failure exception message")
     traceback: str | None = Field(None, description="Task failure traceback")
+    cluster: str | None = Field(None, description="Celery cluster the task runs in")
 
     @classmethod
     def from_celery_task(cls, task: CeleryTask) -> Self:
@@ -85,9 +86,25 @@ class Task(BaseModel):
             result=task.result,
             exception=task.exception,
             traceback=task.traceback,
+            cluster=getattr(task.cluster_state, "cluster", None),
         )
 
 
+class WorkflowNode(BaseModel):
+    task: Task = Field(description="Task in the workflow")
+    depth: int = Field(description="Distance from the workflow root")
+    aggregate_runtime: float = Field(description="Runtime of the task and all of its descendants in seconds")
+    finished_at: EpochTimestamp | None = Field(None, description="When the task succeeded or failed")
+
+
+class Workflow(BaseModel):
+    root_id: str = Field(description="Root Task ID")
+    nodes: list[WorkflowNode] = Field(description="Tasks in the workflow, parents before children")
+    critical_path: list[str] = Field(description="Task IDs from the root to the task that finished last")
+    total_runtime: float = Field(description="Sum of all task runtimes in seconds")
+    duration: float | None = Field(None, description="Seconds from the root being sent to the last task finishing")
+
+
 class TaskResult(BaseModel):
     id: str = Field(description="Task ID")
     type: str | None = Field(None, description="Task type name")
@@ -0,0 +1,202 @@
+import time
+import uuid
+from unittest import mock
+
+from celery.events.state import State
+from django.test import SimpleTestCase
+
+from events.changelog import ChangeLog
+from events.clusters import clusters
+from events.factories import SyntheticCluster
+from events.receiver import apply_event, evict_tasks
+from events.snapshot import SnapshotManager
+from tasks import index as task_index
+from tasks.index import TaskFilter, TaskIndex, query_indexes, task_keys
+from tasks.workflow import build_workflow
+
+START = 1_700_000_000.0
+
+
+def indexed_state(workflows: int = 10, seed: int = 1) -> tuple[State, TaskIndex]:
+    state = State()
+    index = TaskIndex()
+    for event in SyntheticCluster(seed=seed).events(workflows):
+        state.event(event)
+        if event["type"].startswith("task-"):
+            index.update(state.tasks[event["uuid"]])
+    return state, index
+
+
+def matching(state: State, filters: TaskFilter) -> list[str]:
+    """Uuids of the stored tasks matching ``filters``, most recently updated first."""
+    checks = filters.items()
+    return [
+        uuid for uuid, task in state.tasks_by_time()
+        # The task heap of the state outlives the tasks evicted from it
+        if uuid in state.tasks and all(task_keys(task)[position] == value for position, value in checks)
+    ]
+
+
+class TaskIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.state, self.index = indexed_state()
+        # Small chunks, so pages span several acquisitions of the index lock
+        patcher = mock.patch.object(task_index, "SCAN_CHUNK", 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tasks_are_listed_most_recently_updated_first(self):
+        page = self.index.query(self.state.tasks.get, limit=1000)
+        self.assertEqual([task.uuid for task in page.tasks], matching(self.state, TaskFilter()))
+        self.assertEqual(page.total, len(self.state.tasks))
+        self.assertIsNone(page.next_cursor)
+
+    def test_cursor_pages_list_every_matching_task_once(self):
+        filters = TaskFilter(state="SUCCESS", type="test_project.app.create_invoice")
+        uuids, cursor = [], None
+        while True:
+            page = self.index.query(self.state.tasks.get, filters=filters, cursor=cursor, limit=3)
+            uuids += [task.uuid for task in page.tasks]
+            if (cursor := page.next_cursor) is None:
+                break
+        self.assertEqual(uuids, matching(self.state, filters))
+
+    def test_offset_pages_skip_the_matching_tasks(self):
+        filters = TaskFilter(state="SUCCESS")
+        page = self.index.query(self.state.tasks.get, filters=filters, limit=5, offset=4)
+        self.assertEqual([task.uuid for task in page.tasks], matching(self.state, filters)[4:9])
+
+    def test_total_counts_the_tasks_matching_every_filter(self):
+        for filters in (
+                TaskFilter(),
+                TaskFilter(state="SUCCESS"),
+                TaskFilter(state="SUCCESS", type="test_project.app.create_invoice"),
+                TaskFilter(state="FAILURE", worker="celery@worker-6", type="test_project.app.order_workflow"),
+                TaskFilter(state="PENDING"),
+        ):
+            with self.subTest(filters=filters):
+                page = self.index.query(self.state.tasks.get, filters=filters, limit=1)
+                self.assertEqual(page.total, len(matching(self.state, filters)))
+                self.assertEqual(self.index.count(filters), page.total)
+
+    def test_tasks_evicted_from_the_state_are_dropped(self):
+        evicted = matching(self.state, TaskFilter())[:4]
+        for uuid in evicted:
+            del self.state.tasks[uuid]
+        page = self.index.query(self.state.tasks.get, limit=1000)
+        self.assertEqual([task.uuid for task in page.tasks], matching(self.state, TaskFilter()))
+        self.assertEqual(page.total, len(self.state.tasks))
+        self.assertEqual(len(self.index), len(self.state.tasks))
+
+    def test_query_indexes_merges_several_indexes_by_last_update(self):
+        other_state, other_index = indexed_state(seed=2)
+        indexes = [(self.index, self.state.tasks.get, None), (other_index, other_state.tasks.get, None)]
+        # Every task of the other index was updated after those of this one
+        expected = matching(other_state, TaskFilter()) + matching(self.state, TaskFilter())
+
+        page = query_indexes(indexes, limit=10, offset=5)
+        self.assertEqual([task.uuid for task in page.tasks], expected[5:15])
+        self.assertEqual(page.total, len(expected))
+
+
+class WorkflowTests(SimpleTestCase):
+    def setUp(self):
+        self.snapshots = SnapshotManager(State(), ChangeLog(1000))
+        self.index = TaskIndex()
+        # (task, parent, sent, succeeded, runtime): a and b are children of the root, c of a
+        for task_id, parent_id, sent, succeeded, runtime in (
+                ("root", None, 0.0, 2.0, 1.0),
+                ("a", "root", 2.0, 5.0, 3.0),
+                ("b", "root", 3.0, 12.0, 10.0),
+                ("c", "a", 5.0, 20.0, 4.0),
+        ):
+            self.event(task_id, "task-sent", sent, root_id="root", parent_id=parent_id)
+            self.event(task_id, "task-succeeded", succeeded, runtime=runtime)
+
+    def event(self, task_id: str, type_: str, timestamp: float, **fields) -> None:
+        """Apply a task event happening ``timestamp`` seconds after the workflow started."""
+        self.snapshots.apply({
+            "type": type_, "uuid": task_id, "name": "tests.add", "hostname": "worker@tests",
+            "timestamp": START + timestamp, "local_received": START + timestamp, "clock": 1, **fields,
+        })
+        self.index.update(self.snapshots.state.tasks[task_id])
+
+    def workflow(self, task_id: str):
+        return build_workflow(self.snapshots.state.tasks[task_id], self.snapshots.snapshot(), self.index)
+
+    def test_nodes_are_listed_parents_first_with_their_aggregate_runtime(self):
+        workflow = self.workflow("c")
+        self.assertEqual(workflow.root_id, "root")
+        self.assertEqual(
+            [(node.task.id, node.depth, node.aggregate_runtime) for node in workflow.nodes],
+            [("root", 0, 18.0), ("a", 1, 7.0), ("b", 1, 10.0), ("c", 2, 4.0)],
+        )
+        self.assertEqual((workflow.total_runtime, workflow.duration), (18.0, 20.0))
+
+    def test_the_critical_path_leads_to_the_task_that_finished_last(self):
+        self.assertEqual(self.workflow("root").critical_path, ["root", "a", "c"])
+
+        self.event("b", "task-succeeded", 30.0, runtime=27.0)
+        self.assertEqual(self.workflow("root").critical_path, ["root", "b"])
+
+    def test_tasks_whose_parent_was_evicted_hang_off_the_top(self):
+        del self.snapshots.state.tasks["a"]
+        workflow = self.workflow("root")
+        self.assertEqual(
+            [(node.task.id, node.depth) for node in workflow.nodes], [("root", 0), ("c", 0), ("b", 1)],
+        )
+        self.assertEqual(workflow.critical_path, ["c"])
+
+
+class TaskListTests(SimpleTestCase):
+    def setUp(self):
+        # The tasks of other tests share the default cluster, they are told apart by workflow
+        self.root_id = str(uuid.uuid4())
+        self.tasks = [str(uuid.uuid4()) for _ in range(3)]
+        for task_id in self.tasks:
+            self.event(task_id, "task-received")
+
+    def event(self, task_id: str, type_: str) -> None:
+        now = time.time()
+        apply_event({
+            "type": type_, "uuid": task_id, "name": "tests.add", "hostname": "worker@tests", "root_id": self.root_id,
+            "timestamp": now, "local_received": now, "clock": 1,
+        })
+
+    def get(self, headers: dict | None = None, **params):
+        return self.client.get(
+            "/api/tasks", {"cluster": clusters.default.id, "root_id": self.root_id, **params}, headers=headers,
+        )
+
+    def test_unchanged_lists_are_not_sent_again(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertEqual(self.get(headers={"If-None-Match": etag}).status_code, 304)
+
+        self.event(self.tasks[0], "task-started")
+        response = self.get(headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_since_lists_the_changed_and_removed_tasks(self):
+        version = self.get().json()["version"]
+        self.event(self.tasks[0], "task-started")
+        evict_tasks([self.tasks[1]], clusters.default)
+
+        changes = self.get(since=version).json()
+        self.assertEqual([task["id"] for task in changes["items"]], [self.tasks[0]])
+        self.assertEqual(changes["removed"], [self.tasks[1]])
+        self.assertGreater(changes["version"], version)
+        self.assertNotIn("total", changes)
+
+    def test_tasks_no_longer_matching_the_filters_are_removed(self):
+        version = self.get(state="RECEIVED").json()["version"]
+        self.event(self.tasks[0], "task-started")
+        self.assertEqual(self.get(state="RECEIVED", since=version).json()["removed"], [self.tasks[0]])
+
+    def test_a_page_is_sent_when_the_changes_are_no_longer_known(self):
+        page = self.get(since=0).json()
+        self.assertEqual(page["total"], 3)
+        self.assertEqual([task["id"] for task in page["items"]], self.tasks[::-1])
+        self.assertEqual(self.get(since="latest").status_code, 400)
@@ -6,4 +6,5 @@ urlpatterns = [
     path('', views.get_tasks, name='get_tasks'),
     path('/<str:task_id>', views.get_task_detail, name='get_task_detail'),
     path('/<str:task_id>/result', views.get_task_result, name='get_task_result'),
+    path('/<str:task_id>/workflow', views.get_task_workflow, name='get_task_workflow'),
 ]
\ No newline at end of file
@@ -1,38 +1,152 @@
 # views.py
 import json
 import ast
-from django.http import JsonResponse, Http404
-from django.core.paginator import Paginator
+from django.http import HttpResponse, JsonResponse, Http404, HttpResponseBadRequest
+from django.views.decorators.http import condition
 from celery.result import AsyncResult
 from celery_detect.celery_app import get_celery_app
-from events.receiver import state
-from tasks.models import Task, TaskResult
+from common.responses import json_items_response
+from events.changelog import ChangeLog
+from events.clusters import UnknownClusterError, clusters, task_cluster
+from events.exceptions import ShardUnavailableError
+from events.sharding import shard_pool
+from events.snapshot import StateSnapshot
+from tasks.index import TaskFilter, query_indexes, task_keys
+from tasks.models import TaskResult
+from tasks.workflow import build_workflow
 
 
+def get_task_changes(
+        snapshot: StateSnapshot, log: ChangeLog, since: int, filters: TaskFilter, limit: int
+) -> HttpResponse | None:
+    """Tasks changed after version ``since``, and the ones to drop (evicted or no longer matching the filters)."""
+    changes = log.since(since)
+    if changes is None or since > snapshot.version or len(changes.tasks) > limit:
+        return None
+
+    checks = filters.items()
+    items, removed = [], []
+    for uuid, task in zip(changes.tasks, snapshot.get_tasks(changes.tasks)):
+        if task is None or any(task_keys(task)[position] != value for position, value in checks):
+            removed.append(uuid)
+        else:
+            items.append(snapshot.convert_task(task).json)
+    return json_items_response(items, removed=removed, version=snapshot.version)
+
+
+def clusters_etag(request, *args, **kwargs) -> str | None:
+    if shard_pool is not None:
+        # The versions of the shards are not known to this process
+        return None
+    try:
+        return clusters.etag(request.GET.get('cluster') or None)
+    except UnknownClusterError:
+        return None
+
+
+@condition(etag_func=clusters_etag)
 def get_tasks(request):
-    limit = int(request.GET.get('limit', 1000))
-    offset = int(request.GET.get('offset', 0))
+    """A page of tasks, or with ``since`` only the changes since that version (falling back to a page
+    when they are no longer all known). Either way ``version`` is the one to pass as ``since`` next.
+
+    Tasks are listed most recently updated first, the order of ``State.tasks_by_time``, and ``total`` is
+    the number of tasks matching the filters. Tasks of every cluster are listed unless ``cluster`` is
+    given. Versions are per cluster, so with several clusters and no ``cluster``, ``version`` is null
+    and there are only full pages. So it is with sharded state, which only pages by ``offset``."""
+    try:
+        limit = max(int(request.GET.get('limit', 1000)), 1)
+        offset = int(request.GET.get('offset', 0))
+        cursor = request.GET.get('cursor')
+        cursor = int(cursor) if cursor else None
+        since = request.GET.get('since')
+        since = int(since) if since else None
+    except ValueError:
+        return HttpResponseBadRequest("limit, offset, cursor and since must be integers")
+    if offset < 0:
+        return HttpResponseBadRequest("offset must not be negative")
+
+    filters = TaskFilter.from_query(request.GET)
+    if shard_pool is not None:
+        try:
+            items, total = shard_pool.tasks(filters, limit=limit, offset=offset)
+        except ShardUnavailableError as e:
+            return HttpResponse(str(e), status=503)
+        return json_items_response(items, total=total, limit=limit, offset=offset, next_cursor=None, version=None)
+
+    try:
+        selected = clusters.select(filters.cluster)
+    except UnknownClusterError as e:
+        return HttpResponseBadRequest(str(e))
+    snapshot = clusters.snapshot(filters.cluster)
+    if since is not None and len(selected) == 1:
+        response = get_task_changes(snapshot, selected[0].snapshots.changes, since, filters, limit)
+        if response is not None:
+            response['ETag'] = snapshot.etag
+            return response
 
-    items = [Task.from_celery_task(task) for _, task in state.tasks_by_time()]
-    paginator = Paginator(items, limit)
-    page = paginator.get_page(offset // limit + 1)
+    if len(selected) == 1:
+        indexes = [(selected[0].index, snapshot.get_task, selected[0].state.tasks.data.__contains__)]
+    else:
+        indexes = [
+            (cluster.index, snapshot.snapshots[cluster.id].get_task, cluster.state.tasks.data.__contains__)
+            for cluster in selected
+        ]
+    page = query_indexes(
+        indexes,
+        filters=filters,
+        cursor=cursor,
+        limit=limit,
+        offset=offset if cursor is None else 0,
+    )
 
-    response_data = {
-        'items': [task.model_dump() for task in page.object_list],
-        'total': paginator.count,
-        'limit': limit,
-        'offset': offset,
-    }
-    return JsonResponse(response_data)
+    response = json_items_response(
+        [snapshot.convert_task(task).json for task in page.tasks],
+        total=page.total,
+        limit=limit,
+        offset=offset,
+        next_cursor=page.next_cursor,
+        version=snapshot.version,
+    )
+    response['ETag'] = snapshot.etag
+    return response
 
 
 def get_task_detail(request, task_id):
-    task = state.tasks.get(task_id)
+    if shard_pool is not None:
+        try:
+            task_data = shard_pool.task(task_id)
+        except ShardUnavailableError as e:
+            return HttpResponse(str(e), status=503)
+        if task_data is None:
+            raise Http404("Task not found.")
+        return HttpResponse(task_data, content_type="application/json")
+
+    snapshot = clusters.snapshot()
+    task = snapshot.get_task(task_id)
+    if task is None:
+        raise Http404("Task not found.")
+
+    return HttpResponse(snapshot.convert_task(task).json, content_type="application/json")
+
+
+def get_task_workflow(request, task_id):
+    """Whole workflow tree of a task. Follow it live by subscribing to its ``root_id`` on ws/events."""
+    if shard_pool is not None:
+        try:
+            workflow = shard_pool.workflow(task_id)
+        except ShardUnavailableError as e:
+            return HttpResponse(str(e), status=503)
+        if workflow is None:
+            raise Http404("Task not found.")
+        return JsonResponse(workflow)
+
+    task = clusters.snapshot().get_task(task_id)
     if task is None:
         raise Http404("Task not found.")
 
-    task_data = Task.from_celery_task(task).model_dump()
-    return JsonResponse(task_data)
+    # The workflow is assembled within the task's cluster
+    cluster = clusters.get(task_cluster(task))
+    return JsonResponse(build_workflow(task, cluster.snapshots.snapshot(), cluster.index).model_dump())
 
 
 def get_task_result(request, task_id):
@@ -0,0 +1,73 @@
+from celery.events.state import Task as CeleryTask
+
+from events.snapshot import StateSnapshot
+from tasks.index import TaskIndex
+from tasks.models import Task, Workflow, WorkflowNode
+
+
+def get_workflow_tasks(task: CeleryTask, snapshot: StateSnapshot, index: TaskIndex) -> list[CeleryTask]:
+    """All tasks in ``snapshot`` belonging to the same workflow as ``task``, found in the index of its cluster."""
+    root_id = task.root_id or task.uuid
+    uuids = index.workflow(root_id)
+    if root_id not in uuids:
+        uuids.append(root_id)
+    return [found for found in snapshot.get_tasks(uuids) if found is not None]
+
+
+def build_workflow(task: CeleryTask, snapshot: StateSnapshot, index: TaskIndex) -> Workflow:
+    """Assemble the workflow tree of ``task``, with per node aggregate runtimes and the critical path."""
+    root_id = task.root_id or task.uuid
+    tasks = {found.uuid: snapshot.convert_task(found).model for found in get_workflow_tasks(task, snapshot, index)}
+
+    parents: dict[str, str | None] = {}
+    children: dict[str | None, list[str]] = {}
+    for task_id, node in tasks.items():
+        # Tasks whose parent was evicted from memory hang off the top of the tree
+        parent_id = node.parent_id if node.parent_id in tasks and node.parent_id != task_id else None
+        parents[task_id] = parent_id
+        children.setdefault(parent_id, []).append(task_id)
+    for siblings in children.values():
+        siblings.sort(key=lambda task_id: tasks[task_id].sent_at)
+
+    # Parents before children, breadth first from the root (and any orphans)
+    order: list[tuple[str, int]] = [(task_id, 0) for task_id in children.get(None, [])]
+    for task_id, depth in order:
+        order.extend((child_id, depth + 1) for child_id in children.get(task_id, []))
+
+    aggregate: dict[str, float] = {}
+    for task_id, _ in reversed(order):
+        aggregate[task_id] = (tasks[task_id].runtime or 0.0) + sum(
+            aggregate[child_id] for child_id in children.get(task_id, [])
+        )
+
+    def finished_at(node: Task) -> float | None:
+        return node.succeeded_at or node.failed_at
+
+    nodes = [
+        WorkflowNode(
+            task=tasks[task_id],
+            depth=depth,
+            aggregate_runtime=aggregate[task_id],
+            finished_at=finished_at(tasks[task_id]),
+        )
+        for task_id, depth in order
+    ]
+
+    # The critical path ends at the task that finished last, and is traced back through its parents
+    critical_path: list[str] = []
+    last = max(nodes, key=lambda node: node.finished_at or node.task.last_updated, default=None)
+    task_id = last.task.id if last is not None else None
+    while task_id is not None:
+        critical_path.append(task_id)
+        task_id = parents[task_id]
+    critical_path.reverse()
+
+    root = tasks.get(root_id)
+    end = max((node.finished_at for node in nodes if node.finished_at is not None), default=None)
+    return Workflow(
+        root_id=root_id,
+        nodes=nodes,
+        critical_path=critical_path,
+        total_runtime=sum(node.runtime or 0.0 for node in tasks.values()),
+        duration=end - root.sent_at if root is not None and end is not None else None,
+    )
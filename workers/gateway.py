@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import threading
+import time
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Self
+
+from celery_detect.celery_app import get_celery_app
+from celery_detect.settings import CELERY_DEFAULT_CLUSTER, InspectSettings
+
+logger = logging.getLogger(__name__)
+
+#: Inspect commands served by the gateway, with how long (in seconds) a worker's reply is reused by default.
+DEFAULT_TTL = {
+    "stats": 5.0,
+    "registered": 5.0,
+    "revoked": 5.0,
+    "active_queues": 5.0,
+    "scheduled": 1.0,
+    "reserved": 1.0,
+    "active": 1.0,
+}
+INSPECT_COMMANDS = tuple(DEFAULT_TTL)
+
+
+class InspectGateway:
+    """Cached, single-flight access to Celery's inspect broadcasts.
+
+    Replies are cached per cluster, command and worker, each for the command's TTL. Concurrent
+    identical requests share one in-flight broadcast, which runs on a connection from the app's
+    broker connection pool (of the cluster's app) instead of a new connection per request. A request to a single worker
+    returns as soon as it replied, while a broadcast waits for the timeout: the workers known to the
+    state may be fewer than the ones that reply, and a broadcast cut short would pass for a complete one.
+
+    Broadcasts run on the gateway's own threads, so requests from different event loops (the
+    HTTP views and the events system) share them too.
+    """
+
+    def __init__(self, timeout: float = 10.0, ttl: dict[str, float] | None = None):
+        self.timeout = timeout
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        # (cluster, command) -> worker -> (fetched at, reply)
+        self._replies: dict[tuple[str, str], dict[str, tuple[float, Any]]] = {}
+        # (cluster, command) -> when the last broadcast to all workers completed
+        self._broadcast_at: dict[tuple[str, str], float] = {}
+        self._in_flight: dict[tuple[str, str, str | None], Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.ttl), thread_name_prefix="InspectGateway")
+        self.broadcasts = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict = InspectSettings) -> Self:
+        return cls(timeout=settings.get("TIMEOUT", 10.0), ttl=settings.get("TTL"))
+
+    def _fresh(self, fetched_at: float | None, command: str) -> bool:
+        return fetched_at is not None and time.monotonic() - fetched_at < self.ttl[command]
+
+    def cached(
+            self, command: str, worker: str | None = None, cluster: str = CELERY_DEFAULT_CLUSTER,
+    ) -> dict[str, Any] | None:
+        """Replies still within their TTL, or None if the gateway has to ask the workers again."""
+        with self._lock:
+            replies = self._replies.get((cluster, command), {})
+            if worker is not None:
+                fetched_at, reply = replies.get(worker, (None, None))
+                return {worker: reply} if self._fresh(fetched_at, command) else None
+            if not self._fresh(self._broadcast_at.get((cluster, command)), command):
+                return None
+            return {
+                hostname: reply for hostname, (fetched_at, reply) in replies.items() if self._fresh(fetched_at, command)
+            }
+
+    async def inspect(
+            self, command: str, worker: str | None = None, cluster: str = CELERY_DEFAULT_CLUSTER,
+    ) -> dict[str, Any]:
+        """Replies to an inspect ``command`` by worker hostname, from the workers of ``cluster`` or a single one."""
+        if command not in self.ttl:
+            raise ValueError(f"Unsupported inspect command {command!r}")
+        cached = self.cached(command, worker, cluster)
+        if cached is not None:
+            return cached
+
+        key = (cluster, command, worker)
+        with self._lock:
+            future = self._in_flight.get(key)
+            started = future is None
+            if started:
+                future = self._in_flight[key] = self._executor.submit(self._fetch, command, worker, cluster)
+        if started:
+            # Outside the lock, as the callback runs right away if the broadcast already finished
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # A cancelled request must not cancel the broadcast other requests are waiting for
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _forget(self, key: tuple[str, str, str | None], future: Future) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    async def inspect_many(
+            self, commands: Iterable[str] = INSPECT_COMMANDS, worker: str | None = None,
+            cluster: str = CELERY_DEFAULT_CLUSTER,
+    ) -> dict[str, dict[str, Any]]:
+        """Run several inspect commands at once, so they share a single reply window."""
+        commands = list(commands)
+        results = await asyncio.gather(*(self.inspect(command, worker, cluster) for command in commands))
+        return dict(zip(commands, results))
+
+    def _fetch(self, command: str, worker: str | None, cluster: str) -> dict[str, Any]:
+        replies = self._request(command, worker, cluster)
+        fetched_at = time.monotonic()
+        with self._lock:
+            cache = self._replies.setdefault((cluster, command), {})
+            for hostname, reply in replies.items():
+                cache[hostname] = (fetched_at, reply)
+            if worker is None:
+                self._broadcast_at[(cluster, command)] = fetched_at
+                # Workers that did not answer this broadcast are not served from older replies
+                for hostname in [hostname for hostname in cache if hostname not in replies]:
+                    del cache[hostname]
+        return replies
+
+    def _request(self, command: str, worker: str | None, cluster: str) -> dict[str, Any]:
+        app = get_celery_app(cluster)
+        self.broadcasts += 1
+        logger.debug(f"Broadcasting inspect {command} to {worker or 'all workers'} of cluster {cluster}")
+        with app.pool.acquire(block=True) as connection:
+            inspect = app.control.inspect(
+                timeout=self.timeout,
+                destination=[worker] if worker is not None else None,
+                connection=connection,
+                limit=1 if worker is not None else None,
+            )
+            return getattr(inspect, command)() or {}
+
+
+inspect_gateway = InspectGateway.from_settings()
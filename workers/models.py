@@ -27,9 +27,10 @@ class Worker(BaseModel):
     last_updated: EpochTimestamp = Field(description="When worker latest event published")
     heartbeat_expires: EpochTimestamp | None = Field(default=None, description="When worker will be considered offline")
     cpu_load: CPULoad | None = Field(default=None, description="Host CPU load average in last 1, 5 and 15 minutes")
+    cluster: str | None = Field(default=None, description="Celery cluster the worker belongs to")
 
     @classmethod
-    def from_celery_worker(cls, worker: CeleryWorker) -> Self:
+    def from_celery_worker(cls, worker: CeleryWorker, cluster: str | None = None) -> Self:
         return cls(
             id=f"{worker.hostname}-{worker.pid}",
             hostname=worker.hostname,
@@ -42,6 +43,7 @@ class Worker(BaseModel):
             processed_tasks=worker.processed or 0,
             heartbeat_expires=worker.heartbeat_expires if worker.heartbeats else None,
             cpu_load=CPULoad(*worker.loadavg) if worker.loadavg is not None else None,
+            cluster=cluster,
         )
 
 
@@ -1,3 +1,90 @@
-from django.test import TestCase
+import asyncio
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from workers.gateway import InspectGateway
+
+
+class FakeWorkers:
+    """Replies to inspect requests in place of the broker, once ``release`` is set."""
+
+    def __init__(self, replies: dict[str, dict]):
+        self.replies = replies
+        self.requests: list[tuple[str, str | None, str]] = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, command: str, worker: str | None, cluster: str) -> dict:
+        self.requests.append((command, worker, cluster))
+        self.release.wait(5)
+        if worker is not None:
+            return {worker: self.replies[worker]} if worker in self.replies else {}
+        return dict(self.replies)
+
+
+class InspectGatewayTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = InspectGateway(timeout=1.0, ttl={"stats": 5.0})
+        self.addCleanup(self.gateway._executor.shutdown)
+        self.workers = FakeWorkers({"celery@a": {"pid": 1}, "celery@b": {"pid": 2}})
+        patcher = mock.patch.object(self.gateway, "_request", self.workers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expire(self, command: str) -> None:
+        """Make the cached replies to ``command`` outlive their TTL."""
+        self.gateway.ttl[command] = 0
+
+    async def test_concurrent_requests_share_one_broadcast(self):
+        self.workers.release.clear()
+        requests = [asyncio.ensure_future(self.gateway.inspect("stats")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        self.workers.release.set()
+
+        results = await asyncio.gather(*requests)
+        self.assertEqual(results, [self.workers.replies] * 3)
+        self.assertEqual(self.workers.requests, [("stats", None, "default")])
+
+    async def test_replies_are_reused_until_their_ttl_runs_out(self):
+        await self.gateway.inspect("stats")
+        # Replies of a broadcast serve requests to a single worker too
+        self.assertEqual(await self.gateway.inspect("stats", worker="celery@a"), {"celery@a": {"pid": 1}})
+        self.assertEqual(len(self.workers.requests), 1)
+
+        self.expire("stats")
+        await self.gateway.inspect("stats")
+        self.assertEqual(len(self.workers.requests), 2)
+
+    async def test_commands_and_clusters_are_cached_apart(self):
+        await self.gateway.inspect("stats")
+        await self.gateway.inspect("active")
+        await self.gateway.inspect("stats", cluster="other")
+        self.assertEqual(
+            self.workers.requests, [("stats", None, "default"), ("active", None, "default"), ("stats", None, "other")],
+        )
+
+    async def test_workers_missing_from_a_broadcast_are_not_served_from_older_replies(self):
+        await self.gateway.inspect("stats")
+        del self.workers.replies["celery@b"]
+        self.expire("stats")
+        self.assertEqual(await self.gateway.inspect("stats"), {"celery@a": {"pid": 1}})
+        self.gateway.ttl["stats"] = 5.0
+        self.assertEqual(self.gateway.cached("stats"), {"celery@a": {"pid": 1}})
+        self.assertIsNone(self.gateway.cached("stats", worker="celery@b"))
+
+    async def test_a_cancelled_request_does_not_cancel_the_shared_broadcast(self):
+        self.workers.release.clear()
+        cancelled = asyncio.ensure_future(self.gateway.inspect("stats"))
+        waiting = asyncio.ensure_future(self.gateway.inspect("stats"))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        self.workers.release.set()
+
+        self.assertEqual(await waiting, self.workers.replies)
+        self.assertEqual(len(self.workers.requests), 1)
+
+    async def test_unsupported_commands_are_rejected(self):
+        with self.assertRaises(ValueError):
+            await self.gateway.inspect("shutdown")
@@ -1,69 +1,128 @@
-from django.http import JsonResponse
-from django.views.decorators.cache import cache_page
-from asgiref.sync import sync_to_async
-from events.receiver import state
-from workers.dependencies import get_inspect
-from workers.models import QueueInfo, ScheduledTask, Stats, TaskRequest, Worker
+import asyncio
 
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.views.decorators.http import condition
 
+from common.responses import json_items_response, json_list_response
+from events.clusters import UnknownClusterError, clusters
+from events.exceptions import ShardUnavailableError
+from events.sharding import shard_pool
+from workers.gateway import inspect_gateway
+from workers.models import QueueInfo, ScheduledTask, Stats, TaskRequest
+
+
+def workers_etag(request) -> str | None:
+    if shard_pool is not None:
+        return None
+    try:
+        selected = clusters.select(request.GET.get('cluster') or None)
+    except UnknownClusterError:
+        return None
+    # Workers stop being alive without any event, which changes the number of alive workers
+    alive = sum(1 for cluster in selected for worker in list(cluster.state.workers.data.values()) if worker.alive)
+    versions = "-".join(str(cluster.snapshots.version) for cluster in selected)
+    return f'W/"{versions}-{alive}"'
+
+
+@condition(etag_func=workers_etag)
 async def get_workers(request):
+    """All workers. With ``since``, an object with the workers changed since that version (plus the ones
+    that are not alive, which expire without any event) and the hostnames to drop, or with all of them
+    and no ``removed`` when the changes are no longer all known.
+
+    Workers of every cluster are listed unless ``cluster`` is given, in which case changes are only
+    known for a single cluster."""
     alive = request.GET.get('alive')
     if alive is not None:
         alive = alive.lower() in ['true', '1']
-
-    workers = [
-        Worker.from_celery_worker(worker)
-        for worker in state.workers.values()
-        if alive is None or worker.alive == alive
-    ]
-
-    return JsonResponse([worker.model_dump() for worker in workers], safe=False)
+    try:
+        since = request.GET.get('since')
+        since = int(since) if since else None
+    except ValueError:
+        return HttpResponseBadRequest("since must be an integer")
+    if shard_pool is not None:
+        # Sharded state has no versions to compute changes from
+        try:
+            items = await asyncio.to_thread(shard_pool.workers, alive)
+        except ShardUnavailableError as e:
+            return HttpResponse(str(e), status=503)
+        if since is None:
+            return json_list_response(items)
+        return json_items_response(items, version=None)
+
+    try:
+        selected = clusters.select(request.GET.get('cluster') or None)
+    except UnknownClusterError as e:
+        return HttpResponseBadRequest(str(e))
+
+    snapshot = clusters.snapshot(request.GET.get('cluster') or None)
+    workers = list(snapshot.cluster_workers())
+    changes = None
+    if since is not None and snapshot.version is not None and since <= snapshot.version:
+        changes = selected[0].snapshots.changes.since(since)
+    if changes is None:
+        items = [
+            snapshot.convert_worker(worker, cluster).json
+            for cluster, worker in workers
+            if alive is None or worker.alive == alive
+        ]
+        if since is None:
+            return json_list_response(items)
+        return json_items_response(items, version=snapshot.version)
+
+    changed = set(changes.workers)
+    stored = {worker.hostname for _, worker in workers}
+    items, removed = [], [hostname for hostname in changed if hostname not in stored]
+    for cluster, worker in workers:
+        if worker.hostname not in changed and worker.alive:
+            continue
+        if alive is None or worker.alive == alive:
+            items.append(snapshot.convert_worker(worker, cluster).json)
+        else:
+            removed.append(worker.hostname)
+    return json_items_response(items, removed=removed, version=snapshot.version)
+
+
+async def inspect_workers(request, command: str) -> JsonResponse | HttpResponseBadRequest:
+    """Replies to an inspect ``command`` from the workers of every cluster, of ``cluster``, or from ``worker``,
+    asked within the clusters it is known to."""
+    worker = request.GET.get('worker') or None
+    try:
+        selected = clusters.select(request.GET.get('cluster') or None)
+    except UnknownClusterError as e:
+        return HttpResponseBadRequest(str(e))
+    if worker is not None and len(selected) > 1:
+        selected = [cluster for cluster in selected if worker in cluster.state.workers.data] or selected
+    results = await asyncio.gather(*(inspect_gateway.inspect(command, worker, cluster.id) for cluster in selected))
+    replies = {}
+    for result in results:
+        replies.update(result)
+    return JsonResponse(replies)
 
 
-@cache_page(5)
 async def get_worker_stats(request):
-    inspect = await get_inspect()
-    stats = await sync_to_async(inspect.stats)() or {}
-    return JsonResponse(stats)
+    return await inspect_workers(request, "stats")
 
 
-@cache_page(5)
 async def get_worker_registered(request):
-    inspect = await get_inspect()
-    registered = await sync_to_async(inspect.registered)() or {}
-    return JsonResponse(registered)
+    return await inspect_workers(request, "registered")
 
 
-@cache_page(5)
 async def get_worker_revoked(request):
-    inspect = await get_inspect()
-    revoked = await sync_to_async(inspect.revoked)() or {}
-    return JsonResponse(revoked)
+    return await inspect_workers(request, "revoked")
 
 
-@cache_page(1)
 async def get_worker_scheduled(request):
-    inspect = await get_inspect()
-    scheduled = await sync_to_async(inspect.scheduled)() or {}
-    return JsonResponse(scheduled)
+    return await inspect_workers(request, "scheduled")
 
 
-@cache_page(1)
 async def get_worker_reserved(request):
-    inspect = await get_inspect()
-    reserved = await sync_to_async(inspect.reserved)() or {}
-    return JsonResponse(reserved)
+    return await inspect_workers(request, "reserved")
 
 
-@cache_page(1)
 async def get_worker_active(request):
-    inspect = await get_inspect()
-    active = await sync_to_async(inspect.active)() or {}
-    return JsonResponse(active)
+    return await inspect_workers(request, "active")
 
 
-@cache_page(5)
 async def get_worker_queues(request):
-    inspect = await get_inspect()
-    queues = await sync_to_async(inspect.active_queues)() or {}
-    return JsonResponse(queues)
+    return await inspect_workers(request, "active_queues")
@@ -1,7 +1,15 @@
 import logging
 import json
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from ws.managers import events_manager, raw_events_manager
+from pydantic import ValidationError
+
+from events.poller import worker_poller
+from ws.encoding import WireFormat, negotiate_wire_format
+from ws.managers import events_manager, raw_events_manager, workers_manager
+from ws.models import ClientInfo, SlowClientPolicy
+from ws.subscriptions import SubscriptionFilter
 
 logger = logging.getLogger(__name__)
 
@@ -10,21 +18,54 @@ class BaseWebSocketConsumer(AsyncWebsocketConsumer):
     manager = None  # Define the manager in subclass
 
     async def connect(self):
-        await self.accept()
-        self.manager.subscribe(self)
+        self.client_info = await ClientInfo.from_scope(self.scope)
+        wire_format = negotiate_wire_format(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=wire_format.value if wire_format is not None else None)
+        self.manager.subscribe(
+            self,
+            policy=self.get_slow_client_policy(),
+            wire_format=wire_format or WireFormat.JSON,
+        )
         logger.info(f"Client {self.scope['client']} connected to {self.manager.name}")
 
     async def disconnect(self, close_code):
         self.manager.unsubscribe(self)
         logger.info(f"Client {self.scope['client']} disconnected from {self.manager.name}")
 
+    def handle_message(self, message: str | bytes) -> None:
+        """Apply subscription requests, e.g, ``{"action": "subscribe", "filters": {"task_names": ["app.*"]}}``."""
+        try:
+            request = json.loads(message)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(request, dict):
+            return
+
+        action = request.get("action")
+        if action == "subscribe":
+            self.manager.set_filter(self, SubscriptionFilter.model_validate(request.get("filters") or {}))
+        elif action == "unsubscribe":
+            self.manager.set_filter(self, SubscriptionFilter())
+
+    def get_slow_client_policy(self) -> SlowClientPolicy | None:
+        """Clients may pick how they are treated when falling behind, e.g, ``ws/events?on_lag=drop``."""
+        query = parse_qs(self.scope.get('query_string', b'').decode('utf-8', errors='ignore'))
+        try:
+            return SlowClientPolicy(query['on_lag'][0])
+        except (KeyError, ValueError):
+            return None
+
     async def receive(self, text_data=None, bytes_data=None):
         try:
             message = text_data or bytes_data
             logger.debug(f"Client {self.scope['client']} sent message: {message}")
+            self.handle_message(message)
             # You can respond with a JSON message:
             response = {"code": 0, "message": "ok"}
             await self.send(text_data=json.dumps(response))
+        except ValidationError as e:
+            logger.info(f"Invalid subscription from {self.scope['client']}: {e}")
+            await self.send(text_data=json.dumps({"code": -1, "message": "invalid subscription"}))
         except Exception as e:
             logger.error(f"Error processing received message from {self.scope['client']}: {e}")
             await self.send(text_data=json.dumps({"code": -1, "message": "error"}))
@@ -36,3 +77,13 @@ class EventsConsumer(BaseWebSocketConsumer):
 
 class RawEventsConsumer(BaseWebSocketConsumer):
     manager = raw_events_manager
+
+
+class WorkersConsumer(BaseWebSocketConsumer):
+    """Worker details (stats, active, reserved and scheduled tasks, queues), pushed as they change."""
+    manager = workers_manager
+
+    async def connect(self):
+        await super().connect()
+        if worker_poller is not None:
+            worker_poller.send_snapshot(self)
@@ -0,0 +1,81 @@
+import json
+import logging
+import zlib
+from enum import Enum
+from typing import Any, Self
+
+from pydantic import BaseModel
+
+from metrics.tracing import EventTrace
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+
+class WireFormat(str, Enum):
+    """Encodings a client can negotiate through the WebSocket subprotocol."""
+    JSON = "json"
+    JSON_DEFLATE = "json.deflate"
+    MSGPACK = "msgpack"
+
+    @property
+    def available(self) -> bool:
+        return self != WireFormat.MSGPACK or msgpack is not None
+
+
+def negotiate_wire_format(subprotocols: list[str]) -> WireFormat | None:
+    """Pick the first subprotocol offered by the client that we support, in the client's order of preference."""
+    for subprotocol in subprotocols:
+        try:
+            wire_format = WireFormat(subprotocol)
+        except ValueError:
+            continue
+        if wire_format.available:
+            return wire_format
+    return None
+
+
+class Payload:
+    """A broadcast message, encoded lazily at most once per wire format and shared by every client.
+
+    ``trace`` is the latency trace of the event the message was built from, if it was sampled.
+    """
+
+    __slots__ = ("data", "trace", "_frames")
+
+    def __init__(self, data: BaseModel | Any, trace: EventTrace | None = None):
+        self.data = data
+        self.trace = trace
+        self._frames: dict[WireFormat, str | bytes] = {}
+
+    @classmethod
+    def from_text(cls, text: str) -> Self:
+        """Wrap an already JSON-encoded message."""
+        payload = cls(None)
+        payload._frames[WireFormat.JSON] = text
+        return payload
+
+    def encode(self, wire_format: WireFormat = WireFormat.JSON) -> str | bytes:
+        try:
+            return self._frames[wire_format]
+        except KeyError:
+            frame = self._frames[wire_format] = self._encode(wire_format)
+            return frame
+
+    def _encode(self, wire_format: WireFormat) -> str | bytes:
+        if wire_format == WireFormat.JSON:
+            if isinstance(self.data, BaseModel):
+                return self.data.model_dump_json()
+            return json.dumps(self.data)
+        elif wire_format == WireFormat.JSON_DEFLATE:
+            return zlib.compress(self.encode(WireFormat.JSON).encode("utf-8"))
+        elif wire_format == WireFormat.MSGPACK:
+            if self.data is None:
+                return msgpack.packb(json.loads(self._frames[WireFormat.JSON]))
+            data = self.data.model_dump(mode="json") if isinstance(self.data, BaseModel) else self.data
+            return msgpack.packb(data, default=str)
+        raise ValueError(f"Unknown wire format {wire_format!r}")
@@ -2,3 +2,4 @@ from ws.websocket_manager import WebsocketManager
 
 events_manager = WebsocketManager("Events")
 raw_events_manager = WebsocketManager("RawEvents")
+workers_manager = WebsocketManager("Workers")
@@ -5,6 +5,8 @@ from typing import Self
 from user_agents import parse as user_agent_parse
 from pydantic import BaseModel, Field
 
+from ws.encoding import WireFormat
+
 
 logger = logging.getLogger(__name__)
 
@@ -43,12 +45,29 @@ class UserAgentInfo(BaseModel):
         )
 
 
+class SlowClientPolicy(str, Enum):
+    DROP = "drop"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+class ClientStats(BaseModel):
+    policy: SlowClientPolicy = Field(description="What happens when the client falls behind")
+    wire_format: WireFormat = Field(description="Encoding negotiated through the WebSocket subprotocol")
+    pending: int = Field(description="Messages waiting to be sent to the client")
+    sent: int = Field(description="Messages sent to the client")
+    dropped: int = Field(description="Messages dropped because the client fell behind")
+    coalesced: int = Field(description="Pending messages replaced by a newer message for the same entity")
+    lag: float = Field(description="Age of the oldest pending message in seconds")
+
+
 class ClientInfo(BaseModel):
     host: str
     port: int
     state: ConnectionState  # 使用枚举值代替字符串
     is_secure: bool
     user_agent: UserAgentInfo | None
+    stats: ClientStats | None = None
 
     @classmethod
     async def from_scope(cls, scope) -> Self:
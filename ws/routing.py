@@ -6,4 +6,5 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'ws/events', consumers.EventsConsumer.as_asgi()),
     re_path(r'ws/raw_events', consumers.RawEventsConsumer.as_asgi()),
+    re_path(r'ws/workers', consumers.WorkersConsumer.as_asgi()),
 ]
@@ -0,0 +1,145 @@
+import logging
+from collections.abc import Hashable
+from fnmatch import fnmatchcase
+from typing import NamedTuple
+
+from pydantic import BaseModel, ConfigDict, Field
+
+logger = logging.getLogger(__name__)
+
+#: Attribute value for dimensions that do not apply to an event (e.g, task name of a worker event).
+NOT_APPLICABLE = object()
+GLOB_CHARACTERS = frozenset("*?[")
+
+
+class EventAttributes(NamedTuple):
+    category: str
+    type: str
+    task_name: str | None | object = NOT_APPLICABLE
+    worker: str | None | object = NOT_APPLICABLE
+    routing_key: str | None | object = NOT_APPLICABLE
+    root_id: str | None | object = NOT_APPLICABLE
+    cluster: str | None | object = NOT_APPLICABLE
+
+
+class SubscriptionFilter(BaseModel):
+    """Which events a client wants to receive. Empty lists match everything.
+
+    Values within a list are alternatives, and the lists are combined with AND. Constraints
+    on task fields (task name, routing key, root id) only apply to task events.
+    """
+    categories: list[str] = Field(default_factory=list, description="Event categories (task / worker)")
+    types: list[str] = Field(default_factory=list, description="Event types (e.g, task-failed)")
+    task_names: list[str] = Field(default_factory=list, description="Task names, glob patterns allowed")
+    workers: list[str] = Field(default_factory=list, description="Worker hostnames")
+    routing_keys: list[str] = Field(default_factory=list, description="Task routing keys / queues")
+    root_ids: list[str] = Field(default_factory=list, description="Root task IDs, to follow workflows")
+    clusters: list[str] = Field(default_factory=list, description="Celery cluster ids")
+
+    model_config = ConfigDict(
+        extra="forbid",
+    )
+
+    def dimensions(self) -> tuple[list[str], ...]:
+        """Constraints in the order of :class:`EventAttributes` fields."""
+        return (
+            self.categories, self.types, self.task_names, self.workers, self.routing_keys, self.root_ids, self.clusters,
+        )
+
+
+class _Dimension:
+    """Routing table for one event attribute."""
+
+    __slots__ = ("exact", "globs", "unconstrained", "_glob_cache")
+
+    def __init__(self):
+        self.exact: dict[str, set[Hashable]] = {}
+        self.globs: dict[str, set[Hashable]] = {}
+        self.unconstrained: set[Hashable] = set()
+        self._glob_cache: dict[str, tuple[str, ...]] = {}
+
+    def add(self, client: Hashable, values: list[str]) -> None:
+        if not values:
+            self.unconstrained.add(client)
+            return
+        for value in values:
+            table = self.globs if GLOB_CHARACTERS.intersection(value) else self.exact
+            table.setdefault(value, set()).add(client)
+        self._glob_cache.clear()
+
+    def remove(self, client: Hashable) -> None:
+        self.unconstrained.discard(client)
+        for table in (self.exact, self.globs):
+            for value in [value for value, clients in table.items() if client in clients]:
+                table[value].discard(client)
+                if not table[value]:
+                    del table[value]
+        self._glob_cache.clear()
+
+    @property
+    def constrained(self) -> bool:
+        return bool(self.exact or self.globs)
+
+    def match(self, value) -> set[Hashable]:
+        if value is None:
+            return self.unconstrained
+        matched = self.unconstrained | self.exact.get(value, set())
+        if self.globs:
+            for pattern in self._matching_globs(value):
+                matched |= self.globs[pattern]
+        return matched
+
+    def _matching_globs(self, value: str) -> tuple[str, ...]:
+        try:
+            return self._glob_cache[value]
+        except KeyError:
+            if len(self._glob_cache) > 4096:
+                self._glob_cache.clear()
+            patterns = self._glob_cache[value] = tuple(
+                pattern for pattern in self.globs if fnmatchcase(value, pattern)
+            )
+            return patterns
+
+
+class SubscriptionIndex:
+    """Precomputed routing of events to clients by their subscription filters.
+
+    Instead of evaluating every client's filter for every event, each event attribute is looked
+    up once per dimension and the matching client sets are intersected.
+    """
+
+    def __init__(self):
+        self.filters: dict[Hashable, SubscriptionFilter] = {}
+        self._dimensions = tuple(_Dimension() for _ in EventAttributes._fields)
+
+    def assign(self, client: Hashable, subscription: SubscriptionFilter) -> None:
+        self.remove(client)
+        self.filters[client] = subscription
+        for dimension, values in zip(self._dimensions, subscription.dimensions()):
+            dimension.add(client, values)
+
+    def remove(self, client: Hashable) -> None:
+        if self.filters.pop(client, None) is None:
+            return
+        for dimension in self._dimensions:
+            dimension.remove(client)
+
+    @property
+    def unconstrained(self) -> bool:
+        """Whether every client receives every event."""
+        return not any(dimension.constrained for dimension in self._dimensions)
+
+    def match(self, attributes: EventAttributes) -> set[Hashable] | None:
+        """Clients that should receive an event, or None if all of them should."""
+        if self.unconstrained:
+            return None
+
+        candidates = [
+            dimension.match(value)
+            for dimension, value in zip(self._dimensions, attributes)
+            if value is not NOT_APPLICABLE and dimension.constrained
+        ]
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:])
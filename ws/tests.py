@@ -0,0 +1,243 @@
+import asyncio
+import json
+import unittest
+import zlib
+
+from django.test import SimpleTestCase
+from pydantic import BaseModel
+
+from metrics.tracing import LatencyTracer
+from ws.encoding import Payload, WireFormat, msgpack, negotiate_wire_format
+from ws.models import SlowClientPolicy
+from ws.subscriptions import EventAttributes, SubscriptionFilter, SubscriptionIndex
+from ws.websocket_manager import SLOW_CLIENT_CLOSE_CODE, ClientSender, WebsocketManager
+
+
+class FakeConnection:
+    """Stands in for a WebSocket consumer whose sends wait until ``open`` is set."""
+
+    def __init__(self):
+        self.scope = {"client": ("127.0.0.1", 8000)}
+        self.open = asyncio.Event()
+        self.open.set()
+        self.frames: list[str | bytes] = []
+        self.close_code: int | None = None
+
+    async def send(self, text_data: str | None = None, bytes_data: bytes | None = None) -> None:
+        await self.open.wait()
+        self.frames.append(text_data if text_data is not None else bytes_data)
+
+    async def close(self, code: int | None = None) -> None:
+        self.close_code = code
+
+
+async def until(condition, timeout: float = 5) -> None:
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.001)
+
+
+def task_attributes(
+        type_: str = "task-failed", task_name: str = "app.add", worker: str = "celery@a",
+) -> EventAttributes:
+    return EventAttributes(
+        category="task", type=type_, task_name=task_name, worker=worker, routing_key="default", root_id="root",
+        cluster="default",
+    )
+
+
+class Message(BaseModel):
+    type: str
+    count: int
+
+
+class PayloadTests(SimpleTestCase):
+    def test_json_encodes_the_model(self):
+        self.assertEqual(json.loads(Payload(Message(type="a", count=1)).encode()), {"type": "a", "count": 1})
+        self.assertEqual(json.loads(Payload({"type": "b"}).encode(WireFormat.JSON)), {"type": "b"})
+
+    def test_frames_are_encoded_once_per_wire_format(self):
+        payload = Payload(Message(type="a", count=1))
+        self.assertIs(payload.encode(WireFormat.JSON), payload.encode(WireFormat.JSON))
+        self.assertIs(payload.encode(WireFormat.JSON_DEFLATE), payload.encode(WireFormat.JSON_DEFLATE))
+
+    def test_json_deflate_compresses_the_json_frame(self):
+        payload = Payload(Message(type="a", count=1))
+        frame = payload.encode(WireFormat.JSON_DEFLATE)
+        self.assertIsInstance(frame, bytes)
+        self.assertEqual(zlib.decompress(frame).decode("utf-8"), payload.encode(WireFormat.JSON))
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_packs_the_model_and_already_encoded_text(self):
+        self.assertEqual(
+            msgpack.unpackb(Payload(Message(type="a", count=1)).encode(WireFormat.MSGPACK)), {"type": "a", "count": 1}
+        )
+        self.assertEqual(msgpack.unpackb(Payload.from_text('{"type": "b"}').encode(WireFormat.MSGPACK)), {"type": "b"})
+
+    def test_the_first_supported_subprotocol_is_negotiated(self):
+        self.assertEqual(negotiate_wire_format(["graphql-ws", "json.deflate", "json"]), WireFormat.JSON_DEFLATE)
+        self.assertIsNone(negotiate_wire_format(["graphql-ws"]))
+        self.assertIsNone(negotiate_wire_format([]))
+
+
+class ClientSenderTests(SimpleTestCase):
+    async def stalled_sender(self, policy: SlowClientPolicy, max_pending: int = 2) -> ClientSender:
+        """A sender whose client is stuck receiving a first message."""
+        self.connection = FakeConnection()
+        self.connection.open.clear()
+        sender = ClientSender(self.connection, max_pending=max_pending, policy=policy)
+        self.addCleanup(sender.close)
+        sender.enqueue(Payload.from_text("first"), key="first")
+        await until(lambda: not sender.stats().pending)
+        return sender
+
+    async def test_messages_are_sent_in_order(self):
+        connection = FakeConnection()
+        sender = ClientSender(connection, max_pending=10, policy=SlowClientPolicy.DROP)
+        for text in ("a", "b", "c"):
+            sender.enqueue(Payload.from_text(text))
+        await until(lambda: len(connection.frames) == 3)
+        sender.close()
+        self.assertEqual(connection.frames, ["a", "b", "c"])
+        self.assertEqual(sender.stats().sent, 3)
+
+    async def test_coalesce_replaces_pending_messages_of_the_same_key(self):
+        sender = await self.stalled_sender(SlowClientPolicy.COALESCE)
+        for text, key in (("a1", "a"), ("b1", "b"), ("a2", "a")):
+            self.assertTrue(sender.enqueue(Payload.from_text(text), key=key))
+        self.assertEqual((sender.stats().pending, sender.stats().coalesced), (2, 1))
+
+        self.connection.open.set()
+        await until(lambda: len(self.connection.frames) == 3)
+        self.assertEqual(self.connection.frames, ["first", "a2", "b1"])
+
+    async def test_drop_drops_the_oldest_pending_message(self):
+        sender = await self.stalled_sender(SlowClientPolicy.DROP)
+        for text in ("a", "b", "c"):
+            self.assertTrue(sender.enqueue(Payload.from_text(text), key="same"))
+        self.assertEqual((sender.stats().pending, sender.stats().dropped), (2, 1))
+
+        self.connection.open.set()
+        await until(lambda: len(self.connection.frames) == 3)
+        self.assertEqual(self.connection.frames, ["first", "b", "c"])
+
+    async def test_disconnect_closes_clients_that_fall_behind(self):
+        closed = []
+        sender = await self.stalled_sender(SlowClientPolicy.DISCONNECT)
+        sender.on_close = closed.append
+        self.assertTrue(sender.enqueue(Payload.from_text("a")))
+        self.assertTrue(sender.enqueue(Payload.from_text("b")))
+        self.assertFalse(sender.enqueue(Payload.from_text("c")))
+
+        await until(lambda: self.connection.close_code is not None)
+        self.assertEqual(self.connection.close_code, SLOW_CLIENT_CLOSE_CODE)
+        self.assertEqual(closed, [sender])
+        self.assertFalse(sender.enqueue(Payload.from_text("d")))
+        self.assertEqual((sender.stats().pending, sender.stats().dropped), (0, 3))
+
+    async def test_frames_are_sent_in_the_wire_format_of_the_client(self):
+        connection = FakeConnection()
+        sender = ClientSender(
+            connection, max_pending=10, policy=SlowClientPolicy.DROP, wire_format=WireFormat.JSON_DEFLATE,
+        )
+        payload = Payload(Message(type="a", count=1))
+        sender.enqueue(payload)
+        await until(lambda: len(connection.frames) == 1)
+        sender.close()
+        self.assertEqual(connection.frames, [payload.encode(WireFormat.JSON_DEFLATE)])
+
+    async def test_only_the_first_delivery_of_a_traced_message_is_timed(self):
+        tracer = LatencyTracer(sample_rate=1)
+        payload = Payload(Message(type="a", count=1), trace=tracer.start({}))
+        connections = [FakeConnection(), FakeConnection()]
+        senders = [ClientSender(connection, max_pending=10, policy=SlowClientPolicy.DROP) for connection in connections]
+        for sender in senders:
+            self.addCleanup(sender.close)
+            sender.enqueue(payload)
+        await until(lambda: all(connection.frames for connection in connections))
+
+        stages = tracer.report().stages
+        for stage in ("client_queue", "serialize", "send", "total"):
+            self.assertEqual(stages[stage].count, 1)
+
+    async def test_messages_can_be_enqueued_from_other_threads(self):
+        connection = FakeConnection()
+        sender = ClientSender(connection, max_pending=10, policy=SlowClientPolicy.DROP)
+        await asyncio.to_thread(sender.enqueue, Payload.from_text("a"))
+        await until(lambda: connection.frames == ["a"])
+        sender.close()
+
+
+class SubscriptionIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def test_every_client_matches_while_no_filter_constrains_events(self):
+        self.index.assign("a", SubscriptionFilter())
+        self.index.assign("b", SubscriptionFilter())
+        self.assertTrue(self.index.unconstrained)
+        self.assertIsNone(self.index.match(task_attributes()))
+
+    def test_constraints_are_combined_with_and_and_values_with_or(self):
+        self.index.assign("all", SubscriptionFilter())
+        self.index.assign("failures", SubscriptionFilter(types=["task-failed", "task-retried"]))
+        self.index.assign("failures-of-a", SubscriptionFilter(types=["task-failed"], workers=["celery@a"]))
+        self.assertEqual(self.index.match(task_attributes()), {"all", "failures", "failures-of-a"})
+        self.assertEqual(self.index.match(task_attributes("task-retried")), {"all", "failures"})
+        self.assertEqual(self.index.match(task_attributes(worker="celery@b")), {"all", "failures"})
+        self.assertEqual(self.index.match(task_attributes("task-succeeded")), {"all"})
+
+    def test_task_names_can_be_glob_patterns(self):
+        self.index.assign("app", SubscriptionFilter(task_names=["app.*"]))
+        self.index.assign("exact", SubscriptionFilter(task_names=["app.add"]))
+        self.assertEqual(self.index.match(task_attributes(task_name="app.add")), {"app", "exact"})
+        self.assertEqual(self.index.match(task_attributes(task_name="app.mul")), {"app"})
+        self.assertEqual(self.index.match(task_attributes(task_name="other.add")), set())
+
+    def test_task_constraints_do_not_apply_to_worker_events(self):
+        self.index.assign("app", SubscriptionFilter(task_names=["app.*"]))
+        self.index.assign("worker-a", SubscriptionFilter(workers=["celery@a"]))
+        heartbeat = EventAttributes(category="worker", type="worker-heartbeat", worker="celery@b")
+        self.assertEqual(self.index.match(heartbeat), {"app"})
+
+    def test_reassigned_and_removed_clients_no_longer_match_their_old_filter(self):
+        self.index.assign("a", SubscriptionFilter(types=["task-failed"]))
+        self.index.assign("a", SubscriptionFilter(types=["task-succeeded"]))
+        self.index.assign("b", SubscriptionFilter(types=["task-failed"]))
+        self.assertEqual(self.index.match(task_attributes()), {"b"})
+        self.index.remove("b")
+        self.assertEqual(self.index.match(task_attributes()), set())
+        self.index.remove("a")
+        self.assertTrue(self.index.unconstrained)
+
+
+class WebsocketManagerTests(SimpleTestCase):
+    def subscribe(self, manager: WebsocketManager, subscription: SubscriptionFilter | None = None) -> FakeConnection:
+        connection = FakeConnection()
+        manager.subscribe(connection)
+        self.addCleanup(manager.unsubscribe, connection)
+        if subscription is not None:
+            manager.set_filter(connection, subscription)
+        return connection
+
+    async def test_messages_are_only_sent_to_the_clients_matching_the_event(self):
+        manager = WebsocketManager("Tests")
+        everything = self.subscribe(manager)
+        failures = self.subscribe(manager, SubscriptionFilter(types=["task-failed"]))
+        await manager.broadcast("failed", attributes=task_attributes())
+        await manager.broadcast("succeeded", attributes=task_attributes("task-succeeded"))
+        await manager.broadcast("anything")
+
+        await until(lambda: len(everything.frames) == 3 and len(failures.frames) == 2)
+        self.assertEqual(everything.frames, ["failed", "succeeded", "anything"])
+        self.assertEqual(failures.frames, ["failed", "anything"])
+
+    async def test_unsubscribed_clients_are_no_longer_routed_to(self):
+        manager = WebsocketManager("Tests")
+        connection = self.subscribe(manager, SubscriptionFilter(types=["task-failed"]))
+        self.assertEqual([sender.connection for sender in manager.route(task_attributes())], [connection])
+
+        manager.unsubscribe(connection)
+        self.assertEqual(manager.route(task_attributes()), [])
+        self.assertFalse(manager.has_subscribers)
+        self.assertNotIn(connection, manager.subscriptions.filters)
@@ -1,35 +1,280 @@
 import logging
 import asyncio
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
 
-from ws.models import ClientInfo
+from celery_detect.settings import CELERY_WS_CLIENT_QUEUE_SIZE, CELERY_WS_SLOW_CLIENT_POLICY
+from ws.encoding import Payload, WireFormat
+from ws.models import ClientInfo, ClientStats, SlowClientPolicy
+from ws.subscriptions import EventAttributes, SubscriptionFilter, SubscriptionIndex
 
 logger = logging.getLogger(__name__)
 
+#: Close code sent to clients disconnected for falling behind (policy violation).
+SLOW_CLIENT_CLOSE_CODE = 1008
+
+
+class ClientSender:
+    """Bounded send queue for a single client, drained by its own writer task.
+
+    Messages may be enqueued from any thread (e.g, the events system runs its own event loop), so
+    the queue is guarded by a lock and the writer task is always woken up on the loop of the connection.
+    ``on_close`` is called once the sender closes, including when it closes itself because the client
+    fell behind or could not be sent to.
+    """
+
+    def __init__(
+            self,
+            connection: AsyncWebsocketConsumer,
+            max_pending: int,
+            policy: SlowClientPolicy,
+            wire_format: WireFormat = WireFormat.JSON,
+            on_close: Callable[["ClientSender"], None] | None = None,
+    ):
+        self.connection = connection
+        self.max_pending = max_pending
+        self.policy = policy
+        self.wire_format = wire_format
+        self.on_close = on_close
+        self._pending: OrderedDict[Hashable, tuple[Payload, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._unkeyed = 0
+        self.sent = self.dropped = self.coalesced = 0
+        self.closed = False
+        self._task = asyncio.create_task(self._write())
+
+    def enqueue(self, message: Payload, key: Hashable | None = None) -> bool:
+        """Queue a message without waiting. Returns False if the client was disconnected for lagging."""
+        if self.closed:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            if key is not None and self.policy == SlowClientPolicy.COALESCE and key in self._pending:
+                _, enqueued_at = self._pending[key]
+                self._pending[key] = (message, enqueued_at)
+                self.coalesced += 1
+                return True
+
+            lagging = len(self._pending) >= self.max_pending
+            if lagging and self.policy == SlowClientPolicy.DISCONNECT:
+                self.dropped += len(self._pending) + 1
+            else:
+                if lagging:
+                    self._pending.popitem(last=False)
+                    self.dropped += 1
+                if key is None or self.policy != SlowClientPolicy.COALESCE:
+                    self._unkeyed += 1
+                    key = (ClientSender, self._unkeyed)
+                self._pending[key] = (message, now)
+
+        if lagging and self.policy == SlowClientPolicy.DISCONNECT:
+            logger.warning(f"Client {self.connection.scope['client']} fell behind, disconnecting")
+            self.close()
+            self._call_in_loop(self.connection.close(code=SLOW_CLIENT_CLOSE_CODE))
+            return False
+        self._wake()
+        return True
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _wake(self) -> None:
+        if self._in_loop():
+            self._ready.set()
+        elif not self._ready.is_set():
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def _call_in_loop(self, coroutine) -> None:
+        """Run a coroutine on the connection's loop, whichever thread this is called from."""
+        if self._in_loop():
+            asyncio.create_task(coroutine)
+        else:
+            asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _pop(self) -> Payload | None:
+        with self._lock:
+            if not self._pending or self.closed:
+                return None
+            _, (message, _) = self._pending.popitem(last=False)
+            return message
+
+    async def _write(self) -> None:
+        while not self.closed:
+            await self._ready.wait()
+            while (message := self._pop()) is not None:
+                # Only the first delivery of a traced message is timed
+                trace = message.trace if message.trace is not None and message.trace.claim() else None
+                if trace is not None:
+                    trace.mark("client_queue")
+                try:
+                    frame = message.encode(self.wire_format)
+                    if trace is not None:
+                        trace.mark("serialize")
+                    if isinstance(frame, bytes):
+                        await self.connection.send(bytes_data=frame)
+                    else:
+                        await self.connection.send(text_data=frame)
+                except Exception as e:
+                    logger.warning(f"Failed to send message to client {self.connection.scope['client']}: {e}")
+                    self.close()
+                    return
+                if trace is not None:
+                    trace.finish()
+                self.sent += 1
+            self._ready.clear()
+            # A producer on another thread may have skipped waking us up while we were draining
+            with self._lock:
+                pending = bool(self._pending)
+            if pending:
+                self._ready.set()
+
+    def lag(self) -> float:
+        with self._lock:
+            return self._lag()
+
+    def _lag(self) -> float:
+        if not self._pending:
+            return 0.0
+        _, enqueued_at = next(iter(self._pending.values()))
+        return time.monotonic() - enqueued_at
+
+    def stats(self) -> ClientStats:
+        with self._lock:
+            return ClientStats(
+                policy=self.policy,
+                wire_format=self.wire_format,
+                pending=len(self._pending),
+                sent=self.sent,
+                dropped=self.dropped,
+                coalesced=self.coalesced,
+                lag=self._lag(),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._pending.clear()
+        if self.on_close is not None:
+            self.on_close(self)
+        if self._task.done():
+            return
+        if not self._in_loop():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        elif self._task is not asyncio.current_task():
+            self._task.cancel()
+
 
 class WebsocketManager:
-    def __init__(self, name: str):
+    """Connected clients of a websocket endpoint and their subscriptions.
+
+    Clients connect and disconnect on the server loop while events are routed from the events system
+    thread, so the connections and the subscription index are only used under a lock.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            max_pending: int = CELERY_WS_CLIENT_QUEUE_SIZE,
+            default_policy: SlowClientPolicy = SlowClientPolicy(CELERY_WS_SLOW_CLIENT_POLICY),
+    ):
         self.name = name
-        self.active_connections = []
+        self.max_pending = max_pending
+        self.default_policy = default_policy
+        self.active_connections: dict[AsyncWebsocketConsumer, ClientSender] = {}
+        self.subscriptions = SubscriptionIndex()
+        self._lock = threading.Lock()
 
-    def subscribe(self, websocket: AsyncWebsocketConsumer) -> None:
+    def subscribe(
+            self,
+            websocket: AsyncWebsocketConsumer,
+            policy: SlowClientPolicy | None = None,
+            wire_format: WireFormat = WireFormat.JSON,
+    ) -> None:
         logger.info(f"Client {websocket.scope['client']} subscribed to {self.name} websocket manager")
-        self.active_connections.append(websocket)
+        sender = ClientSender(
+            websocket, self.max_pending, policy or self.default_policy, wire_format, on_close=self._discard,
+        )
+        with self._lock:
+            self.active_connections[websocket] = sender
+            self.subscriptions.assign(websocket, SubscriptionFilter())
+
+    def set_filter(self, websocket: AsyncWebsocketConsumer, subscription: SubscriptionFilter) -> None:
+        """Replace which events a connected client receives."""
+        with self._lock:
+            if websocket not in self.active_connections:
+                return
+            self.subscriptions.assign(websocket, subscription)
+        logger.info(f"Client {websocket.scope['client']} updated its {self.name} subscription: {subscription}")
 
     def unsubscribe(self, websocket: AsyncWebsocketConsumer) -> None:
         logger.info(f"Client {websocket.scope['client']} unsubscribed from {self.name} websocket manager")
-        self.active_connections.remove(websocket)
+        with self._lock:
+            sender = self.active_connections.get(websocket)
+        if sender is not None:
+            sender.close()
+
+    def _discard(self, sender: ClientSender) -> None:
+        """Forget a client once its sender closed, unless it reconnected meanwhile with another one."""
+        with self._lock:
+            if self.active_connections.get(sender.connection) is sender:
+                del self.active_connections[sender.connection]
+                self.subscriptions.remove(sender.connection)
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self.active_connections)
+
+    def route(self, attributes: EventAttributes | None = None) -> list[ClientSender]:
+        """Senders of the clients whose subscription matches an event with the given attributes."""
+        with self._lock:
+            clients = self.subscriptions.match(attributes) if attributes is not None else None
+            if clients is None:
+                return list(self.active_connections.values())
+            return [self.active_connections[client] for client in clients if client in self.active_connections]
 
-    async def broadcast(self, message: str) -> None:
-        """Broadcasts a message to all active connections."""
-        logger.debug(f"Broadcasting message to {self.name} websocket manager")
-        for connection in self.active_connections:
-            await connection.send(text_data=message)
+    async def broadcast(
+            self,
+            message: Payload | str,
+            key: Hashable | None = None,
+            attributes: EventAttributes | None = None,
+    ) -> None:
+        """Queues a message for all matching connections, without waiting for any of them to receive it.
+
+        The message is encoded once per wire format in use and the same frame is shared by all clients.
+        Messages with the same ``key`` (e.g, the same task) may be coalesced for clients that fall behind.
+        """
+        self.send(self.route(attributes), message, key)
+
+    def send(self, senders: list[ClientSender], message: Payload | str, key: Hashable | None = None) -> None:
+        logger.debug(f"Broadcasting message to {len(senders)} clients of {self.name} websocket manager")
+        if not isinstance(message, Payload):
+            message = Payload.from_text(message)
+        for sender in senders:
+            sender.enqueue(message, key)
 
     def get_clients(self) -> list[ClientInfo]:
         """Returns a list of clients currently connected."""
-        return [client.client_info for client in self.active_connections]
+        with self._lock:
+            connections = list(self.active_connections.items())
+        return [client.client_info.model_copy(update={"stats": sender.stats()}) for client, sender in connections]
+
+    def max_lag(self) -> float:
+        with self._lock:
+            senders = list(self.active_connections.values())
+        return max((sender.lag() for sender in senders), default=0.0)
 
 
 class WebSocketConsumer(AsyncWebsocketConsumer):